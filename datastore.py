@@ -1,9 +1,39 @@
 import os
 import sys
 import json
+import heapq
+import datetime
+import itertools
+import math
+import time
+import zlib
+import lzma
+import mmap
+import struct
+import queue
+import hashlib
+import shutil
+import asyncio
+import functools
+import threading
+import multiprocessing
 import warnings
+from collections import deque, OrderedDict
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from bisect import bisect_left, bisect_right, insort
 
-__all__ = ['DataStore']
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+__all__ = ['DataStore', 'AsyncDataStore']
 
 
 #
@@ -82,61 +112,343 @@ class Index(object):
 #
 # query
 #
-class Term(object):
-    # FIXME: implement methods for infix operations &, |, -, ^
+class Query(object):
+    # base of query trees; plan() returns (estimated cost, factory of
+    # (encoded key, key, doc) stream sorted by encoded primary key)
+    def __and__(self, other):
+        return And(self, other)
+
+    def __or__(self, other):
+        return Or(self, other)
+
+    def __sub__(self, other):
+        return Sub(self, other)
+
+    def __xor__(self, other):
+        return Xor(self, other)
+
+    def matches(self, table, key, doc):
+        raise NotImplementedError
+
+    def may_match(self, file_table):
+        # False if zone maps of file rule out every row
+        return True
+
+    def plan(self, table, snapshot=None):
+        raise NotImplementedError
+
+    def execute(self, table, snapshot=None):
+        cost, stream = self.plan(table, snapshot)
+        return ((key, doc) for raw_key, key, doc in stream())
+
+    def _full_scan(self, table, snapshot=None):
+        # files ruled out by zone maps are only probed for newer versions
+        # of rows found elsewhere
+        cost = table.estimate_rows(self.may_match)
+
+        def stream():
+            for raw_key, doc in table._scan(file_filter=self.may_match, snapshot=snapshot):
+                key = decode_key(raw_key)
+
+                if self.matches(table, key, doc):
+                    yield raw_key, key, doc
+
+        return cost, stream
+
+
+# cost of fetching a row found through secondary index, relative to
+# reading a row in a scan
+INDEX_ROW_COST = 4
+
+
+class Term(Query):
+    OPERATORS = {
+        '==': lambda a, b: a == b,
+        '<': lambda a, b: a < b,
+        '<=': lambda a, b: a <= b,
+        '>': lambda a, b: a > b,
+        '>=': lambda a, b: a >= b,
+    }
+
+    def __init__(self, field_name, value=None, op='=='):
+        if op not in self.OPERATORS:
+            raise ValueError('invalid operator: {}'.format(repr(op)))
 
-    def __init__(self, field_name, value):
         self.field_name = field_name
-        self.value = value.lower()
+        self.value = value
+        self.op = op
+
+    def __repr__(self):
+        return '<{} {} {} {}>'.format(
+            self.__class__.__name__,
+            self.field_name,
+            self.op,
+            repr(self.value),
+        )
+
+    def __bool__(self):
+        # `a <= Term(f) <= b` evaluates as `(a <= Term(f)) and (Term(f) <= b)`
+        # and would silently drop lower bound
+        raise TypeError('chained comparison of terms, use (a <= Term(f)) & (Term(f) <= b)')
+
+    def _compare(self, op, value):
+        if self.value is not None:
+            return NotImplemented
+
+        return Term(self.field_name, value, op)
+
+    def __eq__(self, value):
+        return self._compare('==', value)
+
+    def __lt__(self, value):
+        return self._compare('<', value)
+
+    def __le__(self, value):
+        return self._compare('<=', value)
+
+    def __gt__(self, value):
+        return self._compare('>', value)
+
+    def __ge__(self, value):
+        return self._compare('>=', value)
 
-    def execute(self, table):
-        results = None # {}
-        return rows
+    __hash__ = object.__hash__
 
+    def column_value(self, table, key, doc):
+        # raises KeyError if row does not have field
+        if isinstance(doc, dict) and self.field_name in doc:
+            return doc[self.field_name]
 
-class BinOp(object):
+        primary_key = table.meta.primary_key
+
+        if self.field_name in primary_key and len(key) == len(primary_key):
+            return key[primary_key.index(self.field_name)]
+
+        raise KeyError(self.field_name)
+
+    def matches(self, table, key, doc):
+        try:
+            value = self.column_value(table, key, doc)
+            return bool(self.OPERATORS[self.op](value, self.value))
+        except (KeyError, TypeError):
+            return False
+
+    def may_match(self, file_table):
+        return file_table.may_match(self.field_name, self.op, self.value)
+
+    def key_range(self):
+        # [start, end) of one column prefix matching term
+        v = self.value
+
+        if self.op == '==':
+            return (v,), (v, KEY_MAX)
+        elif self.op == '<':
+            return None, (v,)
+        elif self.op == '<=':
+            return None, (v, KEY_MAX)
+        elif self.op == '>':
+            return (v, KEY_MAX), None
+        else:
+            return (v,), None
+
+    def plan(self, table, snapshot=None):
+        plans = [self._full_scan(table, snapshot)]
+        start, end = self.key_range()
+        primary_key = table.meta.primary_key
+
+        # primary key range scan
+        if primary_key and primary_key[0] == self.field_name:
+            def stream():
+                rows = table._scan(start, end, file_filter=self.may_match, snapshot=snapshot)
+
+                for raw_key, doc in rows:
+                    key = decode_key(raw_key)
+
+                    if self.matches(table, key, doc):
+                        yield raw_key, key, doc
+
+            plans.append((table.estimate_range(start, end), stream))
+
+        # secondary index scan; rows with None in leading column are
+        # not indexed
+        for name, columns in table.meta.indexes.items():
+            if columns[0] != self.field_name or self.value is None:
+                continue
+
+            sorted_by_key = self.op == '==' and len(columns) == 1
+            plans.append(table.plan_index(name, start, end, sorted_by_key, self.matches, snapshot))
+
+        return min(plans, key=lambda plan: plan[0])
+
+
+class Eq(Term):
+    def __init__(self, term):
+        Term.__init__(self, term.field_name, term.value, '==')
+
+
+class Lt(Term):
+    def __init__(self, term):
+        Term.__init__(self, term.field_name, term.value, '<')
+
+
+class Le(Term):
+    def __init__(self, term):
+        Term.__init__(self, term.field_name, term.value, '<=')
+
+
+class Gt(Term):
+    def __init__(self, term):
+        Term.__init__(self, term.field_name, term.value, '>')
+
+
+class Ge(Term):
+    def __init__(self, term):
+        Term.__init__(self, term.field_name, term.value, '>=')
+
+
+class BinOp(Query):
     def __init__(self, operator, operands):
         self.operator = operator
         self.operands = operands
 
-    def execute(self, model):
-        raise NotImplementedError
+    def __repr__(self):
+        return '<{} {}>'.format(
+            self.operator,
+            ' '.join(repr(op) for op in self.operands),
+        )
 
 
 class And(BinOp):
     def __init__(self, *operands):
         BinOp.__init__(self, 'AND', operands)
 
-    def execute(self, model):
-        results = None # {}
-        return rows
+    def matches(self, table, key, doc):
+        return all(op.matches(table, key, doc) for op in self.operands)
+
+    def may_match(self, file_table):
+        return all(op.may_match(file_table) for op in self.operands)
+
+    def plan(self, table, snapshot=None):
+        # cheapest operand drives, rest filter its stream
+        plans = [self._full_scan(table, snapshot)]
+
+        # equality terms covering leading columns of a compound index;
+        # estimates are per block, on a tie compound index is the more
+        # selective one, so it is considered before single operands
+        eq = {
+            op.field_name: op.value
+            for op in self.operands
+            if isinstance(op, Term) and op.op == '==' and op.value is not None
+        }
+
+        for name, columns in table.meta.indexes.items():
+            n = 0
+
+            while n < len(columns) and columns[n] in eq:
+                n += 1
+
+            if n < 2:
+                continue
+
+            prefix = tuple(eq[c] for c in columns[:n])
+            sorted_by_key = n == len(columns)
+            plans.append(table.plan_index(
+                name, prefix, prefix + (KEY_MAX,), sorted_by_key, self.matches, snapshot,
+            ))
+
+        for op in self.operands:
+            cost, stream = op.plan(table, snapshot)
+            plans.append((cost, self._filtered(table, stream)))
+
+        return min(plans, key=lambda plan: plan[0])
+
+    def _filtered(self, table, stream):
+        def filtered():
+            for raw_key, key, doc in stream():
+                if self.matches(table, key, doc):
+                    yield raw_key, key, doc
+
+        return filtered
 
 
 class Or(BinOp):
     def __init__(self, *operands):
         BinOp.__init__(self, 'OR', operands)
 
-    def execute(self, model):
-        results = None # {}
-        return rows
+    def matches(self, table, key, doc):
+        return any(op.matches(table, key, doc) for op in self.operands)
+
+    def may_match(self, file_table):
+        return any(op.may_match(file_table) for op in self.operands)
+
+    def plan(self, table, snapshot=None):
+        # union of sorted streams, unless scanning everything is cheaper
+        plans = [op.plan(table, snapshot) for op in self.operands]
+        cost = sum(plan[0] for plan in plans)
+
+        def stream():
+            last_key = None
+
+            for raw_key, key, doc in heapq.merge(*[plan[1]() for plan in plans], key=first_item):
+                if raw_key != last_key:
+                    last_key = raw_key
+                    yield raw_key, key, doc
+
+        return min([(cost, stream), self._full_scan(table, snapshot)], key=lambda plan: plan[0])
 
 
 class Sub(BinOp):
     def __init__(self, *operands):
         BinOp.__init__(self, 'SUB', operands)
 
-    def execute(self, model):
-        results = None # {}
-        return rows
+    def matches(self, table, key, doc):
+        first, rest = self.operands[0], self.operands[1:]
+        return first.matches(table, key, doc) and not any(op.matches(table, key, doc) for op in rest)
+
+    def may_match(self, file_table):
+        return self.operands[0].may_match(file_table)
+
+    def plan(self, table, snapshot=None):
+        # stream of first operand, rows matching any other are dropped
+        cost, first = self.operands[0].plan(table, snapshot)
+
+        def stream():
+            for raw_key, key, doc in first():
+                if self.matches(table, key, doc):
+                    yield raw_key, key, doc
+
+        return min([(cost, stream), self._full_scan(table, snapshot)], key=lambda plan: plan[0])
 
 
 class Xor(BinOp):
     def __init__(self, *operands):
         BinOp.__init__(self, 'XOR', operands)
 
-    def execute(self, model):
-        results = None # {}
-        return rows
+    def matches(self, table, key, doc):
+        return sum(bool(op.matches(table, key, doc)) for op in self.operands) % 2 == 1
+
+    def may_match(self, file_table):
+        return any(op.may_match(file_table) for op in self.operands)
+
+    def plan(self, table, snapshot=None):
+        # rows present in odd number of sorted operand streams
+        plans = [op.plan(table, snapshot) for op in self.operands]
+        cost = sum(plan[0] for plan in plans)
+
+        def stream():
+            merged = heapq.merge(*[plan[1]() for plan in plans], key=first_item)
+
+            for raw_key, group in itertools.groupby(merged, key=first_item):
+                group = list(group)
+
+                if len(group) % 2 == 1:
+                    yield group[0]
+
+        return min([(cost, stream), self._full_scan(table, snapshot)], key=lambda plan: plan[0])
+
+
+def first_item(item):
+    return item[0]
 
 
 class Union(Or):
@@ -156,263 +468,4516 @@ class SymmetricDifference(Xor):
 
 
 #
-# table
+# sstable
 #
-class TableMeta(object):
-    def __init__(self, table, fields=None):
-        self.table = table
-        self.fields = fields
-        
-        self.path = os.path.join(
-            self.table.ds.dirpath,
-            '{}.meta'.format(self.table.name),
-        )
+# file layout:
+#   [data block 0] ... [data block n-1] [index block] [footer]
+#
+# data block: `<codec:u8><length:u32>` header followed by payload,
+#   compressed by codec unless it is COMPRESSION_NONE; length is size
+#   of uncompressed payload.
+# block payload: sorted records, each `<shared:u16><unshared:u32><flag:u8>
+#   <value_len:u32>` followed by key suffix and value bytes; key is first
+#   `shared` bytes of previous key plus suffix. Every SSTABLE_RESTART_INTERVAL
+#   records a restart point stores key whole; payload ends with u32
+#   offsets of restart points and their count. A block is closed once it
+#   reaches `block_size` bytes.
+# index block: one entry per data block, `<key_len:u32><offset:u64><length:u32>`
+#   followed by the first key of that block.
+# stats block: JSON, last key and zone map `{column: [min, max]}` of
+#   document columns, values encoded as keys, hex encoded; a column with
+#   values of more than one type has no zone map.
+# footer: fixed size, see SSTABLE_FOOTER.
+#
+SSTABLE_MAGIC = b'DSST'
+SSTABLE_VERSION = 6
+SSTABLE_BLOCK_SIZE = 4096
+SSTABLE_BLOCK_HEADER = struct.Struct('<BI')
+SSTABLE_RECORD = struct.Struct('<HIBI')
+SSTABLE_RESTART = struct.Struct('<I')
+SSTABLE_RESTART_INTERVAL = 16
+SSTABLE_INDEX_ENTRY = struct.Struct('<IQI')
 
-        if self.fields:
-            if os.path.exists(self.path):
-                with open(self.path, 'r') as f:
-                    meta = json.load(f)
-                    fields = meta.get('fields', None)
-                    
-                    # FIXME: compare fields
-            else:
-                with open(self.path, 'w') as f:
-                    meta = {
-                        'name': self.table.name,
-                        'fields': {
-                            k: v.__getstate__()
-                            for k, v in self.fields.items()
-                        },
-                    }
-
-                    json.dump(meta, f, indent=4)
-        else:
-            # look for .meta file (JSON)
-            if os.path.exists(self.path):
-                with open(self.path, 'r') as f:
-                    meta = json.load(f)
-                    self.fields = meta.get('fields', None)
+# magic, version, level, seq, index_offset, index_length, block_count,
+# record_count, stats_length; seq orders level 0 files by age, it is the
+# file number of a flushed file or the newest seq of compaction inputs;
+# stats block follows index block
+SSTABLE_FOOTER = struct.Struct('<4sHBQQIIQI')
 
-class MemIndex(object):
-    def __init__(self, mem_table, columns):
-        self.mem_table = mem_table
-        self.columns = columns
-        self.items = []
+RECORD_FLAG_SET = 0
+RECORD_FLAG_DELETE = 1
 
-    def add(self, row):
-        # columns: pos_in_mem_table
-        pass
 
-    def execute(self, q):
-        pass
+#
+# block compression
+#
+# codec id is stored in every block header; a block that does not shrink
+# by at least 1/8 is stored uncompressed, so reads of incompressible
+# blocks stay zero-copy
+#
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_LZMA = 2
+COMPRESSION_LZ4 = 3
+COMPRESSION_ZSTD = 4
 
+# name -> (codec id, compress, decompress)
+COMPRESSION_CODECS = {
+    'zlib': (COMPRESSION_ZLIB, zlib.compress, zlib.decompress),
+    'lzma': (COMPRESSION_LZMA, lzma.compress, lzma.decompress),
+}
 
-class MemTable(object):
-    def __init__(self, table, cap=1000, on_full=None):
-        self.table = table
-        self.cap = cap
-        self.items = []
-        self.on_full_callback = on_full
+if lz4 is not None:
+    COMPRESSION_CODECS['lz4'] = (COMPRESSION_LZ4, lz4.frame.compress, lz4.frame.decompress)
 
-    def __repr__(self):
-        return '<{} table:{} len:{} cap:{}>'.format(
-            self.__class__.__name__,
-            self.table,
-            len(self.cap),
-            self.cap,
-        )
+if zstandard is not None:
+    # compressor objects are not thread-safe
+    COMPRESSION_CODECS['zstd'] = (
+        COMPRESSION_ZSTD,
+        lambda data: zstandard.ZstdCompressor().compress(data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data),
+    )
 
-    def set(self, key, value):
-        # FIXME:
-        self.items[key] = value
+BLOCK_DECOMPRESSORS = {
+    codec: decompress
+    for codec, compress, decompress in COMPRESSION_CODECS.values()
+}
 
-        if len(self.items) == self.cap:
-            if self.on_full_callback:
-                self.on_full_callback(table=self.table, mem_table=self)
-            else:
-                warnings.warn('max capacity reached for memtable: {}'.format(self))
 
-    def get(self, key):
-        # FIXME:
-        value = self.items[key]
-        return value
+def compression_codec(name):
+    # (codec id, compress) of compression setting, None for no compression
+    if name is None:
+        return None
 
-    def delete(self, key):
-        # FIXME:
-        del self.items[key]
+    if name not in COMPRESSION_CODECS:
+        raise ValueError('unsupported compression: {}'.format(repr(name)))
 
-    def on_full(self, func):
-        self.on_full_callback = func
+    codec, compress, decompress = COMPRESSION_CODECS[name]
+    return codec, compress
 
 
-class FileIndex(object):
-    def __init__(self, file_table, columns, path):
-        self.file_table = file_table
-        self.path = path
+def compress_block(data, compression=None):
+    if compression is not None:
+        codec, compress = compression
+        compressed = compress(data)
 
-        # FIXME: mmap file
+        if len(compressed) <= len(data) - len(data) // 8:
+            return SSTABLE_BLOCK_HEADER.pack(codec, len(data)) + compressed
 
-    def __repr__(self):
-        return '<{} table:{} path:{}>'.format(
-            self.__class__.__name__,
-            self.table,
-            self.path,
-        )
+    return SSTABLE_BLOCK_HEADER.pack(COMPRESSION_NONE, len(data)) + data
 
-    def execute(self, q):
-        pass
 
+def decompress_block(block):
+    codec, length = SSTABLE_BLOCK_HEADER.unpack_from(block)
+    data = block[SSTABLE_BLOCK_HEADER.size:]
 
-class FileTable(object):
-    def __init__(self, table, path):
-        self.table = table
-        self.path = path
+    if codec == COMPRESSION_NONE:
+        return data
+
+    if codec not in BLOCK_DECOMPRESSORS:
+        raise ValueError('unsupported block codec: {}'.format(codec))
+
+    data = BLOCK_DECOMPRESSORS[codec](data)
+
+    if len(data) != length:
+        raise ValueError('corrupt block: {} bytes, expected {}'.format(len(data), length))
+
+    return memoryview(data)
+
+
+#
+# key encoding
+#
+# primary keys (and index items) are tuples encoded into byte strings
+# whose bytewise order is the order of tuples, so memtables, sstable
+# indexes, merges and compaction compare raw bytes; every component is
+# a type tag followed by:
+#   int: 64-bit big-endian with sign bit flipped
+#   float: 64-bit big-endian ieee-754, sign bit flipped for positive,
+#     all bits flipped for negative numbers
+#   text, bytes: 0x00 escaped as 0x00 0xff, terminated by 0x00 0x01
+#   date: days since epoch, as int; time, datetime: microseconds, as int
+# KEY_MAX is a single 0xff byte, above every tag;
+# an encoded tuple is a prefix of encoded tuples it is a prefix of;
+# components of different types order by tag
+#
+KEY_NONE = 0x01
+KEY_FALSE = 0x02
+KEY_TRUE = 0x03
+KEY_INT = 0x10
+KEY_FLOAT = 0x20
+KEY_TEXT = 0x30
+KEY_BYTES = 0x40
+KEY_DATE = 0x50
+KEY_TIME = 0x51
+KEY_DATETIME = 0x52
 
-        # FIXME: mmap file
+KEY_UINT64 = struct.Struct('>Q')
+KEY_DOUBLE = struct.Struct('>d')
+KEY_SIGN = 1 << 63
+KEY_MASK = (1 << 64) - 1
+
+
+class KeyMax(object):
+    # sorts after any value, (v, KEY_MAX) is upper bound of prefix (v,);
+    # encodes to a byte greater than any tag
+    def __lt__(self, other):
+        return False
+
+    def __le__(self, other):
+        return other is self
+
+    def __gt__(self, other):
+        return other is not self
+
+    def __ge__(self, other):
+        return True
+
+    def __eq__(self, other):
+        return other is self
+
+    __hash__ = object.__hash__
 
     def __repr__(self):
-        return '<{} table:{} path:{}>'.format(
-            self.__class__.__name__,
-            self.table,
-            self.path,
-        )
+        return '<KeyMax>'
 
-    @classmethod
-    def from_mem_table(cls, table, mem_table):
-        # save to file
-        # FIXME: implement
 
-        # instantiate FileTable
-        file_table = FileTable(table, path)
-        return file_table
+KEY_MAX = KeyMax()
 
-    def get(self, key):
-        pass
 
+def encode_key_int(tag, value):
+    if not INT64_MIN <= value <= INT64_MAX:
+        raise OverflowError('key int out of 64-bit range: {}'.format(value))
 
-class Table(object):
-    def __init__(self, ds, name, fields=None, mem_table_cap=1000):
-        self.ds = ds
-        self.name = name
+    return bytes((tag,)) + KEY_UINT64.pack(value + KEY_SIGN)
 
-        self.meta = TableMeta(table=self, fields=fields)
-        self.mem_table = MemTable(table=self, cap=mem_table_cap, on_full=self._mem_full)
-        self.file_tables = [] # scan for .data files
 
-        # scan datastore dir for data files
-        for entry in os.scandir(self.ds.dirpath):
-            if entry.is_file() and entry.name.endswith('.data'):
-                path = os.path.join(self.dirpath, entry.name)
-                file_table = FileTable(table=self, path=path)
-                self.file_tables.append(file_table)
-                print(path, file_table)
+def encode_key(key):
+    parts = []
 
-    def fields(self, **fields):
-        self.meta = TableMeta(table=self, fields=fields)
-        return self
+    for v in key:
+        t = type(v)
 
-    def set(self, key, value):
-        self.mem_table.set(key, value)
+        if t is str:
+            parts.append(b'\x30' + v.encode('utf-8').replace(b'\x00', b'\x00\xff') + b'\x00\x01')
+        elif t is int:
+            parts.append(encode_key_int(KEY_INT, v))
+        elif t is float:
+            bits = KEY_UINT64.unpack(KEY_DOUBLE.pack(v + 0.0))[0]
 
-    def get(self, key):
-        value = self.mem_table.get(key)
-        return value
+            if bits & KEY_SIGN:
+                bits ^= KEY_MASK
+            else:
+                bits |= KEY_SIGN
 
-    def delete(self, key):
-        self.mem_table.delete(key)
+            parts.append(b'\x20' + KEY_UINT64.pack(bits))
+        elif v is None:
+            parts.append(b'\x01')
+        elif t is bool:
+            parts.append(b'\x03' if v else b'\x02')
+        elif t is bytes:
+            parts.append(b'\x40' + v.replace(b'\x00', b'\x00\xff') + b'\x00\x01')
+        elif t is datetime.datetime and v.tzinfo is None:
+            parts.append(encode_key_int(KEY_DATETIME, encode_datetime(v)))
+        elif t is datetime.date:
+            parts.append(encode_key_int(KEY_DATE, encode_date(v)))
+        elif t is datetime.time and v.tzinfo is None:
+            parts.append(encode_key_int(KEY_TIME, encode_time(v)))
+        elif v is KEY_MAX:
+            parts.append(b'\xff')
+        else:
+            raise TypeError('unsupported key value: {}'.format(repr(v)))
 
-    def _mem_full(self, table, mem_table):
-        print('_mem_full', self, table, mem_table)
+    return b''.join(parts)
 
-        # table
-        file_table = FileTable.from_mem_table(table=table, mem_table=mem_table)
-        self.file_tables.append(file_table)
 
-        # memtable
-        self.mem_table = MemTable(
-            table=table,
-            cap=mem_table.cap,
-            on_full=self._mem_full,
-        )
+def decode_key_prefix(data, n=None):
+    # first n components of encoded key and byte length they take
+    data = bytes(data)
+    values = []
+    pos = 0
 
-    def execute(self, q):
-        pass
+    while pos < len(data) and (n is None or len(values) < n):
+        tag = data[pos]
+        pos += 1
 
+        if tag == KEY_TEXT or tag == KEY_BYTES:
+            parts = []
 
-class DataStore(object):
-    def __init__(self, dirpath):
-        self.dirpath = os.path.abspath(dirpath)
+            while True:
+                i = data.index(b'\x00', pos)
+                parts.append(data[pos:i])
+                pos = i + 2
 
-        if not os.path.exists(self.dirpath):
-            msg = 'datastore does not exist at {}'.format(repr(self.dirpath))
-            msg += ', so it will be created.'
-            warnings.warn(msg)
-            os.makedirs(dirpath)
+                if data[i + 1] == 0x01:
+                    break
 
-        # database tables
-        self.tables = {}
+                parts.append(b'\x00')
 
-    def __repr__(self):
-        return '<{} dirpath:{}>'.format(
-            self.__class__.__name__,
-            repr(self.dirpath),
-        )
+            v = b''.join(parts)
 
-    def table(self, name, fields=None, mem_table_cap=1000):
-        t = Table(self, name, fields, mem_table_cap=mem_table_cap)
-        self.tables[name] = t
-        return t
+            if tag == KEY_TEXT:
+                v = v.decode('utf-8')
+        elif tag == KEY_NONE:
+            v = None
+        elif tag == KEY_FALSE:
+            v = False
+        elif tag == KEY_TRUE:
+            v = True
+        elif tag == KEY_FLOAT:
+            bits = KEY_UINT64.unpack_from(data, pos)[0]
+            pos += 8
 
+            if bits & KEY_SIGN:
+                bits ^= KEY_SIGN
+            else:
+                bits ^= KEY_MASK
 
-if __name__ == '__main__':
-    d = DataStore('tmp/demo0')
+            v = KEY_DOUBLE.unpack(KEY_UINT64.pack(bits))[0]
+        elif tag in (KEY_INT, KEY_DATE, KEY_TIME, KEY_DATETIME):
+            v = KEY_UINT64.unpack_from(data, pos)[0] - KEY_SIGN
+            pos += 8
 
-    User = d.table('User', mem_table_cap=10).fields(
-        username=TextField(primary_key=True),
-        password=TextField(primary_key=True),
-        created=DateTimeField(primary_key=True),
-        first_name=TextField(),
-        last_name=TextField(),
-        email=TextField(),
-        dob=DateField(),
-        username_dob_index=Index('username', 'dob'),
-        dob_email_index=Index('dob', 'email'),
-    )
+            if tag == KEY_DATE:
+                v = decode_date(v)
+            elif tag == KEY_TIME:
+                v = decode_time(v)
+            elif tag == KEY_DATETIME:
+                v = decode_datetime(v)
+        else:
+            raise ValueError('invalid key tag: {}'.format(tag))
 
-    # results = User.execute(
-    #     Or(
-    #         Term('username', 'mtasic'),
-    #         And(
-    #             Le(Term('dob', '19850623')),
-    #             Ge(Term('dob', '19890625')),
-    #         )
-    #     )
-    # )
+        values.append(v)
 
-    # results = User.execute(
-    #     Term('username', 'mtasic') | (
-    #         '19890625' <= Term('dob') <= '19850623'
-    #     )
-    # )
+    return tuple(values), pos
 
-    # results = User.execute(
-    #     User.username == 'mtasic' | (
-    #         '19890625' <= User.dob <= '19850623'
-    #     )
-    # )
 
-    # results = User.execute(
-    #     'username == "mtasic" OR (dob < "19850623" AND dob > "19890625")'
-    # )
+def decode_key(data):
+    return decode_key_prefix(data)[0]
 
-    for i in range(User.mem_table.cap * 2 - 1):
-        User.set(i, i)
 
-    for i in range(User.mem_table.cap * 2 - 1):
-        try:
-            v = User.get(i)
-        except KeyError as e:
-            print(KeyError, e)
-            continue
+# json has no date and time types; they are stored as single key
+# objects, so are user dicts with such a key, as pairs
+JSON_TAGS = {
+    '$date': datetime.date.fromisoformat,
+    '$time': datetime.time.fromisoformat,
+    '$datetime': datetime.datetime.fromisoformat,
+    '$dict': dict,
+}
 
-        print('{}: {}'.format(i, v))
+
+def to_json(value):
+    t = type(value)
+
+    if t is dict:
+        if len(value) == 1 and next(iter(value)) in JSON_TAGS:
+            return {'$dict': [[k, to_json(v)] for k, v in value.items()]}
+
+        return {k: to_json(v) for k, v in value.items()}
+    elif t is list or t is tuple:
+        return [to_json(v) for v in value]
+    elif t is datetime.datetime:
+        return {'$datetime': value.isoformat()}
+    elif t is datetime.date:
+        return {'$date': value.isoformat()}
+    elif t is datetime.time:
+        return {'$time': value.isoformat()}
+
+    return value
+
+
+def from_json(obj):
+    if len(obj) == 1:
+        k, v = next(iter(obj.items()))
+
+        if k in JSON_TAGS:
+            return JSON_TAGS[k](v)
+
+    return obj
+
+
+def encode_value(value):
+    return json.dumps(to_json(value)).encode('utf-8')
+
+
+def decode_value(data):
+    return json.loads(bytes(data).decode('utf-8'), object_hook=from_json)
+
+
+#
+# record codec
+#
+# typed record:
+#   `<format:u8><version:u16>`, presence and null bitmaps of schema
+#   fields, one struct of fixed-width values of present, non-null fields
+#   in field order (text as byte length), then utf-8 text bytes
+# json record:
+#   `<format:u8>` followed by json; used for values not matching schema,
+#   dates and times are tagged objects (see to_json)
+#
+RECORD_FORMAT_JSON = 0
+RECORD_FORMAT_TYPED = 1
+RECORD_HEADER = struct.Struct('<BH')
+
+EPOCH_DATE = datetime.date(1970, 1, 1)
+EPOCH_DATETIME = datetime.datetime(1970, 1, 1)
+INT64_MIN = -(1 << 63)
+INT64_MAX = (1 << 63) - 1
+
+
+def encode_date(value):
+    return (value - EPOCH_DATE).days
+
+
+def decode_date(value):
+    return EPOCH_DATE + datetime.timedelta(days=value)
+
+
+def encode_time(value):
+    return ((value.hour * 60 + value.minute) * 60 + value.second) * 1000000 + value.microsecond
+
+
+def decode_time(value):
+    value, microsecond = divmod(value, 1000000)
+    value, second = divmod(value, 60)
+    hour, minute = divmod(value, 60)
+    return datetime.time(hour, minute, second, microsecond)
+
+
+def encode_datetime(value):
+    delta = value - EPOCH_DATETIME
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def decode_datetime(value):
+    return EPOCH_DATETIME + datetime.timedelta(microseconds=value)
+
+
+class RecordCodec(object):
+    # field type: (struct code, type check, encode, decode)
+    TYPES = {
+        'bool': ('?', lambda v: type(v) is bool, None, None),
+        'int': ('q', lambda v: type(v) is int and INT64_MIN <= v <= INT64_MAX, None, None),
+        'float': ('d', lambda v: type(v) is float, None, None),
+        'text': ('I', lambda v: type(v) is str, None, None),
+        'date': ('i', lambda v: type(v) is datetime.date, encode_date, decode_date),
+        'time': ('q', lambda v: type(v) is datetime.time and v.tzinfo is None, encode_time, decode_time),
+        'datetime': ('q', lambda v: type(v) is datetime.datetime and v.tzinfo is None, encode_datetime, decode_datetime),
+    }
+
+    def __init__(self, versions, version):
+        self.versions = versions
+        self.version = version
+        self.structs = {}
+
+    def __getstate__(self):
+        # structs are a cache and can not be pickled
+        return {'versions': self.versions, 'version': self.version}
+
+    def __setstate__(self, state):
+        self.__init__(state['versions'], state['version'])
+
+    def _struct(self, version, bits):
+        # struct of present, non-null fields, cached per bitmap
+        st = self.structs.get((version, bits))
+
+        if st is None:
+            fields = self.versions[version]
+
+            codes = [
+                self.TYPES[field_type][0]
+                for i, (name, field_type) in enumerate(fields)
+                if bits & (1 << i)
+            ]
+
+            st = struct.Struct('<' + ''.join(codes))
+            self.structs[(version, bits)] = st
+
+        return st
+
+    def encode(self, value):
+        if self.version is None or not isinstance(value, dict):
+            return self._encode_json(value)
+
+        fields = self.versions[self.version]
+        present = 0
+        null = 0
+        values = []
+        texts = []
+        n = 0
+
+        for i, (name, field_type) in enumerate(fields):
+            if name not in value:
+                continue
+
+            v = value[name]
+            present |= 1 << i
+            n += 1
+
+            if v is None:
+                null |= 1 << i
+                continue
+
+            code, check, encode, decode = self.TYPES[field_type]
+
+            if not check(v):
+                return self._encode_json(value)
+
+            if field_type == 'text':
+                v = v.encode('utf-8')
+                texts.append(v)
+                values.append(len(v))
+            elif encode is not None:
+                values.append(encode(v))
+            else:
+                values.append(v)
+
+        # keys outside schema
+        if n != len(value):
+            return self._encode_json(value)
+
+        n_bytes = (len(fields) + 7) // 8
+
+        return b''.join([
+            RECORD_HEADER.pack(RECORD_FORMAT_TYPED, self.version),
+            present.to_bytes(n_bytes, 'little'),
+            null.to_bytes(n_bytes, 'little'),
+            self._struct(self.version, present & ~null).pack(*values),
+        ] + texts)
+
+    def _encode_json(self, value):
+        return bytes((RECORD_FORMAT_JSON,)) + encode_value(value)
+
+    def decode(self, data):
+        if data[0] == RECORD_FORMAT_JSON:
+            return decode_value(data[1:])
+
+        record_format, version = RECORD_HEADER.unpack_from(data)
+        fields = self.versions[version]
+        n_bytes = (len(fields) + 7) // 8
+        pos = RECORD_HEADER.size
+        present = int.from_bytes(data[pos:pos + n_bytes], 'little')
+        pos += n_bytes
+        null = int.from_bytes(data[pos:pos + n_bytes], 'little')
+        pos += n_bytes
+        st = self._struct(version, present & ~null)
+        values = st.unpack_from(data, pos)
+        pos += st.size
+        doc = {}
+        j = 0
+
+        for i, (name, field_type) in enumerate(fields):
+            bit = 1 << i
+
+            if not present & bit:
+                continue
+
+            if null & bit:
+                doc[name] = None
+                continue
+
+            v = values[j]
+            j += 1
+
+            if field_type == 'text':
+                doc[name] = bytes(data[pos:pos + v]).decode('utf-8')
+                pos += v
+            else:
+                decode = self.TYPES[field_type][3]
+                doc[name] = v if decode is None else decode(v)
+
+        return doc
+
+
+class BloomFilter(object):
+    # file: `<magic:4s><n_hashes:u8><n_bits:u32>` followed by bit array
+    HEADER = struct.Struct('<4sBI')
+    MAGIC = b'DSBF'
+
+    def __init__(self, n_bits, n_hashes, bits=None):
+        self.n_bits = max(n_bits, 8)
+        self.n_hashes = n_hashes
+
+        if bits is None:
+            bits = bytearray((self.n_bits + 7) // 8)
+
+        self.bits = bits
+
+    @classmethod
+    def for_keys(cls, n_keys, bits_per_key=10):
+        # optimal number of hash functions is bits_per_key * ln(2)
+        n_hashes = min(max(int(round(bits_per_key * math.log(2))), 1), 30)
+        return cls(n_keys * bits_per_key, n_hashes)
+
+    @staticmethod
+    def hash(key):
+        # one digest per key, split into two halves for double hashing
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        return int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little')
+
+    def add(self, key):
+        self.add_hash(self.hash(key))
+
+    def add_hash(self, h):
+        h1, h2 = h
+        n_bits = self.n_bits
+        bits = self.bits
+
+        for i in range(self.n_hashes):
+            pos = (h1 + i * h2) % n_bits
+            bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        return self.may_contain_hash(self.hash(key))
+
+    def may_contain_hash(self, h):
+        h1, h2 = h
+        n_bits = self.n_bits
+        bits = self.bits
+
+        for i in range(self.n_hashes):
+            pos = (h1 + i * h2) % n_bits
+
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+
+        return True
+
+    def save(self, path):
+        tmp_path = '{}.tmp'.format(path)
+
+        with open(tmp_path, 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.n_hashes, self.n_bits))
+            f.write(self.bits)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        magic, n_hashes, n_bits = cls.HEADER.unpack_from(data)
+
+        if magic != cls.MAGIC:
+            raise ValueError('invalid bloom filter file: {}'.format(repr(path)))
+
+        bits = bytearray(data[cls.HEADER.size:])
+        return cls(n_bits, n_hashes, bits)
+
+
+def common_prefix_len(a, b):
+    # length of common prefix, as much as fits into record header
+    n = min(len(a), len(b), 0xffff)
+    i = 0
+
+    while i < n and a[i] == b[i]:
+        i += 1
+
+    return i
+
+
+class SSTableWriter(object):
+    def __init__(self, path, level=0, seq=0, bloom_bits_per_key=0,
+                 block_size=SSTABLE_BLOCK_SIZE, rate_limiter=None, compression=None,
+                 expected_keys=None, columns=()):
+        self.path = path
+        self.level = level
+        self.seq = seq
+        self.bloom_bits_per_key = bloom_bits_per_key
+        self.block_size = block_size
+        self.rate_limiter = rate_limiter
+        self.compression = compression_codec(compression)
+        self.tmp_path = '{}.tmp'.format(path)
+        self.f = open(self.tmp_path, 'wb')
+        self.offset = 0
+        self.block = []
+        self.block_len = 0
+        self.block_first_key = None
+        self.block_restarts = []
+        self.block_records = 0
+        self.last_key = b''
+        self.index = []
+        self.n_records = 0
+        self.key_hashes = []
+
+        # zone maps of document columns: column -> [min, max] of encoded
+        # values, None once column has values of different types
+        self.columns = columns
+        self.column_ranges = {}
+
+        # with number of keys known up front bloom filter is filled as
+        # keys come, instead of keeping their hashes until finish
+        if bloom_bits_per_key and expected_keys is not None:
+            self.bloom = BloomFilter.for_keys(expected_keys, bloom_bits_per_key)
+        else:
+            self.bloom = None
+
+    def add(self, key, flag, value, doc=None):
+        # keys must be added in sorted order, key and value are encoded
+        # bytes; doc is decoded value, for zone maps
+        if doc is not None and self.columns:
+            self._add_column_values(doc)
+
+        if self.block_first_key is None:
+            self.block_first_key = key
+
+        if self.bloom is not None:
+            self.bloom.add(key)
+        elif self.bloom_bits_per_key:
+            self.key_hashes.append(BloomFilter.hash(key))
+
+        if self.block_records % SSTABLE_RESTART_INTERVAL == 0:
+            self.block_restarts.append(self.block_len)
+            shared = 0
+        else:
+            shared = common_prefix_len(self.last_key, key)
+
+        suffix = key[shared:]
+        self.block.append(SSTABLE_RECORD.pack(shared, len(suffix), flag, len(value)))
+        self.block.append(suffix)
+        self.block.append(value)
+        self.block_len += SSTABLE_RECORD.size + len(suffix) + len(value)
+        self.last_key = key
+        self.block_records += 1
+        self.n_records += 1
+
+        if self.block_len >= self.block_size:
+            self._flush_block()
+
+    def _add_column_values(self, doc):
+        if not isinstance(doc, dict):
+            return
+
+        ranges = self.column_ranges
+
+        for column in self.columns:
+            v = doc.get(column)
+
+            if v is None:
+                continue
+
+            try:
+                v = encode_key((v,))
+            except (TypeError, OverflowError):
+                ranges[column] = None
+                continue
+
+            if column not in ranges:
+                ranges[column] = [v, v]
+                continue
+
+            r = ranges[column]
+
+            if r is None:
+                continue
+
+            if r[0][0] != v[0]:
+                ranges[column] = None
+            elif v < r[0]:
+                r[0] = v
+            elif v > r[1]:
+                r[1] = v
+
+    def _flush_block(self):
+        if not self.block:
+            return
+
+        for offset in self.block_restarts:
+            self.block.append(SSTABLE_RESTART.pack(offset))
+
+        self.block.append(SSTABLE_RESTART.pack(len(self.block_restarts)))
+        data = compress_block(b''.join(self.block), self.compression)
+
+        if self.rate_limiter is not None:
+            self.rate_limiter.request(len(data))
+
+        self.f.write(data)
+        self.index.append((self.block_first_key, self.offset, len(data)))
+        self.offset += len(data)
+        self.block = []
+        self.block_len = 0
+        self.block_first_key = None
+        self.block_restarts = []
+        self.block_records = 0
+
+    def finish(self):
+        self._flush_block()
+
+        # index block
+        index = []
+
+        for key, offset, length in self.index:
+            index.append(SSTABLE_INDEX_ENTRY.pack(len(key), offset, length))
+            index.append(key)
+
+        index = b''.join(index)
+        self.f.write(index)
+
+        # stats block
+        stats = json.dumps({
+            'max_key': self.last_key.hex() if self.n_records else None,
+            'columns': {
+                column: [r[0].hex(), r[1].hex()]
+                for column, r in self.column_ranges.items()
+                if r is not None
+            },
+        }).encode()
+
+        self.f.write(stats)
+
+        # footer
+        footer = SSTABLE_FOOTER.pack(
+            SSTABLE_MAGIC,
+            SSTABLE_VERSION,
+            self.level,
+            self.seq,
+            self.offset,
+            len(index),
+            len(self.index),
+            self.n_records,
+            len(stats),
+        )
+
+        self.f.write(footer)
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
+
+        # bloom filter goes first, data file is the commit point
+        if self.bloom is not None:
+            self.bloom.save(FileTable.bloom_path(self.path))
+        elif self.bloom_bits_per_key:
+            bloom = BloomFilter.for_keys(len(self.key_hashes), self.bloom_bits_per_key)
+
+            for h in self.key_hashes:
+                bloom.add_hash(h)
+
+            bloom.save(FileTable.bloom_path(self.path))
+
+        # file becomes visible only when complete
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        self.f.close()
+        os.remove(self.tmp_path)
+
+
+#
+# write-ahead log
+#
+# file: sequence of records `<length:u32><crc32:u32>` followed by payload;
+# payload is one write (one or more operations), each `<key_len:u32>
+# <flag:u8><value_len:u32>` followed by key and value bytes, so a record
+# is replayed completely or not at all. Table's part of a batch spanning
+# tables starts with a batch operation, batch id as key; it is replayed
+# only if manifest has commit of that batch
+#
+WAL_RECORD = struct.Struct('<II')
+WAL_OP = struct.Struct('<IBI')
+WAL_FLAG_BATCH = 2
+
+WAL_SYNC_ALWAYS = 'always' # fsync every write group
+WAL_SYNC_GROUP = 'group' # fsync every wal_group_ms or wal_group_bytes
+WAL_SYNC_NONE = 'none' # leave it to OS
+
+FLUSH_RETRY_SECONDS = 1.0 # pause of flush thread between two failed flushes
+
+fsync = getattr(os, 'fdatasync', os.fsync)
+
+
+def encode_ops(ops, codec):
+    data = []
+
+    for key, value in ops:
+        if value is TOMBSTONE:
+            data.append(WAL_OP.pack(len(key), RECORD_FLAG_DELETE, 0))
+            data.append(key)
+        else:
+            value = codec.encode(value)
+            data.append(WAL_OP.pack(len(key), RECORD_FLAG_SET, len(value)))
+            data.append(key)
+            data.append(value)
+
+    return b''.join(data)
+
+
+def encode_batch_op(batch_id):
+    key = batch_id.encode()
+    return WAL_OP.pack(len(key), WAL_FLAG_BATCH, 0) + key
+
+
+def decode_batch_id(data):
+    # batch id of record, None if it is not part of a batch
+    if len(data) < WAL_OP.size:
+        return None
+
+    key_len, flag, value_len = WAL_OP.unpack_from(data, 0)
+
+    if flag != WAL_FLAG_BATCH:
+        return None
+
+    return bytes(data[WAL_OP.size:WAL_OP.size + key_len]).decode()
+
+
+def decode_ops(data, codec):
+    ops = []
+    pos = 0
+
+    while pos < len(data):
+        key_len, flag, value_len = WAL_OP.unpack_from(data, pos)
+        pos += WAL_OP.size
+        key = bytes(data[pos:pos + key_len])
+        pos += key_len
+
+        if flag == WAL_FLAG_BATCH:
+            continue
+        elif flag == RECORD_FLAG_DELETE:
+            value = TOMBSTONE
+        else:
+            value = codec.decode(data[pos:pos + value_len])
+
+        pos += value_len
+        ops.append((key, value))
+
+    return ops
+
+
+class WriteAheadLog(object):
+    def __init__(self, path, sync=WAL_SYNC_GROUP, group_bytes=1 << 20):
+        if sync not in (WAL_SYNC_ALWAYS, WAL_SYNC_GROUP, WAL_SYNC_NONE):
+            raise ValueError('invalid wal sync policy: {}'.format(repr(sync)))
+
+        self.path = path
+        self.sync_policy = sync
+        self.group_bytes = group_bytes
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.unsynced = 0
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return '<{} path:{} sync:{}>'.format(
+            self.__class__.__name__,
+            self.path,
+            self.sync_policy,
+        )
+
+    def write(self, payloads):
+        # all payloads go out in one write() and at most one fsync
+        if not payloads:
+            return
+
+        data = []
+
+        for payload in payloads:
+            data.append(WAL_RECORD.pack(len(payload), zlib.crc32(payload)))
+            data.append(payload)
+
+        data = b''.join(data)
+
+        with self.lock:
+            os.write(self.fd, data)
+            self.unsynced += len(data)
+
+            if self.sync_policy == WAL_SYNC_ALWAYS:
+                self._sync()
+            elif self.sync_policy == WAL_SYNC_GROUP and self.unsynced >= self.group_bytes:
+                self._sync()
+
+    def sync(self):
+        with self.lock:
+            if self.fd is not None and self.unsynced:
+                self._sync()
+
+    def _sync(self):
+        fsync(self.fd)
+        self.unsynced = 0
+
+    def close(self):
+        with self.lock:
+            if self.fd is None:
+                return
+
+            if self.unsynced and self.sync_policy != WAL_SYNC_NONE:
+                self._sync()
+
+            os.close(self.fd)
+            self.fd = None
+
+    def remove(self):
+        self.close()
+        os.remove(self.path)
+
+    @staticmethod
+    def read_records(path):
+        # yields payload of every record; stops at torn or corrupted tail
+        # left by a crash
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        pos = 0
+
+        while pos + WAL_RECORD.size <= len(data):
+            length, crc = WAL_RECORD.unpack_from(data, pos)
+            pos += WAL_RECORD.size
+            payload = data[pos:pos + length]
+
+            if len(payload) != length or zlib.crc32(payload) != crc:
+                warnings.warn('wal truncated at offset {}: {}'.format(pos, repr(path)))
+                break
+
+            pos += length
+            yield payload
+
+    @staticmethod
+    def replay(path, codec):
+        # yields batch id and list of (key, value) per record
+        for payload in WriteAheadLog.read_records(path):
+            yield decode_batch_id(payload), decode_ops(payload, codec)
+
+
+#
+# manifest
+#
+# one per datastore, `MANIFEST`: log of version edits framed as wal
+# records, every edit a JSON object
+#   {"table": name, "add": [file, ...], "remove": [file no, ...],
+#    "add_wal": [wal no, ...], "remove_wal": [wal no, ...],
+#    "batches": [[wal no, [batch id, ...]], ...], "file_no_limit": n}
+# or commit of a batch spanning tables, logged in their wals before
+#   {"batch": batch id, "wals": [[table name, wal no], ...]}
+# file: {"no", "level", "seq", "size", "records", "min_key", "max_key"},
+# keys hex encoded. Live files and logs of every table are the replay of
+# all edits; a file is added only once complete, so half-written files
+# are never opened. File numbers below file_no_limit may be taken and are
+# never reused. Log is rewritten as one edit per table when opened and
+# whenever it grows past MANIFEST_MAX_BYTES.
+#
+MANIFEST_MAX_BYTES = 1 << 20
+MANIFEST_FILE_NO_LEASE = 1000
+
+
+class Manifest(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.tables = {}
+        self.log = None
+        self.size = 0
+
+        if os.path.exists(path):
+            for payload in WriteAheadLog.read_records(path):
+                self._apply(json.loads(payload.decode()))
+
+        self._rewrite()
+
+    def __repr__(self):
+        return '<{} path:{} tables:{}>'.format(
+            self.__class__.__name__,
+            repr(self.path),
+            len(self.tables),
+        )
+
+    def table(self, name):
+        # {'files': {no: file}, 'wals': set of wal nos, 'batches': {wal no:
+        # set of committed batch ids}, 'file_no_limit': n} or None for
+        # table never opened
+        with self.lock:
+            return self.tables.get(name)
+
+    def write(self, edit):
+        # durable once this returns
+        payload = json.dumps(edit).encode()
+
+        with self.lock:
+            self._apply(edit)
+            self.log.write([payload])
+            self.size += WAL_RECORD.size + len(payload)
+
+            if self.size > MANIFEST_MAX_BYTES:
+                self._rewrite()
+
+    def _state(self, name):
+        return self.tables.setdefault(name, {
+            'files': {},
+            'wals': set(),
+            'batches': {},
+            'file_no_limit': 0,
+        })
+
+    def _apply(self, edit):
+        if 'batch' in edit:
+            for name, wal_no in edit['wals']:
+                self._state(name)['batches'].setdefault(wal_no, set()).add(edit['batch'])
+
+            return
+
+        state = self._state(edit['table'])
+
+        for f in edit.get('add', []):
+            state['files'][f['no']] = f
+
+        for no in edit.get('remove', []):
+            state['files'].pop(no, None)
+
+        for wal_no, batch_ids in edit.get('batches', []):
+            state['batches'].setdefault(wal_no, set()).update(batch_ids)
+
+        state['wals'].update(edit.get('add_wal', []))
+        state['wals'].difference_update(edit.get('remove_wal', []))
+
+        # commits are needed only while their wal is replayed
+        for wal_no in edit.get('remove_wal', []):
+            state['batches'].pop(wal_no, None)
+
+        state['file_no_limit'] = max(state['file_no_limit'], edit.get('file_no_limit', 0))
+
+    def _rewrite(self):
+        # current state as one edit per table, swapped in atomically
+        tmp_path = '{}.tmp'.format(self.path)
+
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+        payloads = [
+            json.dumps({
+                'table': name,
+                'add': sorted(state['files'].values(), key=lambda f: f['no']),
+                'add_wal': sorted(state['wals']),
+                'batches': [
+                    [wal_no, sorted(batch_ids)]
+                    for wal_no, batch_ids in sorted(state['batches'].items())
+                ],
+                'file_no_limit': state['file_no_limit'],
+            }).encode()
+            for name, state in self.tables.items()
+        ]
+
+        log = WriteAheadLog(tmp_path, sync=WAL_SYNC_ALWAYS)
+        log.write(payloads)
+        log.close()
+        os.replace(tmp_path, self.path)
+
+        if self.log is not None:
+            self.log.close()
+
+        self.log = WriteAheadLog(self.path, sync=WAL_SYNC_ALWAYS)
+        self.size = sum(WAL_RECORD.size + len(payload) for payload in payloads)
+
+    def close(self):
+        with self.lock:
+            self.log.close()
+
+
+#
+# compaction
+#
+class RateLimiter(object):
+    # token bucket, callers sleep once they run ahead of bytes_per_sec
+    def __init__(self, bytes_per_sec):
+        self.bytes_per_sec = bytes_per_sec
+        self.allowance = bytes_per_sec
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def request(self, n):
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(
+                self.allowance + (now - self.last) * self.bytes_per_sec,
+                self.bytes_per_sec,
+            )
+
+            self.last = now
+            self.allowance -= n
+            delay = -self.allowance / self.bytes_per_sec
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+class CompactionTask(object):
+    def __init__(self, inputs, level, drop_tombstones, target_file_bytes=None):
+        self.inputs = inputs # newest first
+        self.level = level
+        self.drop_tombstones = drop_tombstones
+        self.target_file_bytes = target_file_bytes
+        self.seq = max(f.seq for f in inputs)
+
+    def __repr__(self):
+        return '<{} inputs:{} level:{}>'.format(
+            self.__class__.__name__,
+            len(self.inputs),
+            self.level,
+        )
+
+
+class CompactionStrategy(object):
+    def pick(self, file_tables):
+        # file_tables is sorted as Table.file_tables, returns
+        # CompactionTask or None
+        raise NotImplementedError
+
+    def pick_full(self, file_tables):
+        # everything into one sorted run at the deepest level in use
+        if len(file_tables) < 2:
+            return None
+
+        level = max(f.level for f in file_tables)
+        return CompactionTask(list(file_tables), level, drop_tombstones=True)
+
+
+class SizeTieredCompaction(CompactionStrategy):
+    # merges runs of similarly sized files; only runs adjacent in age are
+    # merged, so output can take their place in read order
+    def __init__(self, min_threshold=4, max_threshold=32, bucket_low=0.5, bucket_high=1.5):
+        self.min_threshold = min_threshold
+        self.max_threshold = max_threshold
+        self.bucket_low = bucket_low
+        self.bucket_high = bucket_high
+
+    def pick(self, file_tables):
+        i = 0
+
+        while i < len(file_tables):
+            run = [file_tables[i]]
+            total = file_tables[i].size
+
+            for f in file_tables[i + 1:i + self.max_threshold]:
+                avg = total / len(run)
+
+                if not self.bucket_low * avg <= f.size <= self.bucket_high * avg:
+                    break
+
+                run.append(f)
+                total += f.size
+
+            if len(run) >= self.min_threshold:
+                # tombstones can go only if nothing older is left behind
+                drop_tombstones = run[-1] is file_tables[-1]
+                return CompactionTask(run, 0, drop_tombstones)
+
+            i += 1
+
+        return None
+
+
+class LeveledCompaction(CompactionStrategy):
+    # level 0 holds flushed, overlapping files; every deeper level is one
+    # sorted run of non-overlapping files, level_multiplier times larger
+    # than the one above
+    def __init__(self, l0_trigger=4, level_base_bytes=10 << 20, level_multiplier=10,
+                 target_file_bytes=2 << 20):
+        self.l0_trigger = l0_trigger
+        self.level_base_bytes = level_base_bytes
+        self.level_multiplier = level_multiplier
+        self.target_file_bytes = target_file_bytes
+        self.next_compaction_key = {}
+
+    def pick(self, file_tables):
+        levels = {}
+
+        for f in file_tables:
+            levels.setdefault(f.level, []).append(f)
+
+        if len(levels.get(0, [])) >= self.l0_trigger:
+            return self._task(file_tables, levels, levels[0], 0)
+
+        for level in sorted(levels):
+            if level == 0:
+                continue
+
+            max_bytes = self.level_base_bytes * self.level_multiplier ** (level - 1)
+
+            if sum(f.size for f in levels[level]) <= max_bytes:
+                continue
+
+            # round robin over key space of level
+            files = levels[level]
+            key = self.next_compaction_key.get(level)
+            f = files[0]
+
+            if key is not None:
+                for g in files:
+                    if g.min_key > key:
+                        f = g
+                        break
+
+            self.next_compaction_key[level] = f.max_key
+            return self._task(file_tables, levels, [f], level)
+
+        return None
+
+    def _task(self, file_tables, levels, inputs, level):
+        min_key = min(f.min_key for f in inputs)
+        max_key = max(f.max_key for f in inputs)
+
+        inputs = inputs + [
+            f for f in levels.get(level + 1, [])
+            if f.overlaps(min_key, max_key)
+        ]
+
+        min_key = min(f.min_key for f in inputs)
+        max_key = max(f.max_key for f in inputs)
+
+        # tombstones can go when no deeper level holds the key range
+        drop_tombstones = not any(
+            f.level > level + 1 and f.overlaps(min_key, max_key)
+            for f in file_tables
+        )
+
+        return CompactionTask(inputs, level + 1, drop_tombstones, self.target_file_bytes)
+
+
+COMPACTION_STRATEGIES = {
+    'size-tiered': SizeTieredCompaction,
+    'leveled': LeveledCompaction,
+}
+
+
+#
+# table
+#
+class TableMeta(object):
+    def __init__(self, table, fields=None):
+        self.table = table
+        self.fields = fields
+        
+        self.path = os.path.join(
+            self.table.ds.dirpath,
+            '{}.meta'.format(self.table.name),
+        )
+
+        # schema versions: version -> [[field name, field type], ...];
+        # records carry their version, so fields may change over time
+        self.version = None
+        self.versions = {}
+        meta = None
+
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                meta = json.load(f)
+
+            self.version = meta.get('version', 1)
+
+            if 'versions' in meta:
+                self.versions = {
+                    int(k): [tuple(field) for field in v]
+                    for k, v in meta['versions'].items()
+                }
+            else:
+                self.versions = {1: self._schema(meta.get('fields', {}))}
+
+        if self.fields:
+            for k, v in self.fields.items():
+                if v.name is None:
+                    v.name = k
+
+            fields = json.loads(json.dumps({
+                k: v.__getstate__()
+                for k, v in self.fields.items()
+            }))
+
+            schema = self._schema(fields)
+
+            if meta is None:
+                self.version = 1
+                self.versions = {1: schema}
+                self._save(fields)
+            elif self.versions[self.version] != schema:
+                self.version = max(self.versions) + 1
+                self.versions[self.version] = schema
+                self._save(fields)
+            elif meta.get('fields') != fields or 'versions' not in meta:
+                self._save(fields)
+        elif meta is not None:
+            self.fields = meta.get('fields', None)
+
+        # declared fields are objects, loaded ones are their state dicts
+        self.primary_key = []
+        self.indexes = {}
+        self.columns = [] # document columns, zone maps are kept for
+
+        for k, v in (self.fields or {}).items():
+            if not isinstance(v, dict):
+                v = v.__getstate__()
+
+            if v['type'] == 'index':
+                self.indexes[k] = tuple(v['columns'])
+            elif v.get('primary_key'):
+                self.primary_key.append(k)
+            else:
+                self.columns.append(k)
+
+        self.codec = RecordCodec(self.versions, self.version)
+
+    def __getstate__(self):
+        # schema only, for worker processes; table and declared field
+        # objects stay here
+        state = dict(self.__dict__)
+        state['table'] = None
+        state['fields'] = None
+        return state
+
+    @staticmethod
+    def _schema(fields):
+        return [
+            (k, v['type'])
+            for k, v in fields.items()
+            if v['type'] != 'index'
+        ]
+
+    def _save(self, fields):
+        meta = {
+            'name': self.table.name,
+            'fields': fields,
+            'version': self.version,
+            'versions': {
+                str(k): [list(field) for field in v]
+                for k, v in self.versions.items()
+            },
+        }
+
+        tmp_path = '{}.tmp'.format(self.path)
+
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f, indent=4)
+
+        os.replace(tmp_path, self.path)
+
+
+def index_entry(columns, key, doc):
+    # sorted index item: encoded column values followed by encoded
+    # primary key; None if doc is deleted or leading column is missing,
+    # other missing columns are stored as None, so every row a query on
+    # leading column can match is in index
+    if not isinstance(doc, dict):
+        return None
+
+    value = doc.get(columns[0])
+
+    if value is None:
+        return None
+
+    try:
+        parts = [encode_key((value,))]
+    except (TypeError, OverflowError):
+        return None
+
+    for column in columns[1:]:
+        try:
+            parts.append(encode_key((doc.get(column),)))
+        except (TypeError, OverflowError):
+            parts.append(encode_key((None,)))
+
+    return b''.join(parts) + key
+
+
+class MemIndex(object):
+    def __init__(self, mem_table, columns):
+        self.mem_table = mem_table
+        self.columns = columns
+        self.items = SortedList()
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, key, doc):
+        entry = index_entry(self.columns, key, doc)
+
+        if entry is not None:
+            self.items.add(entry)
+
+    def remove(self, key, doc):
+        entry = index_entry(self.columns, key, doc)
+
+        if entry is not None:
+            self.items.remove(entry)
+
+    def iter_range(self, start=None, end=None, reverse=False):
+        return self.items.irange_batched(start, end, reverse, lock=self.mem_table.read_lock())
+
+
+class SortedList(object):
+    # chunked sorted list: O(log n) bisect over chunk maxes, and inserts
+    # only shift elements inside one bounded chunk
+    def __init__(self, load=512):
+        self.load = load
+        self.lists = []
+        self.maxes = []
+        self.len = 0
+
+    def __len__(self):
+        return self.len
+
+    def __iter__(self):
+        for lst in self.lists:
+            for value in lst:
+                yield value
+
+    def __contains__(self, value):
+        pos = bisect_left(self.maxes, value)
+
+        if pos == len(self.maxes):
+            return False
+
+        lst = self.lists[pos]
+        i = bisect_left(lst, value)
+        return lst[i] == value
+
+    def add(self, value):
+        maxes = self.maxes
+        lists = self.lists
+
+        if not maxes:
+            lists.append([value])
+            maxes.append(value)
+        else:
+            pos = bisect_right(maxes, value)
+
+            if pos == len(maxes):
+                pos -= 1
+                lists[pos].append(value)
+                maxes[pos] = value
+            else:
+                insort(lists[pos], value)
+
+            # split chunk
+            lst = lists[pos]
+
+            if len(lst) > self.load * 2:
+                half = lst[self.load:]
+                del lst[self.load:]
+                maxes[pos] = lst[-1]
+                lists.insert(pos + 1, half)
+                maxes.insert(pos + 1, half[-1])
+
+        self.len += 1
+
+    def remove(self, value):
+        maxes = self.maxes
+        pos = bisect_left(maxes, value)
+
+        if pos == len(maxes):
+            raise ValueError('{} not in list'.format(repr(value)))
+
+        lst = self.lists[pos]
+        i = bisect_left(lst, value)
+
+        if lst[i] != value:
+            raise ValueError('{} not in list'.format(repr(value)))
+
+        del lst[i]
+        self.len -= 1
+
+        if lst:
+            maxes[pos] = lst[-1]
+        else:
+            del self.lists[pos]
+            del maxes[pos]
+
+    def irange_batched(self, start=None, end=None, reverse=False, batch_size=256, lock=None):
+        # same as irange, but values are copied out in batches, so list
+        # can be modified between two steps of iteration; with lock held
+        # by writers, every batch is copied under it and list can be
+        # modified by other threads too
+        resumed = False
+
+        while True:
+            if lock is None:
+                values = list(itertools.islice(
+                    self.irange(start, end, reverse=reverse),
+                    batch_size + 1,
+                ))
+            else:
+                with lock:
+                    values = list(itertools.islice(
+                        self.irange(start, end, reverse=reverse),
+                        batch_size + 1,
+                    ))
+
+            # resumed forward iteration starts after last value seen
+            if resumed and not reverse and values and values[0] == start:
+                values = values[1:]
+
+            values = values[:batch_size]
+
+            if not values:
+                return
+
+            for value in values:
+                yield value
+
+            resumed = True
+
+            if reverse:
+                end = values[-1]
+            else:
+                start = values[-1]
+
+    def irange(self, start=None, end=None, reverse=False):
+        # values in [start, end), None means unbounded
+        lists = self.lists
+        maxes = self.maxes
+
+        if not maxes:
+            return
+
+        if start is None:
+            pos0, i0 = 0, 0
+        else:
+            pos0 = bisect_left(maxes, start)
+
+            if pos0 == len(maxes):
+                return
+
+            i0 = bisect_left(lists[pos0], start)
+
+        if end is None:
+            pos1 = len(maxes) - 1
+            i1 = len(lists[pos1])
+        else:
+            pos1 = bisect_left(maxes, end)
+
+            if pos1 == len(maxes):
+                pos1 -= 1
+                i1 = len(lists[pos1])
+            else:
+                i1 = bisect_left(lists[pos1], end)
+
+        if (pos0, i0) >= (pos1, i1):
+            return
+
+        if reverse:
+            for pos in range(pos1, pos0 - 1, -1):
+                lst = lists[pos]
+                lo = i0 if pos == pos0 else 0
+                hi = i1 if pos == pos1 else len(lst)
+
+                for i in range(hi - 1, lo - 1, -1):
+                    yield lst[i]
+        else:
+            for pos in range(pos0, pos1 + 1):
+                lst = lists[pos]
+                lo = i0 if pos == pos0 else 0
+                hi = i1 if pos == pos1 else len(lst)
+
+                for i in range(lo, hi):
+                    yield lst[i]
+
+
+class Tombstone(object):
+    def __repr__(self):
+        return '<Tombstone>'
+
+    def __reduce__(self):
+        # unpickled in worker process as the same singleton
+        return 'TOMBSTONE'
+
+
+TOMBSTONE = Tombstone()
+
+
+class MemTable(object):
+    def __init__(self, table, cap=1000, on_full=None, wal=None):
+        self.table = table
+        self.cap = cap
+        self.keys = SortedList()
+        self.items = {}
+        self.seqs = {} # sequence number of every key's newest version
+        self.history = {} # older versions still seen by snapshots, newest first
+        self.on_full_callback = on_full
+        self.frozen = False
+        self.wal = wal
+        self.indexes = {}
+
+        # held by writer while it applies writes, and by readers while
+        # they copy a batch of sorted keys; dict lookups need no lock
+        self.lock = threading.RLock()
+
+    def __repr__(self):
+        return '<{} table:{} len:{} cap:{}>'.format(
+            self.__class__.__name__,
+            self.table,
+            len(self.items),
+            self.cap,
+        )
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, key, value, seq=0):
+        # set without capacity check
+        if self.frozen:
+            raise ValueError('memtable is frozen: {}'.format(self))
+
+        old = self.items.get(key)
+
+        # overwritten version is kept while a snapshot taken after it
+        # was written is alive
+        if old is not None and self.table is not None:
+            snapshots = self.table.ds.snapshots
+
+            if snapshots and snapshots[-1].seq >= self.seqs[key]:
+                self.history.setdefault(key, []).insert(0, (self.seqs[key], old))
+                old = None
+
+        if self.table is not None and self.table.meta.indexes:
+            history = self.history.get(key, ())
+
+            for name, columns in self.table.meta.indexes.items():
+                mem_index = self.get_index(name, columns)
+
+                # entries of kept versions stay for snapshot reads
+                if old is not None and all(
+                    index_entry(columns, key, h) != index_entry(columns, key, old)
+                    for s, h in history
+                ):
+                    mem_index.remove(key, old)
+
+                mem_index.add(key, value)
+
+        # lock-free readers see a key only once its value is there, and
+        # a value only once its seq is
+        new = key not in self.items
+        self.seqs[key] = seq
+        self.items[key] = value
+
+        if new:
+            self.keys.add(key)
+
+    def is_full(self):
+        return len(self.items) >= self.cap
+
+    def set(self, key, value):
+        with self.lock:
+            self.put(key, value)
+
+        if len(self.items) >= self.cap:
+            if self.on_full_callback:
+                self.on_full_callback(table=self.table, mem_table=self)
+            else:
+                warnings.warn('max capacity reached for memtable: {}'.format(self))
+
+    def get(self, key, seq=None):
+        # returns TOMBSTONE for deleted keys, raises KeyError for unknown keys;
+        # seq reads version as of that sequence number
+        value = self.items[key]
+
+        if seq is not None and self.seqs[key] > seq:
+            for s, value in self.history.get(key, ()):
+                if s <= seq:
+                    return value
+
+            raise KeyError(key)
+
+        return value
+
+    def delete(self, key):
+        # keep tombstone so deletes shadow older values in file tables
+        self.set(key, TOMBSTONE)
+
+    def iter_range(self, start=None, end=None, reverse=False, seq=None):
+        # sorted (key, value) pairs in [start, end), including tombstones;
+        # memtable can be written to between two steps of iteration, with
+        # seq versions written after it are not seen
+        items = self.items
+
+        for key in self.keys.irange_batched(start, end, reverse, lock=self.read_lock()):
+            if seq is None:
+                yield key, items[key]
+                continue
+
+            try:
+                yield key, self.get(key, seq)
+            except KeyError:
+                pass
+
+    def get_index(self, name, columns):
+        # index is created on first use and filled from items already here
+        mem_index = self.indexes.get(name)
+
+        if mem_index is None:
+            with self.lock:
+                mem_index = self.indexes.get(name)
+
+                if mem_index is None:
+                    mem_index = MemIndex(self, columns)
+
+                    for key, value in self.items.items():
+                        mem_index.add(key, value)
+
+                    self.indexes[name] = mem_index
+
+        return mem_index
+
+    def read_lock(self):
+        # frozen memtable is read without locking
+        if self.frozen:
+            return None
+
+        return self.lock
+
+    def on_full(self, func):
+        self.on_full_callback = func
+
+    def freeze(self):
+        # immutable from now on, waiting to be flushed
+        self.frozen = True
+
+
+class BlockCache(object):
+    # LRU of decoded sstable blocks shared by every file of a datastore,
+    # keyed by (file id, block offset); capacity is in bytes of payload
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.size = 0
+        self.blocks = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __repr__(self):
+        return '<{} size:{} capacity:{} hits:{} misses:{} evictions:{}>'.format(
+            self.__class__.__name__,
+            self.size,
+            self.capacity,
+            self.hits,
+            self.misses,
+            self.evictions,
+        )
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def get(self, key):
+        # cached block or None
+        with self.lock:
+            entry = self.blocks.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.blocks.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, block, size):
+        if size > self.capacity:
+            return
+
+        with self.lock:
+            if key in self.blocks:
+                return
+
+            self.blocks[key] = (block, size)
+            self.size += size
+
+            while self.size > self.capacity:
+                key, (block, size) = self.blocks.popitem(last=False)
+                self.size -= size
+                self.evictions += 1
+
+    def discard_file(self, file_id):
+        # blocks of closed or removed file
+        with self.lock:
+            for key in [key for key in self.blocks if key[0] == file_id]:
+                block, size = self.blocks.pop(key)
+                self.size -= size
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'blocks': len(self.blocks),
+                'size': self.size,
+                'capacity': self.capacity,
+            }
+
+
+class RowCache(object):
+    # LRU of decoded documents of one table, keyed by encoded primary key;
+    # every write invalidates its key and bumps generation, a read fills
+    # cache only if no write happened since it started, so a value read
+    # from an older version of a row is never cached
+    MISS = object() # get of key not cached, None is a cacheable value
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.rows = OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __repr__(self):
+        return '<{} len:{} capacity:{} hits:{} misses:{} evictions:{}>'.format(
+            self.__class__.__name__,
+            len(self.rows),
+            self.capacity,
+            self.hits,
+            self.misses,
+            self.evictions,
+        )
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get(self, key):
+        # cached document or MISS
+        with self.lock:
+            value = self.rows.get(key, self.MISS)
+
+            if value is self.MISS:
+                self.misses += 1
+                return value
+
+            self.rows.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, generation):
+        with self.lock:
+            if generation != self.generation:
+                return
+
+            self.rows[key] = value
+            self.rows.move_to_end(key)
+
+            if len(self.rows) > self.capacity:
+                self.rows.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self.lock:
+            self.generation += 1
+            self.rows.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.rows.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'rows': len(self.rows),
+                'capacity': self.capacity,
+            }
+
+
+# unique per opened file, block cache keys never outlive a file
+SSTABLE_IDS = itertools.count()
+
+
+class SSTable(object):
+    # read-only, memory-mapped sstable file; blocks and records are
+    # memoryview slices of the mapping, so lookups do no read() calls
+    # and no copies until a key or value is decoded
+    def __init__(self, path, block_cache=None, key_range=None):
+        self.path = path
+        self.id = next(SSTABLE_IDS)
+        self.block_cache = block_cache
+        self.f = open(self.path, 'rb')
+        self.mmap = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buf = memoryview(self.mmap)
+
+        # footer
+        (
+            magic,
+            version,
+            self.level,
+            self.seq,
+            self.index_offset,
+            self.index_length,
+            self.block_count,
+            self.record_count,
+            stats_length,
+        ) = SSTABLE_FOOTER.unpack_from(self.buf, len(self.buf) - SSTABLE_FOOTER.size)
+
+        if magic != SSTABLE_MAGIC or version != SSTABLE_VERSION:
+            raise ValueError('invalid sstable file: {}'.format(repr(self.path)))
+
+        # sparse index: first key, offset and length of every data block
+        index = self.buf[self.index_offset:self.index_offset + self.index_length]
+        self.block_keys = []
+        self.block_offsets = []
+        self.block_lengths = []
+        pos = 0
+
+        while pos < len(index):
+            key_len, offset, length = SSTABLE_INDEX_ENTRY.unpack_from(index, pos)
+            pos += SSTABLE_INDEX_ENTRY.size
+            self.block_keys.append(bytes(index[pos:pos + key_len]))
+            self.block_offsets.append(offset)
+            self.block_lengths.append(length)
+            pos += key_len
+
+        # key range and zone maps
+        stats_offset = self.index_offset + self.index_length
+        stats = json.loads(bytes(self.buf[stats_offset:stats_offset + stats_length]).decode())
+
+        self.column_ranges = {
+            column: (bytes.fromhex(r[0]), bytes.fromhex(r[1]))
+            for column, r in stats['columns'].items()
+        }
+
+        if key_range is not None:
+            self.min_key, self.max_key = key_range
+        elif self.block_count:
+            self.min_key = self.block_keys[0]
+            self.max_key = bytes.fromhex(stats['max_key'])
+        else:
+            self.min_key = None
+            self.max_key = None
+
+    def __len__(self):
+        return self.record_count
+
+    def close(self):
+        if self.block_cache is not None:
+            self.block_cache.discard_file(self.id)
+
+        self.buf.release()
+
+        try:
+            self.mmap.close()
+        except BufferError:
+            # record slices still referenced, mapping goes away with them
+            pass
+
+        self.f.close()
+
+    def estimate_count(self, start=None, end=None):
+        # records in [start, end), from sparse index only
+        if not self.block_count:
+            return 0
+
+        if start is None:
+            i0 = 0
+        else:
+            i0 = max(bisect_right(self.block_keys, start) - 1, 0)
+
+        if end is None:
+            i1 = self.block_count
+        else:
+            i1 = bisect_left(self.block_keys, end)
+
+        return max(i1 - i0, 0) * self.record_count / self.block_count
+
+    def read_block(self, i):
+        # payload of data block i; slice of mapping unless compressed
+        offset = self.block_offsets[i]
+        return decompress_block(self.buf[offset:offset + self.block_lengths[i]])
+
+    def block_restarts(self, block):
+        # offsets of restart points and end of records
+        n = SSTABLE_RESTART.unpack_from(block, len(block) - SSTABLE_RESTART.size)[0]
+        end = len(block) - SSTABLE_RESTART.size * (n + 1)
+        restarts = struct.unpack_from('<{}I'.format(n), block, end)
+        return restarts, end
+
+    def load_block(self, i, fill_cache=True):
+        # (payload, restart offsets, end of records) of data block i;
+        # scans pass fill_cache=False so they do not evict hot blocks
+        cache = self.block_cache
+
+        if cache is not None:
+            cache_key = (self.id, self.block_offsets[i])
+            entry = cache.get(cache_key)
+
+            if entry is not None:
+                return entry
+
+        block = self.read_block(i)
+        restarts, end = self.block_restarts(block)
+        entry = (block, restarts, end)
+
+        if cache is not None and fill_cache:
+            cache.put(cache_key, entry, len(block))
+
+        return entry
+
+    def iter_block(self, i, fill_cache=True):
+        # (key, flag, value) records of data block i, values as memoryviews
+        block, restarts, end = self.load_block(i, fill_cache)
+        return self.iter_block_records(block, 0, end)
+
+    def iter_block_records(self, block, pos, end):
+        # pos has to be a restart point
+        key = b''
+
+        while pos < end:
+            shared, unshared, flag, value_len = SSTABLE_RECORD.unpack_from(block, pos)
+            pos += SSTABLE_RECORD.size
+            key = key[:shared] + bytes(block[pos:pos + unshared])
+            pos += unshared
+            value = block[pos:pos + value_len]
+            pos += value_len
+            yield key, flag, value
+
+    def restart_key(self, block, pos):
+        shared, unshared, flag, value_len = SSTABLE_RECORD.unpack_from(block, pos)
+        pos += SSTABLE_RECORD.size
+        return bytes(block[pos:pos + unshared])
+
+    def seek_restart(self, block, restarts, key):
+        # offset of last restart point not after key
+        lo = 0
+        hi = len(restarts)
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+
+            if self.restart_key(block, restarts[mid]) <= key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return restarts[max(lo - 1, 0)]
+
+    def get_record(self, key):
+        # (flag, value) of key, raises KeyError for unknown keys; binary
+        # search over restart points, then at most one interval is scanned
+        i = bisect_right(self.block_keys, key) - 1
+
+        if i < 0:
+            raise KeyError(key)
+
+        block, restarts, end = self.load_block(i)
+        pos = self.seek_restart(block, restarts, key)
+
+        for k, flag, value in self.iter_block_records(block, pos, end):
+            if k == key:
+                return flag, value
+
+            if k > key:
+                break
+
+        raise KeyError(key)
+
+    def get_records(self, keys):
+        # (key, flag, value) of found keys out of sorted keys; every block
+        # holding some of them is loaded once and walked once
+        block_keys = self.block_keys
+        n = len(keys)
+        i = 0
+
+        while i < n:
+            b = bisect_right(block_keys, keys[i]) - 1
+
+            if b < 0:
+                i += 1
+                continue
+
+            # keys[i:j] can only be in block b
+            j = i + 1
+
+            if b + 1 < self.block_count:
+                j = bisect_left(keys, block_keys[b + 1], j)
+            else:
+                j = n
+
+            block, restarts, end = self.load_block(b)
+            pos = self.seek_restart(block, restarts, keys[i])
+
+            for k, flag, value in self.iter_block_records(block, pos, end):
+                while i < j and keys[i] < k:
+                    i += 1
+
+                if i == j:
+                    break
+
+                if keys[i] == k:
+                    yield k, flag, value
+                    i += 1
+
+            i = j
+
+    def iter_records(self, start=None, end=None, reverse=False):
+        # sorted (key, flag, value) records in [start, end);
+        # only blocks overlapping the range are read
+        if start is None:
+            i0 = 0
+        else:
+            i0 = max(bisect_right(self.block_keys, start) - 1, 0)
+
+        if end is None:
+            i1 = self.block_count
+        else:
+            i1 = bisect_left(self.block_keys, end)
+
+        blocks = range(i0, i1)
+
+        if reverse:
+            blocks = reversed(blocks)
+
+        for i in blocks:
+            records = []
+
+            for k, flag, value in self.iter_block(i, fill_cache=False):
+                if start is not None and k < start:
+                    continue
+
+                if end is not None and k >= end:
+                    break
+
+                records.append((k, flag, value))
+
+            if reverse:
+                records.reverse()
+
+            for record in records:
+                yield record
+
+
+class FileIndex(SSTable):
+    def __init__(self, file_table, columns, path):
+        SSTable.__init__(self, path, file_table.block_cache)
+        self.file_table = file_table
+        self.columns = columns
+
+    def __repr__(self):
+        return '<{} table:{} columns:{} path:{}>'.format(
+            self.__class__.__name__,
+            self.file_table.table,
+            self.columns,
+            self.path,
+        )
+
+    @staticmethod
+    def write(path, entries, compression=None):
+        # entries are sorted index items
+        writer = SSTableWriter(path, compression=compression)
+
+        try:
+            for entry in entries:
+                writer.add(entry, RECORD_FLAG_SET, b'')
+        except:
+            writer.abort()
+            raise
+
+        writer.finish()
+
+    def iter_range(self, start=None, end=None, reverse=False):
+        for entry, flag, value in self.iter_records(start, end, reverse):
+            yield entry
+
+
+class FileTable(SSTable):
+    def __init__(self, table, path, key_range=None):
+        SSTable.__init__(self, path, table.ds.block_cache, key_range)
+        self.table = table
+        self.no = table._parse_file_name(os.path.basename(path), '.data')
+        self.size = len(self.buf)
+
+        # bloom filter is optional, without it every lookup probes the file
+        bloom_path = self.bloom_path(path)
+
+        if os.path.exists(bloom_path):
+            self.bloom = BloomFilter.load(bloom_path)
+        else:
+            self.bloom = None
+
+        # secondary indexes, opened on first use
+        self.indexes = {}
+        self.indexes_lock = threading.Lock()
+
+    def __repr__(self):
+        return '<{} table:{} path:{}>'.format(
+            self.__class__.__name__,
+            self.table,
+            self.path,
+        )
+
+    @staticmethod
+    def bloom_path(path):
+        return '{}.bloom'.format(os.path.splitext(path)[0])
+
+    @staticmethod
+    def index_path(path, name):
+        return '{}.{}.index'.format(os.path.splitext(path)[0], name)
+
+    @staticmethod
+    def write_indexes(path, indexes, compression=None):
+        # indexes: name -> sorted index items; written before data file,
+        # which is the commit point
+        for name, entries in indexes.items():
+            FileIndex.write(FileTable.index_path(path, name), entries, compression)
+
+    def get_index(self, name, columns):
+        # files flushed before index was declared get it built here
+        with self.indexes_lock:
+            file_index = self.indexes.get(name)
+
+            if file_index is None:
+                path = self.index_path(self.path, name)
+
+                if not os.path.exists(path):
+                    entries = []
+
+                    for key, value in self.iter_range():
+                        entry = index_entry(columns, key, value)
+
+                        if entry is not None:
+                            entries.append(entry)
+
+                    entries.sort()
+                    FileIndex.write(path, entries, self.table.compression)
+
+                file_index = FileIndex(self, columns, path)
+                self.indexes[name] = file_index
+
+        return file_index
+
+    def __lt__(self, other):
+        # sort order of Table.file_tables: level 0 newest first, then
+        # deeper levels by key range
+        if self.level != other.level:
+            return self.level < other.level
+
+        if self.level == 0:
+            return self.seq > other.seq
+
+        return self.min_key < other.min_key
+
+    def may_contain_hash(self, h):
+        return self.bloom is None or self.bloom.may_contain_hash(h)
+
+    def may_contain(self, key, h):
+        # key range first, it is cheaper than bloom filter
+        if self.min_key is None or not self.min_key <= key <= self.max_key:
+            return False
+
+        return self.may_contain_hash(h)
+
+    def overlaps_range(self, start=None, end=None):
+        # any key in [start, end)
+        if self.min_key is None:
+            return False
+
+        return (end is None or self.min_key < end) and (start is None or start <= self.max_key)
+
+    def may_match(self, column, op, value):
+        # False if zone map rules out any row with column op value;
+        # values of other type than zone map can not be ruled out
+        r = self.column_ranges.get(column)
+
+        if r is None:
+            return True
+
+        try:
+            v = encode_key((value,))
+        except (TypeError, OverflowError):
+            return True
+
+        lo, hi = r
+
+        if v[0] != lo[0]:
+            return True
+
+        if op == '==':
+            return lo <= v <= hi
+        elif op == '<':
+            return lo < v
+        elif op == '<=':
+            return lo <= v
+        elif op == '>':
+            return hi > v
+        elif op == '>=':
+            return hi >= v
+
+        return True
+
+    def manifest_entry(self):
+        return {
+            'no': self.no,
+            'level': self.level,
+            'seq': self.seq,
+            'size': self.size,
+            'records': self.record_count,
+            'min_key': self.min_key.hex(),
+            'max_key': self.max_key.hex(),
+        }
+
+    def overlaps(self, min_key, max_key):
+        return self.min_key <= max_key and min_key <= self.max_key
+
+    def remove(self):
+        # mapping is not closed here, readers still holding this file
+        # table keep working, it is released with the last reference;
+        # index files are opened first for the same reason, missing ones
+        # are not built just to be removed
+        paths = [self.path, self.bloom_path(self.path)]
+
+        if self.table is not None:
+            for name, columns in self.table.meta.indexes.items():
+                path = self.index_path(self.path, name)
+
+                if os.path.exists(path):
+                    self.get_index(name, columns)
+                    paths.append(path)
+
+        if self.block_cache is not None:
+            self.block_cache.discard_file(self.id)
+
+            for file_index in self.indexes.values():
+                self.block_cache.discard_file(file_index.id)
+
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def get(self, key):
+        # returns TOMBSTONE for deleted keys, raises KeyError for unknown keys
+        flag, value = self.get_record(key)
+
+        if flag == RECORD_FLAG_DELETE:
+            return TOMBSTONE
+
+        return self.table.meta.codec.decode(value)
+
+    def iter_range(self, start=None, end=None, reverse=False):
+        # sorted (key, value) pairs in [start, end), including tombstones
+        codec = self.table.meta.codec
+
+        for k, flag, value in self.iter_records(start, end, reverse):
+            if flag == RECORD_FLAG_DELETE:
+                yield k, TOMBSTONE
+            else:
+                yield k, codec.decode(value)
+
+
+class PendingWrite(object):
+    # exclusive write is never taken into another leader's group
+    def __init__(self, ops, rotate=False, record=None, exclusive=False):
+        self.ops = ops
+        self.rotate = rotate
+        self.record = record # encoded log record, if already known
+        self.exclusive = exclusive
+        self.done = False
+        self.error = None
+
+
+class ExternalSorter(object):
+    # sorts (key, value) byte pairs in bounded memory: every run_bytes of
+    # input is sorted and spilled into a temporary sstable, runs are merged
+    # when read; of equal keys the one added last wins
+    def __init__(self, new_path, run_bytes=64 << 20):
+        self.new_path = new_path
+        self.run_bytes = run_bytes
+        self.run = []
+        self.run_len = 0
+        self.runs = []
+        self.count = 0 # unique keys, known after finish
+        self.size = 0
+        self.min_key = None
+        self.max_key = None
+
+    def add(self, key, value):
+        self.run.append((key, value))
+        self.run_len += len(key) + len(value) + 64
+
+        if self.run_len >= self.run_bytes:
+            self._spill()
+
+    def _sorted_run(self):
+        # stable sort keeps later duplicates behind earlier ones
+        run = self.run
+        run.sort(key=first_item)
+
+        for i, (key, value) in enumerate(run):
+            if i + 1 < len(run) and run[i + 1][0] == key:
+                continue
+
+            yield key, value
+
+    def _spill(self):
+        writer = SSTableWriter(self.new_path())
+
+        try:
+            for key, value in self._sorted_run():
+                writer.add(key, RECORD_FLAG_SET, value)
+        except:
+            writer.abort()
+            raise
+
+        writer.finish()
+        self.runs.append(SSTable(writer.path))
+        self.run = []
+        self.run_len = 0
+
+    def finish(self):
+        # no more input; one pass over data counts keys and finds range
+        if self.runs and self.run:
+            self._spill()
+
+        if not self.runs:
+            self.run = list(self._sorted_run())
+
+        for key, value in self:
+            if self.min_key is None:
+                self.min_key = key
+
+            self.max_key = key
+            self.count += 1
+            self.size += len(key) + len(value)
+
+    def __iter__(self):
+        if not self.runs:
+            return iter(self.run)
+
+        # later runs rank first among equal keys
+        iters = [self._ranked_run(run, -i) for i, run in enumerate(self.runs)]
+        return self._merge(iters)
+
+    def _ranked_run(self, run, rank):
+        for key, flag, value in run.iter_records():
+            yield key, rank, value
+
+    def _merge(self, iters):
+        last_key = None
+
+        for key, rank, value in heapq.merge(*iters):
+            if key != last_key:
+                last_key = key
+                yield key, value
+
+    def close(self):
+        for run in self.runs:
+            run.close()
+            os.remove(run.path)
+
+        self.runs = []
+        self.run = []
+
+
+class SSTableJob(object):
+    # writes sorted records into sstables <out_prefix>.<n>.data with
+    # bloom filters, zone maps and indexes, a new file every
+    # target_file_bytes; holds no open files or locks, so it can be
+    # pickled and run in a worker process as well as in a thread
+    def __init__(self, table, out_prefix, level, seq, target_file_bytes=None, rate_limit=None):
+        self.out_prefix = out_prefix
+        self.level = level
+        self.seq = seq
+        self.target_file_bytes = target_file_bytes
+        self.rate_limit = rate_limit
+        self.bloom_bits_per_key = table.bloom_bits_per_key
+        self.compression = table.compression
+        self.columns = table.meta.columns
+        self.indexes = table.meta.indexes
+        self.codec = table.meta.codec
+        self.expected_keys = None
+
+    def __repr__(self):
+        return '<{} out_prefix:{} level:{}>'.format(
+            self.__class__.__name__,
+            repr(self.out_prefix),
+            self.level,
+        )
+
+    def records(self):
+        # sorted (key, flag, encoded value, doc)
+        raise NotImplementedError
+
+    def new_index_entries(self):
+        # name -> index entries of one output, kept in memory
+        return {name: [] for name in self.indexes}
+
+    def add_index_entry(self, entries, entry):
+        entries.append(entry)
+
+    def sorted_index_entries(self, index_entries):
+        for entries in index_entries.values():
+            entries.sort()
+
+        return index_entries
+
+    def close_index_entries(self, index_entries):
+        pass
+
+    def run(self):
+        # paths of written files, in key order
+        indexes = self.indexes
+        outputs = []
+        writer = None
+
+        if self.rate_limit:
+            rate_limiter = RateLimiter(self.rate_limit)
+        else:
+            rate_limiter = None
+
+        def finish():
+            # indexes of output are built from its records
+            if indexes:
+                sorted_entries = self.sorted_index_entries(index_entries)
+                FileTable.write_indexes(writer.path, sorted_entries, self.compression)
+
+            writer.finish()
+            self.close_index_entries(index_entries)
+            outputs.append(writer.path)
+
+        try:
+            for key, flag, value, doc in self.records():
+                if writer is None:
+                    writer = SSTableWriter(
+                        '{}.{}.data'.format(self.out_prefix, len(outputs)),
+                        level=self.level,
+                        seq=self.seq,
+                        bloom_bits_per_key=self.bloom_bits_per_key,
+                        rate_limiter=rate_limiter,
+                        compression=self.compression,
+                        expected_keys=self.expected_keys,
+                        columns=self.columns,
+                    )
+
+                    index_entries = self.new_index_entries()
+
+                writer.add(key, flag, value, doc)
+
+                if indexes and flag == RECORD_FLAG_SET:
+                    for name, columns in indexes.items():
+                        entry = index_entry(columns, key, doc)
+
+                        if entry is not None:
+                            self.add_index_entry(index_entries[name], entry)
+
+                if self.target_file_bytes and writer.offset >= self.target_file_bytes:
+                    finish()
+                    writer = None
+
+            if writer is not None:
+                finish()
+                writer = None
+        except:
+            if writer is not None:
+                writer.abort()
+                self.close_index_entries(index_entries)
+
+            for path in outputs:
+                self.remove(path)
+
+            raise
+
+        return outputs
+
+    def remove(self, path):
+        paths = [path, FileTable.bloom_path(path)]
+        paths += [FileTable.index_path(path, name) for name in self.indexes]
+
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class FlushJob(SSTableJob):
+    # memtable written into one level 0 file; documents are encoded by
+    # the job
+    def __init__(self, table, mem_table, out_prefix, seq):
+        SSTableJob.__init__(self, table, out_prefix, 0, seq)
+        self.items = list(mem_table.iter_range())
+
+    def records(self):
+        encode = self.codec.encode
+
+        for key, value in self.items:
+            if value is TOMBSTONE:
+                yield key, RECORD_FLAG_DELETE, b'', None
+            else:
+                yield key, RECORD_FLAG_SET, encode(value), value
+
+
+class BulkLoadJob(SSTableJob):
+    # rows of a finished ExternalSorter, index entries are sorted in
+    # bounded memory too; holds the sorter, so it only runs in a thread
+    def __init__(self, table, sorter, out_prefix, level, seq, target_file_bytes, run_bytes):
+        SSTableJob.__init__(self, table, out_prefix, level, seq, target_file_bytes)
+        self.sorter = sorter
+        self.new_run_path = table._new_run_path
+        self.run_bytes = run_bytes
+
+        if not target_file_bytes:
+            self.expected_keys = sorter.count
+
+    def records(self):
+        decode = self.indexes or self.columns
+
+        for key, value in self.sorter:
+            yield key, RECORD_FLAG_SET, value, self.codec.decode(value) if decode else None
+
+    def new_index_entries(self):
+        return {name: ExternalSorter(self.new_run_path, self.run_bytes) for name in self.indexes}
+
+    def add_index_entry(self, entries, entry):
+        entries.add(entry, b'')
+
+    def sorted_index_entries(self, index_entries):
+        for entries in index_entries.values():
+            entries.finish()
+
+        return {
+            name: (entry for entry, value in entries)
+            for name, entries in index_entries.items()
+        }
+
+    def close_index_entries(self, index_entries):
+        for entries in index_entries.values():
+            entries.close()
+
+
+class CompactionJob(SSTableJob):
+    # k-way merge of input files over keys in [start, end), newest
+    # version of every key wins
+    def __init__(self, table, task, out_prefix, start=None, end=None, rate_limit=None):
+        SSTableJob.__init__(
+            self, table, out_prefix, task.level, task.seq, task.target_file_bytes, rate_limit,
+        )
+
+        self.paths = [f.path for f in task.inputs] # newest first
+        self.drop_tombstones = task.drop_tombstones
+        self.start = start
+        self.end = end
+
+    def records(self):
+        inputs = [SSTable(path) for path in self.paths]
+        decode = self.indexes or self.columns
+        last_key = None
+
+        try:
+            iters = [self._ranked_records(f, rank) for rank, f in enumerate(inputs)]
+
+            for key, rank, flag, value in heapq.merge(*iters):
+                if key == last_key:
+                    continue
+
+                last_key = key
+
+                if flag == RECORD_FLAG_DELETE and self.drop_tombstones:
+                    continue
+
+                if flag == RECORD_FLAG_SET and decode:
+                    doc = self.codec.decode(value)
+                else:
+                    doc = None
+
+                yield key, flag, value, doc
+        finally:
+            for f in inputs:
+                f.close()
+
+    def _ranked_records(self, sstable, rank):
+        for key, flag, value in sstable.iter_records(self.start, self.end):
+            yield key, rank, flag, value
+
+
+AGGREGATES = ('count', 'sum', 'min', 'max')
+
+
+def combine_aggregate(op, a, b):
+    # partial results of aggregate op, None is no rows
+    if a is None:
+        return b
+
+    if b is None:
+        return a
+
+    if op == 'min':
+        return min(a, b)
+    elif op == 'max':
+        return max(a, b)
+
+    return a + b
+
+
+class PartitionJob(object):
+    # live rows of table with keys in [start, end): memtable rows are
+    # passed in, files are read by path, so it can be pickled and run in
+    # a worker process; returns projected rows matching predicate, or
+    # partial aggregate per group
+    def __init__(self, meta, mem_rows, paths, start, end, predicate=None, columns=None,
+                 aggregate=None, column=None, group_by=None):
+        self.meta = meta
+        self.mem_rows = mem_rows # [(key, value)] of every memtable, newest first
+        self.paths = paths # newest first
+        self.start = start
+        self.end = end
+        self.predicate = predicate
+        self.columns = columns
+        self.aggregate = aggregate
+        self.column = column
+        self.group_by = group_by
+
+    def __repr__(self):
+        return '<{} files:{} aggregate:{}>'.format(
+            self.__class__.__name__,
+            len(self.paths),
+            self.aggregate,
+        )
+
+    def rows(self):
+        # (key, doc) merged like Table.scan, newest version wins
+        inputs = [SSTable(path) for path in self.paths]
+        n = len(self.mem_rows)
+        last_key = None
+
+        try:
+            iters = [self._ranked_mem_rows(rows, rank) for rank, rows in enumerate(self.mem_rows)]
+            iters += [self._ranked_records(f, rank) for rank, f in enumerate(inputs, n)]
+
+            for key, rank, flag, value in heapq.merge(*iters):
+                if key == last_key:
+                    continue
+
+                last_key = key
+
+                if flag == RECORD_FLAG_DELETE:
+                    continue
+
+                if rank >= n:
+                    value = self.meta.codec.decode(value)
+
+                key = decode_key(key)
+
+                if self.predicate is None or self.predicate.matches(self, key, value):
+                    yield key, value
+        finally:
+            for f in inputs:
+                f.close()
+
+    def _ranked_mem_rows(self, rows, rank):
+        for key, value in rows:
+            if value is TOMBSTONE:
+                yield key, rank, RECORD_FLAG_DELETE, value
+            else:
+                yield key, rank, RECORD_FLAG_SET, value
+
+    def _ranked_records(self, sstable, rank):
+        for key, flag, value in sstable.iter_records(self.start, self.end):
+            yield key, rank, flag, value
+
+    def _value(self, name, key, doc):
+        # document field or primary key column, None if row has neither
+        try:
+            return Term(name).column_value(self, key, doc)
+        except KeyError:
+            return None
+
+    def run(self):
+        if self.aggregate is None:
+            if self.columns is None:
+                return list(self.rows())
+
+            return [
+                (key, {c: doc[c] for c in self.columns if isinstance(doc, dict) and c in doc})
+                for key, doc in self.rows()
+            ]
+
+        groups = {}
+
+        for key, doc in self.rows():
+            if self.column is None:
+                value = 1
+            else:
+                value = self._value(self.column, key, doc)
+
+                if value is None:
+                    continue
+
+                if self.aggregate == 'count':
+                    value = 1
+
+            if self.group_by is None:
+                group = None
+            else:
+                group = self._value(self.group_by, key, doc)
+
+            groups[group] = combine_aggregate(self.aggregate, groups.get(group), value)
+
+        return groups
+
+
+class WriteBatch(object):
+    # sets and deletes of many keys, committed with DataStore.write; part
+    # of every table is one log record applied to one memtable, so it is
+    # recovered completely or not at all
+    def __init__(self):
+        self.ops = {} # table -> [(encoded key, value)]
+
+    def __repr__(self):
+        return '<{} tables:{} len:{}>'.format(
+            self.__class__.__name__,
+            len(self.ops),
+            len(self),
+        )
+
+    def __len__(self):
+        return sum(len(ops) for ops in self.ops.values())
+
+    def set(self, table, key, value):
+        self.ops.setdefault(table, []).append((table._raw_key(key), value))
+
+    def delete(self, table, key):
+        self.ops.setdefault(table, []).append((table._raw_key(key), TOMBSTONE))
+
+    def clear(self):
+        self.ops = {}
+
+
+class Snapshot(object):
+    # consistent read view of every open table as of sequence number seq:
+    # memtables and files are pinned, versions written after seq are not
+    # seen, later flushes and compactions do not change what it reads.
+    # Files compacted away are deleted but stay mapped while referenced,
+    # overwritten memtable versions are kept until memtable is dropped
+    def __init__(self, ds, seq, views):
+        self.ds = ds
+        self.seq = seq
+        self.views = views # table -> (memtables, files)
+        self.released = False
+
+    def __repr__(self):
+        return '<{} seq:{} tables:{}>'.format(
+            self.__class__.__name__,
+            self.seq,
+            len(self.views),
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def view(self, table):
+        # memtables, files and sequence number to read table at
+        if self.released:
+            raise ValueError('snapshot is released: {}'.format(self))
+
+        try:
+            mem_tables, file_tables = self.views[table]
+        except KeyError:
+            raise ValueError('table opened after snapshot: {}'.format(table)) from None
+
+        return mem_tables, file_tables, self.seq
+
+    def release(self):
+        if self.released:
+            return
+
+        with self.ds.seq_lock:
+            self.ds.snapshots.remove(self)
+
+        self.released = True
+        self.views = {}
+
+
+class Table(object):
+    def __init__(self, ds, name, fields=None, mem_table_cap=1000, bloom_bits_per_key=10,
+                 background_flush=True, max_immutable_mem_tables=4, wal=True,
+                 wal_sync=WAL_SYNC_GROUP, wal_group_ms=10, wal_group_bytes=1 << 20,
+                 compaction='size-tiered', compaction_rate_limit=None, compression=None,
+                 row_cache_size=0):
+        self.ds = ds
+        self.name = name
+        self.mem_table_cap = mem_table_cap
+        self.bloom_bits_per_key = bloom_bits_per_key
+
+        # applies to files written from now on, every block records its codec
+        compression_codec(compression)
+        self.compression = compression
+
+        # decoded documents of hot keys, off by default
+        if row_cache_size:
+            self.row_cache = RowCache(row_cache_size)
+        else:
+            self.row_cache = None
+
+        self.wal = wal
+        self.wal_sync = wal_sync
+        self.wal_group_ms = wal_group_ms
+        self.wal_group_bytes = wal_group_bytes
+
+        if isinstance(compaction, str):
+            compaction = COMPACTION_STRATEGIES[compaction]()
+
+        self.compaction = compaction
+
+        # bytes per second of all subcompactions of a compaction together
+        self.compaction_rate_limit = compaction_rate_limit
+
+        self.meta = TableMeta(table=self, fields=fields)
+
+        # full memtables waiting for flush, newest first; this list and
+        # file_tables are never mutated in place but replaced under
+        # self.lock, so readers can use them without locking
+        self.immutable_mem_tables = []
+        self.file_tables = [] # newest first
+        self.next_file_no = 0
+        self.file_no_limit = 0
+        self.lock = threading.Lock()
+
+        # group commit: writers queue up, the one in front (leader) logs
+        # and applies everything queued behind it in one go
+        self.pending_writes = deque()
+        self.write_cond = threading.Condition()
+
+        # compaction runs one task at a time, woken up after every flush
+        self.compaction_lock = threading.Lock()
+        self.compaction_event = threading.Event()
+
+        # live files and logs come from manifest; sort runs of an
+        # interrupted bulk load and outputs of an interrupted flush or
+        # compaction are dropped, the dir is removed on close
+        if os.path.exists(self._run_dir()):
+            shutil.rmtree(self._run_dir(), ignore_errors=True)
+        state = self.ds.manifest.table(self.name)
+
+        if state is None:
+            self._load_from_dir()
+        else:
+            for file_no, f in state['files'].items():
+                file_table = FileTable(
+                    table=self,
+                    path=self._file_path(file_no, '.data'),
+                    key_range=(bytes.fromhex(f['min_key']), bytes.fromhex(f['max_key'])),
+                )
+
+                self.file_tables.append(file_table)
+
+            self.file_tables.sort()
+            self.next_file_no = self.file_no_limit = state['file_no_limit']
+
+        # recover writes that did not make it into data files; parts of
+        # batches never committed are skipped
+        state = self.ds.manifest.table(self.name)
+
+        for file_no in sorted(state['wals']):
+            path = self._file_path(file_no, '.wal')
+
+            if not os.path.exists(path):
+                # crashed between logging and creating it
+                self.ds.manifest.write({'table': self.name, 'remove_wal': [file_no]})
+                continue
+
+            mem_table = MemTable(
+                table=self,
+                cap=mem_table_cap,
+                wal=WriteAheadLog(path, sync=WAL_SYNC_NONE),
+            )
+
+            committed = state['batches'].get(file_no, ())
+
+            for batch_id, ops in WriteAheadLog.replay(path, self.meta.codec):
+                if batch_id is not None and batch_id not in committed:
+                    continue
+
+                for key, value in ops:
+                    mem_table.put(key, value)
+
+            if len(mem_table):
+                mem_table.freeze()
+                self._flush_mem_table(mem_table)
+            else:
+                self.ds.manifest.write({'table': self.name, 'remove_wal': [file_no]})
+                mem_table.wal.remove()
+
+        self.mem_table = self._new_mem_table()
+
+        # background flush; bounded queue blocks writers when flushing
+        # can not keep up. Error of failed flush is kept until memtable
+        # is flushed, writes fail before they are logged meanwhile
+        self.flush_error = None
+        self.flush_cond = threading.Condition()
+        self.closed = threading.Event()
+
+        if background_flush:
+            self.flush_queue = queue.Queue(maxsize=max_immutable_mem_tables)
+            self.flush_thread = threading.Thread(target=self._flush_worker, daemon=True)
+            self.flush_thread.start()
+        else:
+            self.flush_queue = None
+            self.flush_thread = None
+
+        if self.wal and self.wal_sync == WAL_SYNC_GROUP:
+            self.wal_sync_thread = threading.Thread(target=self._wal_sync_worker, daemon=True)
+            self.wal_sync_thread.start()
+        else:
+            self.wal_sync_thread = None
+
+        if self.compaction is not None:
+            self.compaction_thread = threading.Thread(target=self._compaction_worker, daemon=True)
+            self.compaction_thread.start()
+            self.compaction_event.set()
+        else:
+            self.compaction_thread = None
+
+    def __repr__(self):
+        return '<{} name:{}>'.format(
+            self.__class__.__name__,
+            repr(self.name),
+        )
+
+    def _file_path(self, file_no, ext):
+        return os.path.join(
+            self.ds.dirpath,
+            '{}.{:06d}{}'.format(self.name, file_no, ext),
+        )
+
+    def _parse_file_name(self, file_name, ext):
+        # <table name>.<file no><ext>
+        prefix = '{}.'.format(self.name)
+
+        if not file_name.startswith(prefix) or not file_name.endswith(ext):
+            return None
+
+        file_no = file_name[len(prefix):len(file_name) - len(ext)]
+
+        if not file_no.isdigit():
+            return None
+
+        return int(file_no)
+
+    def _load_from_dir(self):
+        # table not in manifest yet: data and log files of datastore
+        # written before there was one are registered
+        file_nos = []
+        wal_nos = []
+
+        for entry in os.scandir(self.ds.dirpath):
+            if not entry.is_file():
+                continue
+
+            file_no = self._parse_file_name(entry.name, '.data')
+
+            if file_no is not None:
+                file_nos.append(file_no)
+
+            file_no = self._parse_file_name(entry.name, '.wal')
+
+            if file_no is not None:
+                wal_nos.append(file_no)
+
+        for file_no in file_nos:
+            file_table = FileTable(table=self, path=self._file_path(file_no, '.data'))
+            self.file_tables.append(file_table)
+
+        self.file_tables.sort()
+
+        if file_nos or wal_nos:
+            self.next_file_no = max(file_nos + wal_nos) + 1
+
+        self.file_no_limit = self.next_file_no
+
+        self.ds.manifest.write({
+            'table': self.name,
+            'add': [f.manifest_entry() for f in self.file_tables],
+            'add_wal': sorted(wal_nos),
+            'file_no_limit': self.file_no_limit,
+        })
+
+    def _wal_no(self, wal):
+        return self._parse_file_name(os.path.basename(wal.path), '.wal')
+
+    def _new_mem_table(self):
+        if self.wal:
+            # logged in manifest before it is created, so it is replayed
+            # if it exists after a crash
+            file_no = self._new_file_no()
+            self.ds.manifest.write({'table': self.name, 'add_wal': [file_no]})
+
+            wal = WriteAheadLog(
+                self._file_path(file_no, '.wal'),
+                sync=self.wal_sync,
+                group_bytes=self.wal_group_bytes,
+            )
+        else:
+            wal = None
+
+        mem_table = MemTable(
+            table=self,
+            cap=self.mem_table_cap,
+            on_full=self._mem_full,
+            wal=wal,
+        )
+
+        return mem_table
+
+    def _new_file_no(self):
+        # numbers are leased from manifest in batches, so a number taken
+        # by a file that never made it to manifest is not reused
+        with self.lock:
+            file_no = self.next_file_no
+            self.next_file_no += 1
+
+            if self.next_file_no > self.file_no_limit:
+                self.file_no_limit = self.next_file_no + MANIFEST_FILE_NO_LEASE
+
+                self.ds.manifest.write({
+                    'table': self.name,
+                    'file_no_limit': self.file_no_limit,
+                })
+
+        return file_no
+
+    def fields(self, **fields):
+        self.meta = TableMeta(table=self, fields=fields)
+        return self
+
+    def _key(self, key):
+        # primary key is always a tuple
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        return key
+
+    def _raw_key(self, key):
+        # memtables, files and logs hold encoded keys
+        return encode_key(self._key(key))
+
+    def _raw_range(self, start=None, end=None):
+        if start is not None:
+            start = self._raw_key(start)
+
+        if end is not None:
+            end = self._raw_key(end)
+
+        return start, end
+
+    def _pin(self):
+        # memtables and files of snapshot, under lock so they are taken
+        # between two flushes or compactions
+        with self.lock:
+            return [self.mem_table] + self.immutable_mem_tables, self.file_tables
+
+    def _view(self, snapshot=None):
+        # memtables, files and sequence number to read; read order
+        # matters: memtable, immutable memtables, then files, flushing
+        # publishes in the opposite order
+        if snapshot is not None:
+            return snapshot.view(self)
+
+        mem_tables = [self.mem_table] + self.immutable_mem_tables
+        return mem_tables, self.file_tables, None
+
+    def set(self, key, value):
+        self._write([(self._raw_key(key), value)])
+
+    def get(self, key, snapshot=None):
+        key = self._key(key)
+        raw_key = encode_key(key)
+        row_cache = self.row_cache
+
+        # cache holds newest versions only
+        if snapshot is not None:
+            row_cache = None
+
+        if row_cache is not None:
+            value = row_cache.get(raw_key)
+
+            if value is not RowCache.MISS:
+                return value
+
+            generation = row_cache.generation
+
+        try:
+            value = self._get(raw_key, snapshot)
+        except KeyError:
+            raise KeyError(key) from None
+
+        if row_cache is not None:
+            row_cache.put(raw_key, value, generation)
+
+        return value
+
+    def _get(self, key, snapshot=None):
+        mem_tables, file_tables, seq = self._view(snapshot)
+
+        for m in mem_tables:
+            try:
+                value = m.get(key, seq)
+                break
+            except KeyError:
+                pass
+        else:
+            # hash once, every file's bloom filter reuses it
+            h = BloomFilter.hash(key)
+
+            for file_table in file_tables:
+                if not file_table.may_contain(key, h):
+                    continue
+
+                try:
+                    value = file_table.get(key)
+                    break
+                except KeyError:
+                    pass
+            else:
+                raise KeyError(key)
+
+        if value is TOMBSTONE:
+            raise KeyError(key)
+
+        return value
+
+    def get_many(self, keys, default=None, snapshot=None):
+        # values of keys in request order, default for missing ones;
+        # keys are looked up sorted, memtables are checked once and every
+        # file is walked block by block
+        raw_keys = [self._raw_key(key) for key in keys]
+        pending = sorted(set(raw_keys))
+        found = {}
+        row_cache = self.row_cache if snapshot is None else None
+
+        if row_cache is not None:
+            for key in pending:
+                value = row_cache.get(key)
+
+                if value is not RowCache.MISS:
+                    found[key] = value
+
+            pending = [key for key in pending if key not in found]
+            generation = row_cache.generation
+
+        mem_tables, file_tables, seq = self._view(snapshot)
+        loaded = {}
+
+        for mem_table in mem_tables:
+            if not pending:
+                break
+
+            for key in pending:
+                try:
+                    loaded[key] = mem_table.get(key, seq)
+                except KeyError:
+                    pass
+
+            pending = [key for key in pending if key not in loaded]
+
+        if pending:
+            hashes = {key: BloomFilter.hash(key) for key in pending}
+            codec = self.meta.codec
+
+            for file_table in file_tables:
+                if not pending:
+                    break
+
+                candidates = [key for key in pending if file_table.may_contain(key, hashes[key])]
+
+                for key, flag, value in file_table.get_records(candidates):
+                    if flag == RECORD_FLAG_DELETE:
+                        loaded[key] = TOMBSTONE
+                    else:
+                        loaded[key] = codec.decode(value)
+
+                pending = [key for key in pending if key not in loaded]
+
+        for key, value in loaded.items():
+            if value is TOMBSTONE:
+                continue
+
+            found[key] = value
+
+            if row_cache is not None:
+                row_cache.put(key, value, generation)
+
+        return [found.get(key, default) for key in raw_keys]
+
+    def delete(self, key):
+        self._write([(self._raw_key(key), TOMBSTONE)])
+
+    def set_many(self, items, batch_size=None):
+        # (key, value) pairs, committed in batches of batch_size
+        # (memtable capacity by default); every batch is atomic
+        batch_size = batch_size or self.mem_table_cap
+        raw_key = self._raw_key
+        items = iter(items)
+
+        for chunk in iter(lambda: list(itertools.islice(items, batch_size)), []):
+            self._write([(raw_key(key), value) for key, value in chunk])
+
+    def bulk_load(self, items, run_bytes=64 << 20):
+        # (key, value) pairs in any order, written straight into sstables:
+        # external sort in bounded memory, then files with bloom filters and
+        # indexes are published at once; of equal keys the last one wins,
+        # loaded rows win over rows written before
+        self.flush()
+        codec = self.meta.codec
+        sorter = ExternalSorter(self._new_run_path, run_bytes)
+
+        try:
+            for key, value in items:
+                sorter.add(self._raw_key(key), codec.encode(value))
+
+            sorter.finish()
+
+            if sorter.count:
+                self._bulk_write(sorter, run_bytes)
+        finally:
+            sorter.close()
+
+        return sorter.count
+
+    def _run_dir(self):
+        return os.path.join(self.ds.dirpath, '{}.runs'.format(self.name))
+
+    def _new_run_path(self):
+        run_dir = self._run_dir()
+        os.makedirs(run_dir, exist_ok=True)
+        return os.path.join(run_dir, '{:06d}.run'.format(self._new_file_no()))
+
+    def _bulk_write(self, sorter, run_bytes):
+        # rows overlapping files already here have to shadow them, so
+        # they go to level 0 as newest; otherwise they go straight to the
+        # level they would end up in
+        overlaps = any(f.overlaps(sorter.min_key, sorter.max_key) for f in self.file_tables)
+        target_file_bytes = getattr(self.compaction, 'target_file_bytes', None)
+        level = 0
+
+        if not overlaps and isinstance(self.compaction, LeveledCompaction):
+            level = 1
+
+            while sorter.size > self.compaction.level_base_bytes * self.compaction.level_multiplier ** (level - 1):
+                level += 1
+
+        job = BulkLoadJob(
+            self, sorter, self._new_run_path(), level, self._new_file_no(),
+            target_file_bytes, run_bytes,
+        )
+
+        outputs = self._install_outputs(self._run_jobs(None, [job]))
+
+        self.ds.manifest.write({
+            'table': self.name,
+            'add': [f.manifest_entry() for f in outputs],
+        })
+
+        with self.lock:
+            self.file_tables = sorted(self.file_tables + outputs)
+
+        # loaded rows shadow cached ones; cleared after the swap, so a read
+        # of the old files that started before it is not cached either
+        if self.row_cache is not None:
+            self.row_cache.clear()
+
+        self.compaction_event.set()
+
+    def scan(self, start_key=None, end_key=None, reverse=False, limit=None, file_filter=None,
+             snapshot=None):
+        for key, value in self._scan(start_key, end_key, reverse, limit, file_filter, snapshot):
+            yield decode_key(key), value
+
+    def _scan(self, start_key=None, end_key=None, reverse=False, limit=None, file_filter=None,
+              snapshot=None):
+        # lazy, sorted (encoded key, value) pairs in [start_key, end_key); merges
+        # memtables and files, newest version of every key wins and
+        # deleted keys are skipped; files outside of range are not read.
+        # Files file_filter returns False for are not read either, rows
+        # with a newer version in them are dropped
+        start_key, end_key = self._raw_range(start_key, end_key)
+
+        if limit is not None and limit <= 0:
+            return
+
+        mem_tables, file_tables, seq = self._view(snapshot)
+        skipped = []
+
+        # rank orders versions of the same key, newest first; reversed
+        # merge yields larger items first, so ranks are negated
+        sign = -1 if reverse else 1
+        iters = []
+
+        for rank, mem_table in enumerate(mem_tables):
+            iters.append(self._ranked_mem_records(
+                mem_table, sign * rank, start_key, end_key, reverse, seq,
+            ))
+
+        for rank, file_table in enumerate(file_tables, len(mem_tables)):
+            if not file_table.overlaps_range(start_key, end_key):
+                continue
+
+            if file_filter is not None and not file_filter(file_table):
+                skipped.append((rank, file_table))
+                continue
+
+            iters.append(self._ranked_records(
+                file_table, sign * rank, start_key, end_key, reverse,
+            ))
+
+        n = 0
+        last_key = None
+
+        for key, rank, flag, value in heapq.merge(*iters, reverse=reverse):
+            if key == last_key:
+                continue
+
+            last_key = key
+
+            if flag == RECORD_FLAG_DELETE:
+                continue
+
+            if skipped and self._shadowed(key, abs(rank), skipped):
+                continue
+
+            # files hold encoded values
+            if abs(rank) >= len(mem_tables):
+                value = self.meta.codec.decode(value)
+
+            yield key, value
+            n += 1
+
+            if limit is not None and n >= limit:
+                return
+
+    def _write(self, ops, rotate=False, record=None):
+        # encoded in caller's thread, so a value that can not be encoded
+        # fails its own write, not the group it would be logged with
+        if record is None and ops and self.wal:
+            record = encode_ops(ops, self.meta.codec)
+
+        group = self._lead(PendingWrite(ops, rotate=rotate, record=record))
+
+        if group is None:
+            return
+
+        error = None
+
+        try:
+            self._write_group(group)
+        except Exception as e:
+            error = e
+
+        self._finish_group(group, error)
+
+        if error is not None:
+            raise error
+
+    def _lead(self, w):
+        # queue w and wait; None if another leader wrote it, otherwise w
+        # leads and gets its group: everyone queued so far, up to the
+        # first exclusive write
+        with self.write_cond:
+            self.pending_writes.append(w)
+
+            while not w.done and self.pending_writes[0] is not w:
+                self.write_cond.wait()
+
+            if w.done:
+                if w.error is not None:
+                    raise w.error
+
+                return None
+
+            if w.exclusive:
+                return [w]
+
+            return list(itertools.takewhile(lambda x: not x.exclusive, self.pending_writes))
+
+    def _finish_group(self, group, error):
+        with self.write_cond:
+            for x in group:
+                self.pending_writes.popleft()
+                x.done = True
+                x.error = error
+
+            self.write_cond.notify_all()
+
+    def _write_group(self, group):
+        self._check_flush_error()
+        mem_table = self.mem_table
+        self._log_group(mem_table, group)
+        ds = self.ds
+
+        # one sequence number per write, published once whole group is
+        # applied, so a snapshot sees every write of a batch or none
+        with ds.seq_lock:
+            ds.seq = self._apply_group(mem_table, group, ds.seq)
+
+        self._rotate_full(mem_table, group)
+
+    def _log_group(self, mem_table, group):
+        # log first, one record per write
+        if mem_table.wal is not None:
+            mem_table.wal.write([w.record for w in group if w.ops])
+
+    def _apply_group(self, mem_table, group, seq):
+        # caller holds ds.seq_lock; returns last sequence number used
+        row_cache = self.row_cache
+
+        with mem_table.lock:
+            for w in group:
+                if not w.ops:
+                    continue
+
+                seq += 1
+
+                for key, value in w.ops:
+                    mem_table.put(key, value, seq)
+
+                    if row_cache is not None:
+                        row_cache.invalidate(key)
+
+        return seq
+
+    def _rotate_full(self, mem_table, group):
+        # group always lands in one memtable, so its wal covers it
+        if mem_table.is_full() or (len(mem_table) and any(w.rotate for w in group)):
+            self._mem_full(table=self, mem_table=mem_table)
+
+    def flush(self):
+        # flush memtable and wait for all immutable memtables to be written;
+        # raises error of flush while any of them is not
+        self._write([], rotate=True)
+
+        with self.flush_cond:
+            while self.immutable_mem_tables and self.flush_error is None:
+                self.flush_cond.wait()
+
+        self._check_flush_error()
+
+    def close(self):
+        # closing twice is a no-op; closed table leaves ds.tables, so
+        # later snapshots and ds.close do not see it
+        if self.closed.is_set():
+            return
+
+        self.flush()
+        self.closed.set()
+
+        with self.ds.seq_lock:
+            if self.ds.tables.get(self.name) is self:
+                del self.ds.tables[self.name]
+
+        if self.flush_thread is not None:
+            self.flush_queue.put(None)
+            self.flush_thread.join()
+            self.flush_thread = None
+
+        if self.wal_sync_thread is not None:
+            self.wal_sync_thread.join()
+            self.wal_sync_thread = None
+
+        if self.compaction_thread is not None:
+            self.compaction_event.set()
+            self.compaction_thread.join()
+            self.compaction_thread = None
+
+        # memtable is empty after flush
+        if self.mem_table.wal is not None:
+            self.ds.manifest.write({'table': self.name, 'remove_wal': [self._wal_no(self.mem_table.wal)]})
+            self.mem_table.wal.remove()
+
+        for file_table in self.file_tables:
+            file_table.close()
+
+        shutil.rmtree(self._run_dir(), ignore_errors=True)
+
+    def _wal_sync_worker(self):
+        while not self.closed.wait(self.wal_group_ms / 1000.0):
+            wal = self.mem_table.wal
+
+            if wal is not None:
+                wal.sync()
+
+    def _check_flush_error(self):
+        # without flush thread, failed memtables are retried here, oldest
+        # first; flush thread retries them itself
+        if self.flush_error is not None and self.flush_queue is None:
+            for mem_table in reversed(self.immutable_mem_tables):
+                if not self._try_flush(mem_table):
+                    break
+
+        if self.flush_error is not None:
+            raise self.flush_error
+
+    def _try_flush(self, mem_table):
+        try:
+            self._flush_mem_table(mem_table)
+            error = None
+        except Exception as e:
+            error = e
+
+        with self.flush_cond:
+            self.flush_error = error
+            self.flush_cond.notify_all()
+
+        return error is None
+
+    def _mem_full(self, table, mem_table):
+        mem_table.freeze()
+
+        if mem_table.wal is not None:
+            mem_table.wal.close()
+
+        new_mem_table = self._new_mem_table()
+
+        with self.lock:
+            self.immutable_mem_tables = [mem_table] + self.immutable_mem_tables
+
+            # memtable
+            self.mem_table = new_mem_table
+
+        if self.flush_queue is not None:
+            # blocks while queue is full
+            self.flush_queue.put(mem_table)
+        else:
+            # write is applied already, error fails next one
+            self._try_flush(mem_table)
+
+    def _flush_worker(self):
+        while True:
+            mem_table = self.flush_queue.get()
+
+            try:
+                if mem_table is None:
+                    return
+
+                # later memtables wait, so files keep order of memtables
+                while not self._try_flush(mem_table):
+                    time.sleep(FLUSH_RETRY_SECONDS)
+            finally:
+                self.flush_queue.task_done()
+
+    def _flush_mem_table(self, mem_table):
+        # documents are encoded in worker process if there are any
+        file_no = self._new_file_no()
+        job = FlushJob(self, mem_table, self._new_run_path(), seq=file_no)
+        file_table, = self._install_outputs(self._run_jobs(self.ds._process_pool(), [job]))
+
+        edit = {'table': self.name, 'add': [file_table.manifest_entry()]}
+
+        if mem_table.wal is not None:
+            edit['remove_wal'] = [self._wal_no(mem_table.wal)]
+
+        self.ds.manifest.write(edit)
+
+        # publish file first, then drop memtable
+        with self.lock:
+            self.file_tables = [file_table] + self.file_tables
+
+            self.immutable_mem_tables = [
+                m for m in self.immutable_mem_tables
+                if m is not mem_table
+            ]
+
+        # data is in file now
+        if mem_table.wal is not None:
+            mem_table.wal.remove()
+
+        self.compaction_event.set()
+
+    def compact(self, full=False):
+        # run compaction now; full merges all files into one sorted run
+        strategy = self.compaction or SizeTieredCompaction()
+
+        with self.compaction_lock:
+            if full:
+                task = strategy.pick_full(self.file_tables)
+
+                if task is not None:
+                    self._compact(task)
+            else:
+                while True:
+                    task = strategy.pick(self.file_tables)
+
+                    if task is None:
+                        break
+
+                    self._compact(task)
+
+    def _compaction_worker(self):
+        while True:
+            self.compaction_event.wait()
+            self.compaction_event.clear()
+
+            if self.closed.is_set():
+                return
+
+            try:
+                with self.compaction_lock:
+                    while not self.closed.is_set():
+                        task = self.compaction.pick(self.file_tables)
+
+                        if task is None:
+                            break
+
+                        self._compact(task)
+            except Exception as e:
+                warnings.warn('compaction failed for {}: {}'.format(self, e))
+
+    def iter_index(self, name, start=None, end=None, reverse=False, snapshot=None):
+        # live rows ordered by index columns, as (values, key, doc);
+        # start and end are tuples of leading column values, end exclusive
+        for values, key, doc in self._iter_index(name, start, end, reverse, snapshot):
+            yield values, decode_key(key), doc
+
+    def _iter_index(self, name, start=None, end=None, reverse=False, snapshot=None):
+        # same as iter_index, with encoded keys
+        columns = self.meta.indexes[name]
+        n = len(columns)
+        start, end = self._raw_range(start, end)
+        mem_tables, file_tables, seq = self._view(snapshot)
+
+        iters = [m.get_index(name, columns).iter_range(start, end, reverse) for m in mem_tables]
+        iters += [f.get_index(name, columns).iter_range(start, end, reverse) for f in file_tables]
+        last_entry = None
+
+        for entry in heapq.merge(*iters, reverse=reverse):
+            if entry == last_entry:
+                continue
+
+            last_entry = entry
+            values, pos = decode_key_prefix(entry, n)
+            key = entry[pos:]
+
+            # older files keep entries of overwritten and deleted rows,
+            # only entries matching current version of row are live
+            try:
+                doc = self._get(key, snapshot)
+            except KeyError:
+                continue
+
+            if index_entry(columns, key, doc) != entry:
+                continue
+
+            yield values, key, doc
+
+    def find(self, **conditions):
+        # (key, doc) of rows with columns equal to conditions
+        terms = [Term(column, value) for column, value in conditions.items()]
+
+        if len(terms) == 1:
+            return self.execute(terms[0])
+
+        return self.execute(And(*terms))
+
+    def estimate_rows(self, file_filter=None):
+        n = sum(len(m) for m in [self.mem_table] + self.immutable_mem_tables)
+
+        for f in self.file_tables:
+            if file_filter is None or file_filter(f):
+                n += len(f)
+            else:
+                n += 1
+
+        return n
+
+    def estimate_range(self, start=None, end=None):
+        # memtables are small and sorted, counted as one block each
+        start, end = self._raw_range(start, end)
+        n = len(self.immutable_mem_tables) + 1
+        n += sum(f.estimate_count(start, end) for f in self.file_tables)
+        return n
+
+    def estimate_index(self, name, start=None, end=None):
+        columns = self.meta.indexes[name]
+        start, end = self._raw_range(start, end)
+        n = len(self.immutable_mem_tables) + 1
+
+        n += sum(
+            f.get_index(name, columns).estimate_count(start, end)
+            for f in self.file_tables
+        )
+
+        return n
+
+    def plan_index(self, name, start, end, sorted_by_key, matches, snapshot=None):
+        # rows from index come in primary key order only if every index
+        # column is fixed, otherwise their keys are collected and sorted
+        cost = self.estimate_index(name, start, end) * INDEX_ROW_COST
+
+        def stream():
+            # streams carry the encoded key, so merging and sorting never
+            # compare decoded values of mixed types
+            rows = self._iter_index(name, start, end, snapshot=snapshot)
+
+            if sorted_by_key:
+                for values, raw_key, doc in rows:
+                    key = decode_key(raw_key)
+
+                    if matches(self, key, doc):
+                        yield raw_key, key, doc
+
+                return
+
+            raw_keys = sorted(raw_key for values, raw_key, doc in rows
+                              if matches(self, decode_key(raw_key), doc))
+
+            for raw_key in raw_keys:
+                try:
+                    doc = self._get(raw_key, snapshot)
+                except KeyError:
+                    continue
+
+                key = decode_key(raw_key)
+
+                if matches(self, key, doc):
+                    yield raw_key, key, doc
+
+        return cost, stream
+
+    def _shadowed(self, key, rank, file_tables):
+        # key has a version in any of (rank, file table) newer than rank
+        h = None
+
+        for r, file_table in file_tables:
+            if r >= rank:
+                break
+
+            if h is None:
+                h = BloomFilter.hash(key)
+
+            if not file_table.may_contain(key, h):
+                continue
+
+            try:
+                file_table.get_record(key)
+                return True
+            except KeyError:
+                pass
+
+        return False
+
+    def _ranked_records(self, file_table, rank, start=None, end=None, reverse=False):
+        for key, flag, value in file_table.iter_records(start, end, reverse):
+            yield key, rank, flag, value
+
+    def _ranked_mem_records(self, mem_table, rank, start=None, end=None, reverse=False, seq=None):
+        for key, value in mem_table.iter_range(start, end, reverse, seq):
+            if value is TOMBSTONE:
+                yield key, rank, RECORD_FLAG_DELETE, value
+            else:
+                yield key, rank, RECORD_FLAG_SET, value
+
+    def _compact(self, task):
+        # k-way merge of sorted inputs, newest version of every key wins;
+        # with process workers key space is split into subcompactions,
+        # merged in parallel and installed at once
+        pool = self.ds._process_pool()
+
+        if pool is None:
+            ranges = [(None, None)]
+        else:
+            ranges = self._key_ranges(task.inputs, self.ds.process_workers)
+
+        rate_limit = self.compaction_rate_limit and self.compaction_rate_limit / len(ranges)
+
+        jobs = [
+            CompactionJob(self, task, self._new_run_path(), start, end, rate_limit)
+            for start, end in ranges
+        ]
+
+        paths = self._run_jobs(pool, jobs)
+        outputs = self._install_outputs(paths)
+
+        self.ds.manifest.write({
+            'table': self.name,
+            'add': [f.manifest_entry() for f in outputs],
+            'remove': [f.no for f in task.inputs],
+        })
+
+        with self.lock:
+            file_tables = [f for f in self.file_tables if f not in task.inputs]
+            self.file_tables = sorted(file_tables + outputs)
+
+        for f in task.inputs:
+            f.remove()
+
+    def _key_ranges(self, file_tables, n):
+        # [start, end) ranges of about equal size, split at block
+        # boundaries of files; blocks are about the same size, so every
+        # range gets about the same number of them
+        keys = list(heapq.merge(*[f.block_keys for f in file_tables]))
+
+        if not keys:
+            return [(None, None)]
+
+        bounds = sorted(set(keys[len(keys) * i // n] for i in range(1, n)) - {keys[0]})
+        return list(zip([None] + bounds, bounds + [None]))
+
+    def _run_jobs(self, pool, jobs):
+        # output paths of every job in order; in this thread without
+        # pool, otherwise all at once in worker processes
+        if pool is None:
+            paths = []
+
+            for job in jobs:
+                paths += job.run()
+
+            return paths
+
+        futures = [(job, pool.submit(job.run)) for job in jobs]
+        outputs = []
+        error = None
+
+        for job, future in futures:
+            try:
+                outputs.append((job, future.result()))
+            except Exception as e:
+                error = e
+
+        if error is not None:
+            for job, paths in outputs:
+                for path in paths:
+                    job.remove(path)
+
+            raise error
+
+        return [path for job, paths in outputs for path in paths]
+
+    def _install_outputs(self, paths):
+        # job outputs are moved from run dir under file numbers of table
+        file_tables = []
+
+        for path in paths:
+            new_path = self._file_path(self._new_file_no(), '.data')
+            moves = [(FileTable.bloom_path(path), FileTable.bloom_path(new_path))]
+
+            moves += [
+                (FileTable.index_path(path, name), FileTable.index_path(new_path, name))
+                for name in self.meta.indexes
+            ]
+
+            for src, dst in moves:
+                if os.path.exists(src):
+                    os.replace(src, dst)
+
+            # data file last, as everywhere
+            os.replace(path, new_path)
+            file_tables.append(FileTable(table=self, path=new_path))
+
+        return file_tables
+
+    def execute(self, q, snapshot=None):
+        # (key, doc) of rows matching query, in primary key order
+        return q.execute(self, snapshot)
+
+    def parallel_scan(self, predicate=None, columns=None, workers=None):
+        # (key, doc) of rows matching predicate query, in primary key
+        # order, docs projected to columns; key space is split into
+        # workers partitions read in worker processes of datastore, rows
+        # of a partition are yielded as soon as it and those before it
+        # are done
+        for rows in self._run_partitions(workers, predicate=predicate, columns=columns):
+            for row in rows:
+                yield row
+
+    def aggregate(self, op, column=None, predicate=None, group_by=None, workers=None):
+        # count, sum, min or max of column over rows matching predicate,
+        # rows without it are skipped (count without column counts rows);
+        # with group_by a dict of group value -> result, partitions are
+        # aggregated in worker processes and combined here
+        if op not in AGGREGATES:
+            raise ValueError('invalid aggregate: {}'.format(repr(op)))
+
+        if group_by is not None and group_by not in self.meta.columns + self.meta.primary_key:
+            raise ValueError('group by undeclared field: {}'.format(repr(group_by)))
+
+        groups = {}
+
+        for partial in self._run_partitions(workers, predicate=predicate, aggregate=op,
+                                            column=column, group_by=group_by):
+            for group, value in partial.items():
+                groups[group] = combine_aggregate(op, groups.get(group), value)
+
+        if op in ('count', 'sum'):
+            empty = 0
+        else:
+            empty = None
+
+        if group_by is None:
+            return groups.get(None, empty)
+
+        return groups
+
+    def _run_partitions(self, workers, **kwargs):
+        # results of PartitionJob per key range, yielded in key order as
+        # they complete; compaction waits until every job is done, so
+        # files workers open by path stay in place, memtable rows are
+        # taken as of one snapshot
+        process_workers = self.ds.process_workers
+
+        if workers is None:
+            workers = process_workers or 1
+
+        if workers > max(process_workers, 1):
+            msg = 'workers {} exceeds process_workers {} of datastore'
+            raise ValueError(msg.format(workers, process_workers))
+
+        pool = self.ds._process_pool()
+        self.compaction_lock.acquire()
+
+        try:
+            with self.ds.snapshot() as snapshot:
+                mem_tables, file_tables, seq = snapshot.view(self)
+
+                if pool is None:
+                    ranges = [(None, None)]
+                else:
+                    ranges = self._key_ranges(file_tables, workers)
+
+                jobs = [
+                    PartitionJob(
+                        self.meta,
+                        [list(m.iter_range(start, end, seq=seq)) for m in mem_tables],
+                        [f.path for f in file_tables],
+                        start,
+                        end,
+                        **kwargs
+                    )
+                    for start, end in ranges
+                ]
+
+            if pool is None:
+                results = [job.run() for job in jobs]
+                futures = None
+            else:
+                futures = [pool.submit(job.run) for job in jobs]
+        except:
+            self.compaction_lock.release()
+            raise
+
+        if futures is None:
+            self.compaction_lock.release()
+
+            for result in results:
+                yield result
+
+            return
+
+        # lock is released once last job is done, not when results are
+        # consumed, so a slow or abandoned consumer does not hold it
+        pending = [len(futures)]
+        pending_lock = threading.Lock()
+
+        def done(future):
+            with pending_lock:
+                pending[0] -= 1
+
+                if not pending[0]:
+                    self.compaction_lock.release()
+
+        for future in futures:
+            future.add_done_callback(done)
+
+        try:
+            for future in futures:
+                yield future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+class DataStore(object):
+    def __init__(self, dirpath, block_cache_bytes=8 << 20, process_workers=0):
+        self.dirpath = os.path.abspath(dirpath)
+
+        if not os.path.exists(self.dirpath):
+            msg = 'datastore does not exist at {}'.format(repr(self.dirpath))
+            msg += ', so it will be created.'
+            warnings.warn(msg)
+            os.makedirs(dirpath)
+
+        # database tables
+        self.tables = {}
+
+        # every write is stamped with next sequence number, applied and
+        # published under seq_lock; live snapshots in order of seq
+        self.seq = 0
+        self.seq_lock = threading.Lock()
+        self.snapshots = []
+
+        # live files of every table
+        self.manifest = Manifest(os.path.join(self.dirpath, 'MANIFEST'))
+
+        # decoded blocks of every table's files, None disables caching
+        if block_cache_bytes:
+            self.block_cache = BlockCache(block_cache_bytes)
+        else:
+            self.block_cache = None
+
+        # flushes and compactions of every table encode and merge in
+        # worker processes, started on first use; 0 keeps them in threads
+        self.process_workers = process_workers
+        self.process_pool = None
+        self.process_pool_lock = threading.Lock()
+
+    def __repr__(self):
+        return '<{} dirpath:{}>'.format(
+            self.__class__.__name__,
+            repr(self.dirpath),
+        )
+
+    def table(self, name, fields=None, mem_table_cap=1000, bloom_bits_per_key=10,
+              background_flush=True, max_immutable_mem_tables=4, wal=True,
+              wal_sync=WAL_SYNC_GROUP, wal_group_ms=10, wal_group_bytes=1 << 20,
+              compaction='size-tiered', compaction_rate_limit=None, compression=None,
+              row_cache_size=0):
+        t = Table(
+            self,
+            name,
+            fields,
+            mem_table_cap=mem_table_cap,
+            bloom_bits_per_key=bloom_bits_per_key,
+            background_flush=background_flush,
+            max_immutable_mem_tables=max_immutable_mem_tables,
+            wal=wal,
+            wal_sync=wal_sync,
+            wal_group_ms=wal_group_ms,
+            wal_group_bytes=wal_group_bytes,
+            compaction=compaction,
+            compaction_rate_limit=compaction_rate_limit,
+            compression=compression,
+            row_cache_size=row_cache_size,
+        )
+
+        self.tables[name] = t
+        return t
+
+    def _process_pool(self):
+        if not self.process_workers:
+            return None
+
+        with self.process_pool_lock:
+            if self.process_pool is None:
+                # spawned, forking a process with running threads is unsafe
+                self.process_pool = ProcessPoolExecutor(
+                    max_workers=self.process_workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                )
+
+        return self.process_pool
+
+    def snapshot(self):
+        # consistent read view of every open table, see Snapshot; pass it
+        # as snapshot to get, get_many, scan and execute and release it
+        with self.seq_lock:
+            views = {t: t._pin() for t in list(self.tables.values())}
+            snapshot = Snapshot(self, self.seq, views)
+            self.snapshots.append(snapshot)
+
+        return snapshot
+
+    def write(self, batch):
+        # every part is encoded before anything is written, so an invalid
+        # value leaves batch unapplied and uncleared; batch is recovered
+        # after a crash completely or not at all
+        parts = [
+            (table, ops, encode_ops(ops, table.meta.codec))
+            for table, ops in sorted(batch.ops.items(), key=lambda item: item[0].name)
+            if ops
+        ]
+
+        if len(parts) == 1:
+            table, ops, record = parts[0]
+            table._write(ops, record=record)
+        elif parts:
+            self._write_parts(parts)
+
+        batch.clear()
+
+    def _write_parts(self, parts):
+        # each part leads its table's write queue alone, taken in table
+        # name order so two batches never wait on each other. Parts are
+        # logged and synced in wals of their tables marked with batch id,
+        # then one manifest record commits them all, so recovery replays
+        # every part or none. All parts share one sequence number
+        # published at once, so a snapshot sees whole batch or none of it
+        batch_id = os.urandom(16).hex()
+        batch_op = encode_batch_op(batch_id)
+        writes = []
+        error = None
+
+        try:
+            for table, ops, record in parts:
+                w = PendingWrite(ops, record=batch_op + record, exclusive=True)
+                writes.append((table, table._lead(w)))
+
+            for table, group in writes:
+                table._check_flush_error()
+
+            # memtables do not change while their tables are led
+            wals = []
+
+            for table, group in writes:
+                mem_table = table.mem_table
+                table._log_group(mem_table, group)
+
+                if mem_table.wal is not None:
+                    mem_table.wal.sync()
+                    wals.append([table.name, table._wal_no(mem_table.wal)])
+
+            if wals:
+                self.manifest.write({'batch': batch_id, 'wals': wals})
+
+            with self.seq_lock:
+                seq = self.seq
+
+                for table, group in writes:
+                    table._apply_group(table.mem_table, group, seq)
+
+                self.seq = seq + 1
+
+            for table, group in writes:
+                table._rotate_full(table.mem_table, group)
+        except Exception as e:
+            error = e
+
+        for table, group in writes:
+            table._finish_group(group, error)
+
+        if error is not None:
+            raise error
+
+    def close(self):
+        for t in list(self.tables.values()):
+            t.close()
+
+        if self.process_pool is not None:
+            self.process_pool.shutdown()
+            self.process_pool = None
+
+        self.manifest.close()
+
+
+#
+# asyncio
+#
+class AsyncTable(object):
+    # asyncio front-end of Table: blocking calls run in executor of
+    # AsyncDataStore; gets issued in the same loop tick are looked up
+    # with one get_many
+    def __init__(self, ads, table):
+        self.ads = ads
+        self.table = table
+        self.pending_gets = {} # snapshot -> [(key, future)]
+        self.tasks = set()
+
+    def __repr__(self):
+        return '<{} name:{}>'.format(
+            self.__class__.__name__,
+            repr(self.table.name),
+        )
+
+    def fields(self, **fields):
+        self.table.fields(**fields)
+        return self
+
+    async def get(self, key, snapshot=None):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        # invalid key fails its own get, not the whole batch
+        try:
+            self.table._raw_key(key)
+        except Exception as e:
+            future.set_exception(e)
+            return await future
+
+        batch = self.pending_gets.get(snapshot)
+
+        # first get of tick schedules lookup, it runs after every
+        # callback ready now, so gets issued before it join batch
+        if batch is None:
+            batch = self.pending_gets[snapshot] = []
+            task = loop.create_task(self._get_batch(snapshot))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+        batch.append((key, future))
+        return await future
+
+    async def _get_batch(self, snapshot):
+        batch = self.pending_gets.pop(snapshot)
+        missing = object()
+
+        try:
+            values = await self.ads._run(
+                self.table.get_many, [key for key, future in batch], missing, snapshot,
+            )
+        except Exception as e:
+            for key, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+            return
+
+        for (key, future), value in zip(batch, values):
+            if future.done():
+                continue
+
+            if value is missing:
+                future.set_exception(KeyError(self.table._key(key)))
+            else:
+                future.set_result(value)
+
+    async def get_many(self, keys, default=None, snapshot=None):
+        return await self.ads._run(self.table.get_many, list(keys), default, snapshot)
+
+    async def set(self, key, value):
+        await self.ads._write(self.table.set, key, value)
+
+    async def delete(self, key):
+        await self.ads._write(self.table.delete, key)
+
+    async def set_many(self, items, batch_size=None):
+        await self.ads._write(self.table.set_many, list(items), batch_size)
+
+    async def flush(self):
+        await self.ads._write(self.table.flush)
+
+    async def compact(self, full=False):
+        await self.ads._run(self.table.compact, full)
+
+    async def scan(self, start_key=None, end_key=None, reverse=False, limit=None,
+                   snapshot=None, batch_size=256):
+        # rows are read in executor, batch_size at a time
+        rows = self.table.scan(start_key, end_key, reverse, limit, snapshot=snapshot)
+
+        async for row in self.ads._iterate(rows, batch_size):
+            yield row
+
+    async def execute(self, q, snapshot=None, batch_size=256):
+        # planning can build index files of older files
+        rows = await self.ads._run(self.table.execute, q, snapshot)
+
+        async for row in self.ads._iterate(rows, batch_size):
+            yield row
+
+
+class AsyncDataStore(object):
+    # asyncio front-end of DataStore; reads and writes run in a pool of
+    # max_workers threads. Writes wait in event loop for one of
+    # max_writers slots, so when flushing falls behind, writes blocked on
+    # full flush queue hold at most max_writers threads and callers of
+    # set are slowed down while reads go on
+    def __init__(self, dirpath, max_workers=8, max_writers=None, **kwargs):
+        self.ds = DataStore(dirpath, **kwargs)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='datastore')
+        self.write_slots = asyncio.Semaphore(max_writers or max(1, max_workers // 2))
+        self.tables = {}
+
+    def __repr__(self):
+        return '<{} dirpath:{}>'.format(
+            self.__class__.__name__,
+            repr(self.ds.dirpath),
+        )
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def _write(self, func, *args, **kwargs):
+        async with self.write_slots:
+            return await self._run(func, *args, **kwargs)
+
+    async def _iterate(self, rows, batch_size):
+        # sync generator stepped in executor; closed if loop stops early,
+        # after step still running in executor is over, a running
+        # generator can not be closed
+        def take():
+            return list(itertools.islice(rows, batch_size))
+
+        future = None
+
+        try:
+            while True:
+                future = self.executor.submit(take)
+                batch = await asyncio.wrap_future(future)
+
+                for row in batch:
+                    yield row
+
+                if len(batch) < batch_size:
+                    return
+        finally:
+            if future is not None and not future.done():
+                try:
+                    await asyncio.shield(asyncio.wrap_future(future))
+                except Exception:
+                    pass
+
+            rows.close()
+
+    async def table(self, name, fields=None, **kwargs):
+        # opening replays logs, so it runs in executor too
+        t = await self._run(self.ds.table, name, fields, **kwargs)
+        at = self.tables[name] = AsyncTable(self, t)
+        return at
+
+    def snapshot(self):
+        # pins memtables and files, no I/O
+        return self.ds.snapshot()
+
+    async def write(self, batch):
+        await self._write(self.ds.write, batch)
+
+    async def close(self):
+        await self._run(self.ds.close)
+        self.executor.shutdown(wait=False)
+
+
+if __name__ == '__main__':
+    d = DataStore('tmp/demo0')
+
+    User = d.table('User', mem_table_cap=10).fields(
+        username=TextField(primary_key=True),
+        password=TextField(primary_key=True),
+        created=DateTimeField(primary_key=True),
+        first_name=TextField(),
+        last_name=TextField(),
+        email=TextField(),
+        dob=DateField(),
+        username_dob_index=Index('username', 'dob'),
+        dob_email_index=Index('dob', 'email'),
+    )
+
+    # results = User.execute(
+    #     Or(
+    #         Term('username', 'mtasic'),
+    #         And(
+    #             Le(Term('dob', '19850623')),
+    #             Ge(Term('dob', '19890625')),
+    #         )
+    #     )
+    # )
+
+    # results = User.execute(
+    #     Term('username', 'mtasic') | (
+    #         ('19850623' <= Term('dob')) & (Term('dob') <= '19890625')
+    #     )
+    # )
+
+    # results = User.execute(
+    #     User.username == 'mtasic' | (
+    #         '19890625' <= User.dob <= '19850623'
+    #     )
+    # )
+
+    # results = User.execute(
+    #     'username == "mtasic" OR (dob < "19850623" AND dob > "19890625")'
+    # )
+
+    for i in range(User.mem_table.cap * 2 - 1):
+        User.set(i, i)
+
+    for i in range(User.mem_table.cap * 2 - 1):
+        try:
+            v = User.get(i)
+        except KeyError as e:
+            print(KeyError, e)
+            continue
+
+        print('{}: {}'.format(i, v))
+
+    d.close()
@@ -1,8 +1,22 @@
 import os
+import sys
+import json
+import asyncio
 import time
+import random
+import datetime
+import shutil
+import tempfile
+import threading
 import unittest
+import warnings
 
-from datastore import DataStore
+import datastore
+from datastore import DataStore, AsyncDataStore, MemTable, SortedList, BloomFilter, TOMBSTONE
+from datastore import TextField, DateField, IntField, Index
+from datastore import BoolField, FloatField, TimeField, DateTimeField
+from datastore import Term, And, Or, Sub, Xor, Le, Ge
+from datastore import encode_key, decode_key, KEY_MAX
 
 class TestDataStore(unittest.TestCase):
     @classmethod
@@ -47,5 +61,1897 @@ class TestDataStore(unittest.TestCase):
 
         print('took {} seconds'.format(time.time() - t))
 
+class TestMemTable(unittest.TestCase):
+    def test_sorted_list(self):
+        values = list(range(10000))
+        random.shuffle(values)
+        sl = SortedList(load=16)
+
+        for v in values:
+            sl.add(v)
+
+        self.assertEqual(list(sl), list(range(10000)))
+        self.assertEqual(list(sl.irange(10, 20)), list(range(10, 20)))
+        self.assertEqual(list(sl.irange(9990, None, reverse=True)), list(range(9999, 9989, -1)))
+
+        for v in values[:5000]:
+            sl.remove(v)
+
+        self.assertEqual(list(sl), sorted(values[5000:]))
+
+    def test_set_get_delete(self):
+        mem_table = MemTable(table=None, cap=100)
+
+        for i in reversed(range(50)):
+            mem_table.set((i, str(i)), {'i': i})
+
+        self.assertEqual(mem_table.get((7, '7')), {'i': 7})
+        mem_table.delete((7, '7'))
+        self.assertIs(mem_table.get((7, '7')), TOMBSTONE)
+        self.assertRaises(KeyError, mem_table.get, (100, '100'))
+
+        keys = [k for k, v in mem_table.iter_range()]
+        self.assertEqual(keys, sorted(keys))
+        self.assertEqual(len(keys), 50)
+
+        keys = [k for k, v in mem_table.iter_range((10,), (20,), reverse=True)]
+        self.assertEqual(keys, [(i, str(i)) for i in range(19, 9, -1)])
+
+
+class TestKeyEncoding(unittest.TestCase):
+    def test_order(self):
+        rnd = random.Random(12)
+        texts = ['', 'a', 'a\x00', 'a\x00b', 'a\x01', 'ab', 'b', '\u017e']
+        floats = [0.0, -0.0, 1.5, -1.5, 1e-300, -1e300, float('inf'), float('-inf')]
+
+        keys = [
+            (rnd.randint(-2 ** 63, 2 ** 63 - 1), rnd.choice(texts), rnd.choice(floats))
+            for i in range(500)
+        ]
+
+        keys += [(rnd.randint(-3, 3), rnd.choice(texts), rnd.random()) for i in range(500)]
+        keys += [(-1,), (0,), (1,), (0, ''), (0, '', -1.0)]
+        encoded = sorted(encode_key(key) for key in keys)
+        self.assertEqual([decode_key(k) for k in encoded], sorted(keys))
+
+    def test_roundtrip(self):
+        key = (
+            None, True, False, -5, 2 ** 63 - 1, -2.5, 'x\x00y', b'\x00\xff',
+            datetime.date(1900, 1, 1),
+            datetime.time(12, 30, 15, 7),
+            datetime.datetime(2020, 2, 29, 1, 2, 3, 4),
+        )
+
+        self.assertEqual(decode_key(encode_key(key)), key)
+        self.assertRaises(OverflowError, encode_key, (2 ** 63,))
+        self.assertRaises(TypeError, encode_key, ([1],))
+
+    def test_prefix(self):
+        # encoded prefix sorts first, prefix + KEY_MAX after every extension
+        for key in [(1, 'a', 2.0), ('a', 'b'), ('a\x00', 1)]:
+            raw = encode_key(key)
+
+            for n in range(len(key)):
+                self.assertTrue(raw.startswith(encode_key(key[:n])))
+                self.assertLess(raw, encode_key(key[:n] + (KEY_MAX,)))
+                self.assertEqual(datastore.decode_key_prefix(raw, n)[0], key[:n])
+
+    def test_composite_key(self):
+        dirpath = tempfile.mkdtemp()
+        ds = DataStore(dirpath)
+
+        try:
+            t = ds.table('T', mem_table_cap=100, compaction=None)
+
+            for i in range(-150, 150):
+                t.set((i, 'k{}'.format(i % 3), i / 7), {'i': i})
+
+            t.flush()
+            keys = [k for k, v in t.scan((-2,), (2,))]
+            self.assertEqual(keys, sorted((i, 'k{}'.format(i % 3), i / 7) for i in range(-2, 2)))
+            self.assertEqual(t.get((-100, 'k2', -100 / 7)), {'i': -100})
+        finally:
+            ds.close()
+            shutil.rmtree(dirpath)
+
+
+class TestFileTable(unittest.TestCase):
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        self.ds = DataStore(self.dirpath)
+
+    def tearDown(self):
+        self.ds.close()
+        shutil.rmtree(self.dirpath)
+
+    def test_flush_and_get(self):
+        t = self.ds.table('T', mem_table_cap=500, compaction=None)
+
+        for i in range(5050):
+            t.set((i, str(i)), {'i': i})
+
+        t.delete((5, '5'))
+        t.flush()
+
+        self.assertEqual(len(t.file_tables), 11)
+        self.assertEqual(t.get((7, '7')), {'i': 7})
+        self.assertEqual(t.get((5049, '5049')), {'i': 5049})
+        self.assertRaises(KeyError, t.get, (5, '5'))
+        self.assertRaises(KeyError, t.get, (9000, '9000'))
+
+        file_table = t.file_tables[-1]
+        self.assertGreater(file_table.block_count, 1)
+        keys = [decode_key(k) for k, v in file_table.iter_range(encode_key((10,)), encode_key((90,)))]
+        self.assertEqual(keys, [(i, str(i)) for i in range(10, 90)])
+
+    def test_mmap_blocks(self):
+        t = self.ds.table('T', mem_table_cap=1000)
+
+        for i in range(1000):
+            t.set(i, {'i': i})
+
+        t.flush()
+        file_table = t.file_tables[0]
+        self.assertIsInstance(file_table.read_block(0), memoryview)
+        key, flag, value = next(file_table.iter_block(0))
+        self.assertIsInstance(value, memoryview)
+        self.assertEqual(file_table.get(encode_key((999,))), {'i': 999})
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter.for_keys(1000, bits_per_key=10)
+
+        for i in range(1000):
+            bloom.add('key{}'.format(i).encode())
+
+        for i in range(1000):
+            self.assertIn('key{}'.format(i).encode(), bloom)
+
+        false_positives = sum(
+            'other{}'.format(i).encode() in bloom
+            for i in range(10000)
+        )
+
+        self.assertLess(false_positives, 300)
+
+        t = self.ds.table('T', mem_table_cap=100)
+
+        for i in range(200):
+            t.set(i, i)
+
+        t.flush()
+        file_table = t.file_tables[0]
+        self.assertTrue(os.path.exists(file_table.bloom_path(file_table.path)))
+        self.assertIsNotNone(file_table.bloom)
+        self.assertEqual(t.get(150), 150)
+        self.assertRaises(KeyError, t.get, 1000)
+
+    def test_reopen(self):
+        t = self.ds.table('T', mem_table_cap=100)
+
+        for i in range(250):
+            t.set(i, i * 2)
+
+        self.ds.close()
+        self.ds = DataStore(self.dirpath)
+        t = self.ds.table('T', mem_table_cap=100)
+        self.assertEqual(t.get(3), 6)
+        self.assertEqual(t.get(249), 498)
+
+    def test_compression(self):
+        sizes = {}
+
+        for compression in [None] + sorted(datastore.COMPRESSION_CODECS):
+            name = 'T{}'.format(compression)
+            t = self.ds.table(name, mem_table_cap=2000, compression=compression, compaction=None).fields(
+                name=TextField(primary_key=True),
+                email=TextField(),
+                email_index=Index('email'),
+            )
+
+            for i in range(2000):
+                t.set('user{:05d}'.format(i), {'email': 'user{:05d}@example.com'.format(i % 50)})
+
+            t.flush()
+            file_table = t.file_tables[0]
+            sizes[compression] = file_table.size
+
+            # restart points: every key of a block is found by binary search
+            for i in range(0, 2000, 7):
+                key = 'user{:05d}'.format(i)
+                self.assertEqual(t.get(key), {'email': 'user{:05d}@example.com'.format(i % 50)})
+
+            self.assertRaises(KeyError, t.get, 'user00000a')
+            self.assertRaises(KeyError, t.get, 'a')
+            self.assertRaises(KeyError, t.get, 'z')
+            self.assertEqual(len(list(t.scan())), 2000)
+            self.assertEqual(len(list(t.find(email='user00007@example.com'))), 40)
+
+        for compression, size in sizes.items():
+            if compression is not None:
+                self.assertLess(size, sizes[None] / 2)
+
+        # setting applies to new files only, old blocks keep their codec
+        self.ds.close()
+        self.ds = DataStore(self.dirpath)
+        t = self.ds.table('Tzlib', compression=None)
+        self.assertEqual(t.get('user01999'), {'email': 'user00049@example.com'})
+        self.assertRaises(ValueError, self.ds.table, 'X', compression='rar')
+
+
+    def test_block_cache(self):
+        self.ds.close()
+        self.ds = DataStore(self.dirpath, block_cache_bytes=64 << 10)
+        cache = self.ds.block_cache
+        t = self.ds.table('T', mem_table_cap=1000, compaction=None, compression='zlib')
+
+        for i in range(5000):
+            t.set(i, {'i': i, 'text': 'some text {}'.format(i)})
+
+        t.flush()
+
+        # hot keys are served from cache
+        for n in range(20):
+            for i in range(0, 100, 10):
+                self.assertEqual(t.get(i)['i'], i)
+
+        stats = cache.stats()
+        self.assertGreater(stats['hits'], stats['misses'] * 10)
+        self.assertEqual(stats['evictions'], 0)
+
+        # scans do not fill cache, point reads of everything evict
+        list(t.scan())
+        self.assertEqual(cache.stats()['blocks'], stats['blocks'])
+
+        for i in range(5000):
+            t.get(i)
+
+        self.assertGreater(cache.evictions, 0)
+        self.assertLessEqual(cache.size, cache.capacity)
+
+        # closed files leave cache
+        self.ds.close()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+
+        # cache can be turned off
+        self.ds = DataStore(self.dirpath, block_cache_bytes=0)
+        t = self.ds.table('T')
+        self.assertIsNone(self.ds.block_cache)
+        self.assertEqual(t.get(4999)['i'], 4999)
+
+
+    def test_get_many(self):
+        t = self.ds.table('T', mem_table_cap=500, compaction=None, row_cache_size=100)
+        expected = {}
+
+        for i in range(0, 3000, 2):
+            t.set(i, {'i': i})
+            expected[i] = {'i': i}
+
+        for i in range(0, 3000, 10):
+            t.delete(i)
+            del expected[i]
+
+        for i in range(0, 3000, 6):
+            t.set(i, {'i': -i})
+            expected[i] = {'i': -i}
+
+        t.flush()
+        t.set(3, {'i': 3})
+        expected[3] = {'i': 3}
+        t.delete(4)
+        del expected[4]
+
+        rnd = random.Random(17)
+        keys = [rnd.randrange(-10, 3010) for i in range(2000)] + [3, 3, 4]
+        self.assertEqual(t.get_many(keys), [expected.get(k) for k in keys])
+        self.assertEqual(t.get_many(keys[:50], default=False), [expected.get(k, False) for k in keys[:50]])
+        self.assertEqual(t.get_many([]), [])
+
+        # every block is loaded once per file
+        cache = self.ds.block_cache
+        keys = list(range(0, 3000, 2))
+        cache.discard_file(t.file_tables[0].id)
+        misses = cache.misses
+        t.get_many(keys)
+        self.assertLessEqual(cache.misses - misses, sum(f.block_count for f in t.file_tables))
+
+
+class TestRowCache(unittest.TestCase):
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        self.ds = DataStore(self.dirpath)
+
+    def tearDown(self):
+        self.ds.close()
+        shutil.rmtree(self.dirpath)
+
+    def test_hits_and_invalidation(self):
+        t = self.ds.table('T', mem_table_cap=100, row_cache_size=50)
+        cache = t.row_cache
+
+        for i in range(300):
+            t.set(i, {'i': i})
+
+        t.flush()
+
+        for n in range(10):
+            for i in range(20):
+                self.assertEqual(t.get(i), {'i': i})
+
+        self.assertEqual(cache.misses, 20)
+        self.assertEqual(cache.hits, 180)
+
+        t.set(5, {'i': -5})
+        self.assertEqual(t.get(5), {'i': -5})
+        t.delete(6)
+        self.assertRaises(KeyError, t.get, 6)
+        self.assertRaises(KeyError, t.get, 6)
+
+        for i in range(300):
+            if i != 6:
+                t.get(i)
+
+        self.assertEqual(len(cache), 50)
+        self.assertGreater(cache.evictions, 0)
+
+    def test_none_value(self):
+        t = self.ds.table('T', row_cache_size=10)
+        t.set(1, None)
+        self.assertIsNone(t.get(1))
+        self.assertIsNone(t.get(1))
+        self.assertEqual(t.get_many([1, 2], default=0), [None, 0])
+        stats = t.row_cache.stats()
+        self.assertEqual((stats['misses'], stats['hits'], stats['rows']), (2, 2, 1))
+
+    def test_concurrent_writes(self):
+        # readers never see a value older than one already written
+        t = self.ds.table('T', mem_table_cap=200, row_cache_size=10)
+        t.set('k', {'n': 0})
+        stop = threading.Event()
+        errors = []
+
+        def read():
+            while not stop.is_set():
+                floor = last[0]
+                n = t.get('k')['n']
+
+                if n < floor:
+                    errors.append((n, floor))
+
+        last = [0]
+        readers = [threading.Thread(target=read) for i in range(3)]
+
+        for th in readers:
+            th.start()
+
+        for n in range(1, 2000):
+            t.set('k', {'n': n})
+            last[0] = n
+
+        stop.set()
+
+        for th in readers:
+            th.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(t.get('k'), {'n': 1999})
+
+
+class TestBackgroundFlush(unittest.TestCase):
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        self.ds = DataStore(self.dirpath)
+
+    def tearDown(self):
+        self.ds.close()
+        shutil.rmtree(self.dirpath)
+
+    def test_reads_during_flush(self):
+        t = self.ds.table('T', mem_table_cap=100, max_immutable_mem_tables=1, compaction=None)
+        release = threading.Event()
+        flush_mem_table = t._flush_mem_table
+
+        def slow_flush_mem_table(mem_table):
+            release.wait()
+            flush_mem_table(mem_table)
+
+        t._flush_mem_table = slow_flush_mem_table
+
+        def write():
+            for i in range(350):
+                t.set(i, i)
+
+        writer = threading.Thread(target=write)
+        writer.start()
+
+        try:
+            writer.join(0.2)
+
+            # first memtable is being flushed, second one waits in queue,
+            # writer is blocked queueing the third
+            self.assertTrue(writer.is_alive())
+            self.assertEqual(len(t.immutable_mem_tables), 3)
+            self.assertEqual(t.get(0), 0)
+            self.assertEqual(t.get(150), 150)
+            self.assertEqual(t.get(299), 299)
+        finally:
+            release.set()
+            writer.join()
+
+        t.flush()
+
+        self.assertEqual(len(t.immutable_mem_tables), 0)
+        self.assertEqual(len(t.file_tables), 4)
+
+        for i in range(350):
+            self.assertEqual(t.get(i), i)
+
+    def test_synchronous_flush(self):
+        t = self.ds.table('T', mem_table_cap=100, background_flush=False)
+
+        for i in range(250):
+            t.set(i, i)
+
+        self.assertEqual(len(t.file_tables), 2)
+        self.assertEqual(len(t.immutable_mem_tables), 0)
+        self.assertEqual(t.get(249), 249)
+
+
+class TestWriteAheadLog(unittest.TestCase):
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        self.ds = DataStore(self.dirpath)
+
+    def tearDown(self):
+        self.ds.close()
+        shutil.rmtree(self.dirpath)
+
+    def test_recovery(self):
+        t = self.ds.table('T', mem_table_cap=100)
+
+        for i in range(150):
+            t.set(i, i)
+
+        t.delete(3)
+        t.delete(120)
+        t.flush_queue.join()
+        wal_path = t.mem_table.wal.path
+
+        # crash: table is never closed, torn record at the end of log
+        with open(wal_path, 'ab') as f:
+            f.write(b'\x10\x00\x00\x00garbage')
+
+        self.ds = DataStore(self.dirpath)
+
+        with warnings.catch_warnings(record=True):
+            t = self.ds.table('T', mem_table_cap=100)
+
+        self.assertFalse(os.path.exists(wal_path))
+        self.assertEqual(t.get(0), 0)
+        self.assertEqual(t.get(149), 149)
+        self.assertRaises(KeyError, t.get, 3)
+        self.assertRaises(KeyError, t.get, 120)
+
+    def test_group_commit(self):
+        t = self.ds.table('T', wal_sync='always')
+        release = threading.Event()
+        calls = []
+
+        def slow_fsync(fd):
+            calls.append(fd)
+            release.wait()
+
+        fsync = datastore.fsync
+        datastore.fsync = slow_fsync
+
+        try:
+            writers = [
+                threading.Thread(target=t.set, args=(i, i))
+                for i in range(5)
+            ]
+
+            # first writer becomes leader and blocks in fsync, others queue
+            writers[0].start()
+
+            while not calls:
+                time.sleep(0.001)
+
+            for w in writers[1:]:
+                w.start()
+
+            while len(t.pending_writes) < 5:
+                time.sleep(0.001)
+
+            release.set()
+
+            for w in writers:
+                w.join()
+        finally:
+            datastore.fsync = fsync
+
+        self.assertEqual(len(calls), 2)
+
+        for i in range(5):
+            self.assertEqual(t.get(i), i)
+
+    def test_group_commit_invalid_value(self):
+        # value that can not be encoded fails its writer only
+        t = self.ds.table('T', wal_sync='always')
+        release = threading.Event()
+        calls = []
+        errors = {}
+
+        def slow_fsync(fd):
+            calls.append(fd)
+            release.wait()
+
+        def write(key, value):
+            try:
+                t.set(key, value)
+            except Exception as e:
+                errors[key] = e
+
+        fsync = datastore.fsync
+        datastore.fsync = slow_fsync
+
+        try:
+            leader = threading.Thread(target=write, args=(0, {'a': 0}))
+            leader.start()
+
+            while not calls:
+                time.sleep(0.001)
+
+            writers = [
+                threading.Thread(target=write, args=(1, {'a': 1})),
+                threading.Thread(target=write, args=(2, {'a': {1, 2}})),
+            ]
+
+            for w in writers:
+                w.start()
+
+            writers[1].join(1)
+
+            while len(t.pending_writes) < 2:
+                time.sleep(0.001)
+
+            release.set()
+
+            for w in [leader] + writers:
+                w.join()
+        finally:
+            datastore.fsync = fsync
+
+        self.assertEqual(list(errors), [2])
+        self.assertIsInstance(errors[2], TypeError)
+        self.assertEqual(t.get(1), {'a': 1})
+        self.assertRaises(KeyError, t.get, 2)
+
+    def test_flush_error(self):
+        # failed flush is retried until it succeeds; writes and flush fail
+        # meanwhile, before anything is logged
+        failing = [True]
+        run = datastore.FlushJob.run
+
+        def failing_run(job):
+            if failing[0]:
+                raise OSError('disk full')
+
+            return run(job)
+
+        retry_seconds = datastore.FLUSH_RETRY_SECONDS
+        datastore.FlushJob.run = failing_run
+        datastore.FLUSH_RETRY_SECONDS = 0.01
+
+        try:
+            for background_flush in (True, False):
+                t = self.ds.table('T{}'.format(background_flush), mem_table_cap=10,
+                                  background_flush=background_flush)
+                failing[0] = True
+
+                for i in range(10):
+                    t.set(i, i)
+
+                while t.flush_error is None:
+                    time.sleep(0.001)
+
+                self.assertRaises(OSError, t.set, 100, 100)
+                self.assertRaises(KeyError, t.get, 100)
+                self.assertRaises(OSError, t.flush)
+                self.assertEqual(len(t.immutable_mem_tables), 1)
+
+                failing[0] = False
+
+                while background_flush and t.flush_error is not None:
+                    time.sleep(0.001)
+
+                t.set(100, 100)
+                t.flush()
+                self.assertEqual(t.immutable_mem_tables, [])
+                self.assertEqual([v for k, v in t.scan()], list(range(10)) + [100])
+        finally:
+            datastore.FlushJob.run = run
+            datastore.FLUSH_RETRY_SECONDS = retry_seconds
+
+
+    def test_write_batch(self):
+        users = self.ds.table('User', mem_table_cap=100)
+        emails = self.ds.table('Email', mem_table_cap=100)
+        users.set_many(('u{}'.format(i), {'i': i}) for i in range(250))
+        self.assertEqual(len(users.immutable_mem_tables) + len(users.file_tables), 2)
+        self.assertEqual(users.get('u249'), {'i': 249})
+
+        batch = datastore.WriteBatch()
+
+        for i in range(10):
+            batch.set(users, 'v{}'.format(i), {'i': i})
+            batch.set(emails, 'v{}@x.com'.format(i), 'v{}'.format(i))
+
+        batch.delete(users, 'u0')
+        self.assertEqual(len(batch), 21)
+        self.ds.write(batch)
+        self.assertEqual(len(batch), 0)
+        self.assertEqual(users.get('v9'), {'i': 9})
+        self.assertEqual(emails.get('v9@x.com'), 'v9')
+        self.assertRaises(KeyError, users.get, 'u0')
+
+        # crash in the middle of logging a batch: none of it is recovered
+        batch = datastore.WriteBatch()
+
+        for i in range(10):
+            batch.set(users, 'w{}'.format(i), {'i': i})
+
+        self.ds.write(batch)
+        users.flush_queue.join()
+        wal_path = users.mem_table.wal.path
+        users.mem_table.wal.sync()
+
+        with open(wal_path, 'rb+') as f:
+            f.truncate(os.path.getsize(wal_path) - 5)
+
+        self.ds = DataStore(self.dirpath)
+
+        with warnings.catch_warnings(record=True):
+            users = self.ds.table('User', mem_table_cap=100)
+
+        self.assertEqual(users.get('v3'), {'i': 3})
+
+        for i in range(10):
+            self.assertRaises(KeyError, users.get, 'w{}'.format(i))
+
+    def test_write_batch_atomic(self):
+        users = self.ds.table('User', mem_table_cap=100)
+        emails = self.ds.table('Email', mem_table_cap=100)
+
+        # invalid value: nothing written, batch kept
+        batch = datastore.WriteBatch()
+        batch.set(users, 'u0', {'i': 0})
+        batch.set(emails, 'u0@x.com', object())
+        self.assertRaises(TypeError, self.ds.write, batch)
+        self.assertEqual(len(batch), 2)
+        self.assertRaises(KeyError, users.get, 'u0')
+
+        # snapshot sees both parts of a batch or neither
+        def write():
+            for i in range(300):
+                batch = datastore.WriteBatch()
+                batch.set(users, 'u{}'.format(i), {'i': i})
+                batch.set(emails, 'u{}@x.com'.format(i), 'u{}'.format(i))
+                self.ds.write(batch)
+
+        writer = threading.Thread(target=write)
+        writer.start()
+
+        try:
+            while writer.is_alive():
+                with self.ds.snapshot() as snapshot:
+                    n_users = len(list(users.scan(snapshot=snapshot)))
+                    n_emails = len(list(emails.scan(snapshot=snapshot)))
+                    self.assertEqual(n_users, n_emails)
+        finally:
+            writer.join()
+
+        self.assertEqual(users.get('u299'), {'i': 299})
+        self.assertEqual(emails.get('u299@x.com'), 'u299')
+
+    def test_write_batch_recovery(self):
+        users = self.ds.table('User', mem_table_cap=100)
+        emails = self.ds.table('Email', mem_table_cap=100)
+
+        batch = datastore.WriteBatch()
+        batch.set(users, 'u0', {'i': 0})
+        batch.set(emails, 'u0@x.com', 'u0')
+        self.ds.write(batch)
+
+        # second part fails to log after first one is in its wal
+        def failing_write(payloads):
+            raise OSError('disk full')
+
+        batch = datastore.WriteBatch()
+        batch.set(users, 'u1', {'i': 1})
+        batch.set(emails, 'u1@x.com', 'u1')
+        users.mem_table.wal.write = failing_write
+        self.assertRaises(OSError, self.ds.write, batch)
+        self.assertRaises(KeyError, emails.get, 'u1@x.com')
+
+        # crash: nothing is closed, committed batch is recovered, the
+        # part of failed one is not
+        self.ds = DataStore(self.dirpath)
+
+        with warnings.catch_warnings(record=True):
+            users = self.ds.table('User', mem_table_cap=100)
+            emails = self.ds.table('Email', mem_table_cap=100)
+
+        self.assertEqual(users.get('u0'), {'i': 0})
+        self.assertEqual(emails.get('u0@x.com'), 'u0')
+        self.assertRaises(KeyError, users.get, 'u1')
+        self.assertRaises(KeyError, emails.get, 'u1@x.com')
+
+        # commits are dropped with their wals
+        users.flush()
+        emails.flush()
+        self.assertEqual(self.ds.manifest.table('User')['batches'], {})
+        self.assertEqual(self.ds.manifest.table('Email')['batches'], {})
+
+    def test_close_table(self):
+        t = self.ds.table('T', mem_table_cap=100)
+        t.set(1, 1)
+        t.close()
+        t.close()
+        self.assertEqual(self.ds.tables, {})
+
+        with self.ds.snapshot() as snapshot:
+            self.assertEqual(snapshot.views, {})
+
+        self.ds.close()
+        self.ds = DataStore(self.dirpath)
+        self.assertEqual(self.ds.table('T').get(1), 1)
+
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        self.ds = DataStore(self.dirpath)
+
+    def tearDown(self):
+        self.ds.close()
+        shutil.rmtree(self.dirpath)
+
+    def test_reopen_without_scan(self):
+        t = self.ds.table('T', mem_table_cap=100, compaction=None)
+        u = self.ds.table('U', mem_table_cap=100)
+
+        for i in range(1000):
+            t.set(i, i)
+            u.set(i, -i)
+
+        t.flush()
+        t.compact()
+        files = sorted((f.no, f.level, f.min_key, f.max_key) for f in t.file_tables)
+
+        # orphan left by a crash before its manifest edit
+        shutil.copy(t.file_tables[0].path, os.path.join(self.dirpath, 'T.999999.data'))
+        self.ds.close()
+
+        scandir = os.scandir
+
+        def no_scandir(path):
+            raise AssertionError('directory scanned')
+
+        os.scandir = no_scandir
+
+        try:
+            self.ds = DataStore(self.dirpath)
+            t = self.ds.table('T', mem_table_cap=100, compaction=None)
+            u = self.ds.table('U', mem_table_cap=100)
+        finally:
+            os.scandir = scandir
+
+        self.assertEqual(sorted((f.no, f.level, f.min_key, f.max_key) for f in t.file_tables), files)
+        self.assertEqual([v for k, v in t.scan()], list(range(1000)))
+        self.assertEqual(u.get(999), -999)
+
+        # file numbers are never reused
+        self.assertGreater(t.next_file_no, max(no for no, level, min_key, max_key in files))
+
+    def test_compaction_and_rewrite(self):
+        max_bytes = datastore.MANIFEST_MAX_BYTES
+        datastore.MANIFEST_MAX_BYTES = 4000
+
+        try:
+            t = self.ds.table('T', mem_table_cap=20)
+
+            for i in range(2000):
+                t.set(i % 300, i)
+
+            t.flush()
+            t.compact()
+            self.assertLess(os.path.getsize(self.ds.manifest.path), 8000)
+        finally:
+            datastore.MANIFEST_MAX_BYTES = max_bytes
+
+        live = set(f.no for f in t.file_tables)
+        self.assertEqual(set(self.ds.manifest.table('T')['files']), live)
+
+        self.ds.close()
+        self.ds = DataStore(self.dirpath)
+        t = self.ds.table('T')
+        self.assertEqual(set(f.no for f in t.file_tables), live)
+        self.assertEqual(t.get(299), 1799)
+
+    def test_datastore_without_manifest(self):
+        t = self.ds.table('T', mem_table_cap=100)
+
+        for i in range(250):
+            t.set(i, i)
+
+        self.ds.close()
+        os.remove(os.path.join(self.dirpath, 'MANIFEST'))
+        self.ds = DataStore(self.dirpath)
+        t = self.ds.table('T', mem_table_cap=100)
+        self.assertEqual(t.get(249), 249)
+        self.assertEqual(len(self.ds.manifest.table('T')['files']), len(t.file_tables))
+
+
+class TestScan(unittest.TestCase):
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        self.ds = DataStore(self.dirpath)
+
+    def tearDown(self):
+        self.ds.close()
+        shutil.rmtree(self.dirpath)
+
+    def test_scan(self):
+        t = self.ds.table('T', mem_table_cap=100, compaction=None)
+        expected = {}
+
+        # versions of same keys spread over files and memtable
+        for v in range(3):
+            for i in range(v, 500, 2):
+                t.set((i, 'k'), v)
+                expected[(i, 'k')] = v
+
+        for i in range(0, 500, 5):
+            t.delete((i, 'k'))
+            expected.pop((i, 'k'), None)
+
+        self.assertGreater(len(t.file_tables), 1)
+        self.assertGreater(len(t.mem_table), 0)
+
+        items = sorted(expected.items())
+        self.assertEqual(list(t.scan()), items)
+        self.assertEqual(list(t.scan(reverse=True)), items[::-1])
+
+        ranged = [(k, v) for k, v in items if (100,) <= k < (200,)]
+        self.assertEqual(list(t.scan((100,), (200,))), ranged)
+        self.assertEqual(list(t.scan((100,), (200,), reverse=True)), ranged[::-1])
+        self.assertEqual(list(t.scan((100,), limit=3)), ranged[:3])
+
+    def test_scan_while_writing(self):
+        t = self.ds.table('T', mem_table_cap=10000)
+
+        for i in range(0, 1000, 2):
+            t.set(i, i)
+
+        seen = []
+
+        for key, value in t.scan():
+            seen.append(key[0])
+
+            # writes land in memtable chunks being iterated
+            t.set(key[0] - 1, value)
+
+        self.assertEqual(seen, list(range(0, 1000, 2)))
+
+
+    def test_pruning(self):
+        t = self.ds.table('Event', mem_table_cap=100, compaction=None).fields(
+            created=DateTimeField(primary_key=True),
+            n=IntField(),
+            tag=TextField(),
+        )
+
+        t0 = datetime.datetime(2020, 1, 1)
+
+        for i in range(1000):
+            t.set(t0 + datetime.timedelta(minutes=i), {'n': i, 'tag': 't{}'.format(i % 3)})
+
+        t.flush()
+        self.assertEqual(len(t.file_tables), 10)
+        f = t.file_tables[0]
+        self.assertEqual(f.max_key, encode_key((t0 + datetime.timedelta(minutes=999),)))
+        self.assertEqual(set(f.column_ranges), {'n', 'tag'})
+
+        reads = []
+        iter_records = datastore.SSTable.iter_records
+
+        def counting_iter_records(file_table, *args, **kwargs):
+            reads.append(file_table)
+            return iter_records(file_table, *args, **kwargs)
+
+        datastore.SSTable.iter_records = counting_iter_records
+
+        try:
+            # key range: one file
+            start = t0 + datetime.timedelta(minutes=510)
+            rows = list(t.scan(start, start + datetime.timedelta(minutes=5)))
+            self.assertEqual([d['n'] for k, d in rows], list(range(510, 515)))
+            self.assertEqual(len(reads), 1)
+
+            # zone map of n: two files
+            del reads[:]
+            q = (Term('n') >= 850) & (Term('n') < 1050)
+            self.assertEqual([d['n'] for k, d in t.execute(q)], list(range(850, 1000)))
+            self.assertEqual(len(reads), 2)
+        finally:
+            datastore.SSTable.iter_records = iter_records
+
+        # rows moved out of range by newer version in a pruned file are gone
+        t.set(t0, {'n': 5000, 'tag': 'x'})
+        t.delete(t0 + datetime.timedelta(minutes=1))
+        t.flush()
+        self.assertEqual([d['n'] for k, d in t.execute(Term('n') < 4)], [2, 3])
+        self.assertEqual([d['n'] for k, d in t.execute(Term('n') > 4000)], [5000])
+        self.assertEqual(len(list(t.execute(Term('tag') == 't1'))), 332)
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        self.ds = DataStore(self.dirpath)
+
+    def tearDown(self):
+        self.ds.close()
+        shutil.rmtree(self.dirpath)
+
+    def test_consistent_reads(self):
+        t = self.ds.table('User', mem_table_cap=100, compaction=None).fields(
+            username=TextField(primary_key=True),
+            dob=TextField(),
+            dob_index=Index('dob'),
+        )
+
+        expected = {}
+
+        for i in range(250):
+            username = 'user{:04d}'.format(i)
+            doc = {'username': username, 'dob': str(1980 + i % 10)}
+            t.set(username, doc)
+            expected[(username,)] = doc
+
+        s = self.ds.snapshot()
+        items = sorted(expected.items())
+
+        # overwrites and deletes of rows in files and in pinned memtable,
+        # new rows, then everything flushed and compacted away
+        for i in range(0, 300, 2):
+            username = 'user{:04d}'.format(i)
+            t.set(username, {'username': username, 'dob': '2000'})
+
+        for i in range(0, 250, 5):
+            t.delete('user{:04d}'.format(i))
+
+        t.flush()
+        t.compact(full=True)
+        self.assertEqual(len(t.file_tables), 1)
+
+        self.assertEqual(list(t.scan(snapshot=s)), items)
+        self.assertEqual(list(t.scan(reverse=True, snapshot=s)), items[::-1])
+        self.assertEqual(t.get('user0010', snapshot=s), expected[('user0010',)])
+        self.assertRaises(KeyError, t.get, 'user0260', snapshot=s)
+        self.assertEqual(t.get('user0012'), {'username': 'user0012', 'dob': '2000'})
+        self.assertRaises(KeyError, t.get, 'user0010')
+
+        keys = ['user0000', 'user0001', 'user0260']
+        self.assertEqual(t.get_many(keys, snapshot=s), [expected[('user0000',)], expected[('user0001',)], None])
+
+        for dob in ('1984', '2000'):
+            rows = sorted((k, d) for k, d in expected.items() if d['dob'] == dob)
+            self.assertEqual(list(t.execute(Term('dob', dob), snapshot=s)), rows)
+
+        self.assertEqual(len(list(t.execute(Term('dob', '2000')))), 150 - 25)
+
+        s.release()
+        self.assertEqual(self.ds.snapshots, [])
+        self.assertRaises(ValueError, t.get, 'user0010', snapshot=s)
+
+    def test_memtable_versions(self):
+        t = self.ds.table('T', mem_table_cap=1000)
+        t.set(1, 'a')
+
+        with self.ds.snapshot() as s1:
+            t.set(1, 'b')
+            t.set(1, 'c')
+
+            with self.ds.snapshot() as s2:
+                t.set(1, 'd')
+                t.delete(2)
+                t.set(3, 'x')
+
+                self.assertEqual(t.get(1, snapshot=s1), 'a')
+                self.assertEqual(t.get(1, snapshot=s2), 'c')
+                self.assertEqual(list(t.scan(snapshot=s2)), [((1,), 'c')])
+                self.assertEqual(list(t.scan()), [((1,), 'd'), ((3,), 'x')])
+
+            # only versions some snapshot can see are kept
+            self.assertEqual(t.mem_table.history[encode_key((1,))], [(3, 'c'), (1, 'a')])
+
+
+class TestConcurrency(unittest.TestCase):
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        self.ds = DataStore(self.dirpath)
+
+    def tearDown(self):
+        self.ds.close()
+        shutil.rmtree(self.dirpath)
+
+    def test_stress(self):
+        # writers, point readers and scanners on one table while small
+        # memtables keep flushing and compacting underneath them
+        # memtables big enough to split chunks of their sorted keys
+        t = self.ds.table('T', mem_table_cap=1500, wal_sync=datastore.WAL_SYNC_NONE)
+        n_keys = 3000
+        errors = []
+        reads = []
+        stop = threading.Event()
+
+        def guarded(func):
+            def run(*args):
+                try:
+                    func(*args)
+                except Exception as e:
+                    errors.append(e)
+
+            return run
+
+        @guarded
+        def write(w):
+            for n in range(1, 5):
+                for i in range(w, n_keys, 2):
+                    t.set(i, {'k': i, 'n': n})
+
+                if n == 3:
+                    for i in range(w, n_keys, 14):
+                        t.delete(i)
+
+        @guarded
+        def get():
+            rng = random.Random()
+            seen = {}
+            n = 0
+
+            while not stop.is_set():
+                i = rng.randrange(n_keys)
+
+                try:
+                    doc = t.get(i)
+                except KeyError:
+                    continue
+                finally:
+                    n += 1
+
+                # versions of a key never go back
+                if doc['k'] != i or doc['n'] < seen.get(i, 0):
+                    errors.append((i, doc, seen.get(i)))
+
+                seen[i] = doc['n']
+
+            reads.append(n)
+
+        @guarded
+        def scan():
+            while not stop.is_set():
+                with self.ds.snapshot() as s:
+                    rows = list(t.scan(snapshot=s))
+                    keys = [k for k, doc in rows]
+
+                    if keys != sorted(set(keys)) or any(doc['k'] != k[0] for k, doc in rows):
+                        errors.append(keys)
+
+                    if list(t.scan(snapshot=s)) != rows:
+                        errors.append('snapshot changed')
+
+        # switch threads often, so races show up
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-5)
+        self.addCleanup(sys.setswitchinterval, interval)
+
+        writers = [threading.Thread(target=write, args=(w,)) for w in range(2)]
+        readers = [threading.Thread(target=get) for i in range(4)]
+        readers += [threading.Thread(target=scan) for i in range(2)]
+
+        for th in writers + readers:
+            th.start()
+
+        for th in writers:
+            th.join()
+
+        stop.set()
+
+        for th in readers:
+            th.join()
+
+        self.assertEqual(errors, [])
+        self.assertTrue(all(reads))
+        self.assertGreater(len(t.file_tables), 0)
+
+        # rows deleted in round 3 were written again in round 4
+        expected = [((i,), {'k': i, 'n': 4}) for i in range(n_keys)]
+        self.assertEqual(list(t.scan()), expected)
+        self.assertEqual([t.get(i) for i in range(0, n_keys, 50)], [doc for k, doc in expected[::50]])
+
+
+class TestAsync(unittest.TestCase):
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirpath)
+
+    def test_async_table(self):
+        async def main():
+            ads = AsyncDataStore(self.dirpath, max_workers=4)
+            t = await ads.table('T', mem_table_cap=100)
+            await t.set_many((i, {'n': i}) for i in range(500))
+            await t.delete(7)
+
+            # gets of one tick are one get_many; invalid key fails alone
+            calls = []
+            get_many = t.table.get_many
+
+            def counted(keys, *args):
+                calls.append(len(keys))
+                return get_many(keys, *args)
+
+            t.table.get_many = counted
+            results = await asyncio.gather(
+                *[t.get(i) for i in range(0, 500, 5)],
+                t.get(7),
+                t.get(object()),
+                return_exceptions=True,
+            )
+
+            self.assertEqual(calls, [101])
+            self.assertEqual(results[:100], [{'n': i} for i in range(0, 500, 5)])
+            self.assertIsInstance(results[100], KeyError)
+            self.assertIsInstance(results[101], TypeError)
+
+            with self.assertRaises(KeyError):
+                await t.get(7)
+
+            rows = [row async for row in t.scan((100,), (300,), batch_size=64)]
+            self.assertEqual(rows, [((i,), {'n': i}) for i in range(100, 300)])
+
+            rows = []
+
+            async for key, doc in t.execute(Term('n') >= 490, batch_size=4):
+                rows.append(key)
+
+                if len(rows) == 5:
+                    break
+
+            self.assertEqual(rows, [(i,) for i in range(490, 495)])
+
+            with ads.snapshot() as s:
+                await t.set(1, {'n': -1})
+                self.assertEqual(await t.get(1, snapshot=s), {'n': 1})
+                self.assertEqual(await t.get(1), {'n': -1})
+
+            # cancelled while a batch is read in executor
+            scan = t.table.scan
+            started = threading.Event()
+
+            def slow_scan(*args, **kwargs):
+                for row in scan(*args, **kwargs):
+                    started.set()
+                    time.sleep(0.01)
+                    yield row
+
+            async def consume():
+                async for row in t.scan(batch_size=16):
+                    pass
+
+            t.table.scan = slow_scan
+            task = asyncio.ensure_future(consume())
+
+            while not started.is_set():
+                await asyncio.sleep(0.001)
+
+            task.cancel()
+
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+            await ads.close()
+
+        asyncio.run(main())
+
+
+class TestParallelScan(unittest.TestCase):
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.ds.close()
+        shutil.rmtree(self.dirpath)
+
+    def fill(self, process_workers):
+        self.ds = DataStore(self.dirpath, process_workers=process_workers)
+
+        t = self.ds.table('User', mem_table_cap=100, compaction=None).fields(
+            id=IntField(primary_key=True),
+            last_name=TextField(),
+            age=IntField(),
+        )
+
+        last_names = ['Tasic', 'Milosevic', 'Colic']
+        docs = {}
+
+        # rows in files and memtables, overwritten and deleted
+        for v in range(2):
+            for i in range(v, 1000, 2 - v):
+                doc = {'id': i, 'last_name': last_names[i % 3], 'age': i % 50 + v}
+                t.set(i, doc)
+                docs[(i,)] = doc
+
+        for i in range(0, 1000, 9):
+            t.delete(i)
+            del docs[(i,)]
+
+        self.assertGreater(len(t.file_tables), 3)
+        self.assertGreater(len(t.mem_table), 0)
+        return t, docs
+
+    def check(self, t, docs, workers):
+        rows = sorted(docs.items())
+        self.assertEqual(list(t.parallel_scan(workers=workers)), rows)
+
+        old = Term('age') >= 40
+        expected = [(k, {'age': d['age']}) for k, d in rows if d['age'] >= 40]
+        self.assertEqual(list(t.parallel_scan(old, columns=['age'], workers=workers)), expected)
+
+        self.assertEqual(t.aggregate('count', workers=workers), len(docs))
+        self.assertEqual(t.aggregate('sum', 'age', workers=workers), sum(d['age'] for d in docs.values()))
+        self.assertEqual(t.aggregate('max', 'id', predicate=old, workers=workers), max(k[0] for k, d in expected))
+        self.assertIsNone(t.aggregate('min', 'age', predicate=Term('age') > 100))
+
+        counts = {}
+
+        for d in docs.values():
+            counts[d['last_name']] = counts.get(d['last_name'], 0) + 1
+
+        self.assertEqual(t.aggregate('count', group_by='last_name', workers=workers), counts)
+        self.assertRaises(ValueError, t.aggregate, 'avg', 'age')
+        self.assertRaises(ValueError, t.aggregate, 'count', group_by='first_name')
+
+        # more workers than the datastore has processes
+        self.assertRaises(ValueError, t.aggregate, 'count', workers=4)
+
+    def test_process_workers(self):
+        t, docs = self.fill(process_workers=3)
+        self.check(t, docs, 3)
+
+        # first partition is yielded before compaction can run again;
+        # abandoned scan does not keep compaction waiting
+        rows = t.parallel_scan(workers=3)
+        self.assertEqual(next(rows), sorted(docs.items())[0])
+        rows.close()
+        t.compact(full=True)
+        self.assertEqual(list(t.scan()), sorted(docs.items()))
+
+    def test_in_thread(self):
+        t, docs = self.fill(process_workers=0)
+        self.check(t, docs, None)
+        self.check(t, docs, 1)
+
+
+class TestIndex(unittest.TestCase):
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        self.ds = DataStore(self.dirpath)
+
+    def tearDown(self):
+        self.ds.close()
+        shutil.rmtree(self.dirpath)
+
+    def user_table(self, **kwargs):
+        return self.ds.table('User', mem_table_cap=100, **kwargs).fields(
+            username=TextField(primary_key=True),
+            email=TextField(),
+            dob=DateField(),
+            username_dob_index=Index('username', 'dob'),
+            dob_email_index=Index('dob', 'email'),
+        )
+
+    def fill(self, t):
+        docs = {}
+
+        for i in range(600):
+            username = 'user{:04d}'.format(i)
+            doc = {'username': username, 'email': 'u{}@x.com'.format(i % 50), 'dob': str(1980 + i % 20)}
+            t.set(username, doc)
+            docs[(username,)] = doc
+
+        # overwrite rows that already went to files, then delete some
+        for i in range(0, 600, 3):
+            username = 'user{:04d}'.format(i)
+            doc = {'username': username, 'email': 'new@x.com', 'dob': '2001'}
+            t.set(username, doc)
+            docs[(username,)] = doc
+
+        for i in range(0, 600, 10):
+            t.delete('user{:04d}'.format(i))
+            del docs[('user{:04d}'.format(i),)]
+
+        return docs
+
+    def check(self, t, docs):
+        for dob in ('1985', '2001'):
+            expected = sorted((k, d) for k, d in docs.items() if d['dob'] == dob)
+            self.assertEqual(sorted(t.find(dob=dob)), expected)
+
+        expected = sorted(
+            (k, d) for k, d in docs.items()
+            if d['dob'] == '1990' and d['email'] == 'u10@x.com'
+        )
+
+        self.assertEqual(list(t.find(dob='1990', email='u10@x.com')), expected)
+        self.assertEqual(list(t.find(username='user0007')), [(('user0007',), docs[('user0007',)])])
+
+    def test_index_maintenance(self):
+        t = self.user_table(compaction=None)
+        docs = self.fill(t)
+        self.assertGreater(len(t.file_tables), 2)
+
+        path = t.file_tables[0].index_path(t.file_tables[0].path, 'dob_email_index')
+        self.assertTrue(os.path.exists(path))
+        self.check(t, docs)
+
+        t.flush()
+        self.check(t, docs)
+
+        t.compact(full=True)
+        self.assertEqual(len(t.file_tables), 1)
+        self.check(t, docs)
+
+        # live rows only after compaction
+        file_index = t.file_tables[0].get_index('dob_email_index', ('dob', 'email'))
+        self.assertEqual(len(file_index), len(docs))
+
+    def test_missing_trailing_column(self):
+        # compound index is the only one on x, even rows do not have s
+        t = self.ds.table('T', mem_table_cap=5000, compaction=None).fields(
+            id=IntField(primary_key=True),
+            x=IntField(),
+            s=TextField(),
+            x_s_index=Index('x', 's'),
+        )
+
+        docs = {}
+
+        for i in range(20000):
+            doc = {'id': i, 'x': i % 1000}
+
+            if i % 2:
+                doc['s'] = 's{}'.format(i % 3)
+
+            t.set(i, doc)
+            docs[(i,)] = doc
+
+        expected = sorted((k, d) for k, d in docs.items() if d['x'] == 4)
+        self.assertEqual(len(expected), 20)
+
+        cost, stream = Term('x', 4).plan(t)
+        self.assertLess(cost, t.estimate_rows())
+        self.assertEqual([(key, doc) for raw_key, key, doc in stream()], expected)
+        self.assertEqual(sorted(t.find(x=4)), expected)
+
+        expected = sorted((k, d) for k, d in docs.items() if d['x'] < 3)
+        self.assertEqual(list(t.execute(Term('x') < 3)), expected)
+
+        expected = sorted((k, d) for k, d in docs.items() if d['x'] == 5 and d.get('s') == 's2')
+        self.assertEqual(list(t.find(x=5, s='s2')), expected)
+
+    def test_mixed_type_keys(self):
+        # int and text primary keys are ordered by their encoding
+        t = self.ds.table('T', mem_table_cap=5000, compaction=None).fields(
+            x=IntField(),
+            x_index=Index('x'),
+        )
+
+        docs = {}
+
+        for i in range(20000):
+            key = i if i % 2 else 'k{:05d}'.format(i)
+            doc = {'x': i % 1000}
+            t.set(key, doc)
+            docs[(key,)] = doc
+
+        def expected(predicate):
+            rows = [(k, d) for k, d in docs.items() if predicate(d)]
+            return sorted(rows, key=lambda row: encode_key(row[0]))
+
+        q = Term('x', 1) | Term('x', 2)
+        self.assertLess(q.plan(t)[0], t.estimate_rows())
+        self.assertEqual(list(t.execute(q)), expected(lambda d: d['x'] in (1, 2)))
+
+        q = Term('x') < 3
+        self.assertLess(q.plan(t)[0], t.estimate_rows())
+        self.assertEqual(list(t.execute(q)), expected(lambda d: d['x'] < 3))
+
+        q = Term('x', 1) ^ (Term('x') < 2)
+        self.assertEqual(list(t.execute(q)), expected(lambda d: d['x'] == 0))
+
+    def test_index_declared_later(self):
+        t = self.ds.table('User', mem_table_cap=100)
+
+        for i in range(250):
+            t.set('user{:04d}'.format(i), {'dob': str(1980 + i % 20), 'email': 'e'})
+
+        t.flush()
+        self.ds.close()
+
+        self.ds = DataStore(self.dirpath)
+        t = self.user_table()
+        rows = list(t.find(dob='1985'))
+        self.assertEqual(len(rows), len([i for i in range(250) if i % 20 == 5]))
+
+    def test_compact_files_without_index(self):
+        # indexes of compaction inputs are not built just to be removed
+        t = self.ds.table('User', mem_table_cap=100, compaction=None)
+
+        for i in range(250):
+            t.set('user{:04d}'.format(i), {'dob': str(1980 + i % 20), 'email': 'e'})
+
+        t.flush()
+        self.ds.close()
+
+        self.ds = DataStore(self.dirpath)
+        t = self.user_table(compaction=None)
+        self.assertEqual(len(t.file_tables), 3)
+        written = []
+        write = datastore.FileIndex.write
+
+        def counted(path, *args):
+            written.append(path)
+            return write(path, *args)
+
+        datastore.FileIndex.write = counted
+
+        try:
+            t.compact(full=True)
+        finally:
+            datastore.FileIndex.write = write
+
+        self.assertEqual(len(t.file_tables), 1)
+        self.assertEqual(len(written), 2)
+        self.assertEqual(len(list(t.find(dob='1985'))), len([i for i in range(250) if i % 20 == 5]))
+
+
+class TestQuery(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dirpath = tempfile.mkdtemp()
+        cls.ds = DataStore(cls.dirpath)
+
+        cls.t = cls.ds.table('User', mem_table_cap=500, compaction=None).fields(
+            username=TextField(primary_key=True),
+            email=TextField(),
+            dob=DateField(),
+            n=IntField(),
+            dob_index=Index('dob'),
+            dob_email_index=Index('dob', 'email'),
+        )
+
+        cls.docs = {}
+
+        for i in range(3000):
+            username = 'user{:05d}'.format(i)
+
+            doc = {
+                'username': username,
+                'email': 'u{}@x.com'.format(i % 7),
+                'dob': '19{:02d}0101'.format(50 + i % 40),
+                'n': i % 100,
+            }
+
+            cls.t.set(username, doc)
+            cls.docs[(username,)] = doc
+
+        for i in range(0, 3000, 11):
+            del cls.docs[('user{:05d}'.format(i),)]
+            cls.t.delete('user{:05d}'.format(i))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.ds.close()
+        shutil.rmtree(cls.dirpath)
+
+    def check(self, q, predicate):
+        expected = sorted((k, d) for k, d in self.docs.items() if predicate(d))
+        self.assertEqual(list(self.t.execute(q)), expected)
+
+    def test_terms(self):
+        self.check(Term('dob', '19650101'), lambda d: d['dob'] == '19650101')
+        self.check(Term('username', 'user00042'), lambda d: d['username'] == 'user00042')
+        self.check(Term('n') < 5, lambda d: d['n'] < 5)
+        self.check(Le(Term('dob', '19550101')), lambda d: d['dob'] <= '19550101')
+        self.check(Ge(Term('dob', '19850101')), lambda d: d['dob'] >= '19850101')
+        self.check(Term('username') >= 'user02900', lambda d: d['username'] >= 'user02900')
+
+    def test_operators(self):
+        dob = Term('dob')
+        q = ('19600101' <= dob) & (dob <= '19620101')
+        self.assertIsInstance(q, And)
+        self.check(q, lambda d: '19600101' <= d['dob'] <= '19620101')
+
+        q = Term('username', 'user00007') | (Term('n') > 97)
+        self.assertIsInstance(q, Or)
+        self.check(q, lambda d: d['username'] == 'user00007' or d['n'] > 97)
+
+        q = Term('dob', '19700101') - Term('email', 'u3@x.com')
+        self.assertIsInstance(q, Sub)
+        self.check(q, lambda d: d['dob'] == '19700101' and d['email'] != 'u3@x.com')
+
+        q = Term('dob', '19700101') ^ Term('email', 'u3@x.com')
+        self.assertIsInstance(q, Xor)
+        self.check(q, lambda d: (d['dob'] == '19700101') != (d['email'] == 'u3@x.com'))
+
+        q = Or(Term('username', 'user00001'), And(Le(Term('dob', '19520101')), Ge(Term('dob', '19510101'))))
+        self.check(q, lambda d: d['username'] == 'user00001' or '19510101' <= d['dob'] <= '19520101')
+
+        with self.assertRaises(TypeError):
+            '19600101' <= Term('dob') <= '19620101'
+
+    def test_plan(self):
+        t = self.t
+        full_cost = t.estimate_rows()
+
+        cost, stream = Term('dob', '19650101').plan(t)
+        self.assertLess(cost, full_cost)
+
+        cost, stream = Term('username', 'user00042').plan(t)
+        self.assertLess(cost, 100)
+
+        # unindexed column is a full scan
+        cost, stream = Term('n', 5).plan(t)
+        self.assertEqual(cost, full_cost)
+
+        # compound index beats single column one; chosen stream is the
+        # compound index scan itself, not an operand plan filtered by And
+        q = And(Term('dob', '19650101'), Term('email', 'u1@x.com'))
+        cost, stream = q.plan(t)
+        prefix = ('19650101', 'u1@x.com')
+        index_cost, index_stream = t.plan_index(
+            'dob_email_index', prefix, prefix + (KEY_MAX,), True, q.matches,
+        )
+        self.assertEqual(cost, index_cost)
+        self.assertIs(stream.__code__, index_stream.__code__)
+
+        prefix = ('19650101',)
+        dob_cost, dob_stream = t.plan_index(
+            'dob_index', prefix, prefix + (KEY_MAX,), True, q.matches,
+        )
+        self.assertLess(cost, dob_cost)
+        self.check(q, lambda d: d['dob'] == '19650101' and d['email'] == 'u1@x.com')
+
+        self.assertEqual(
+            sorted(t.find(dob='19650101', email='u1@x.com')),
+            list(t.execute(q)),
+        )
+
+
+class TestRecordCodec(unittest.TestCase):
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        self.ds = DataStore(self.dirpath)
+
+    def tearDown(self):
+        self.ds.close()
+        shutil.rmtree(self.dirpath)
+
+    def user_table(self, **fields):
+        return self.ds.table('User', mem_table_cap=100).fields(
+            username=TextField(primary_key=True),
+            active=BoolField(),
+            score=FloatField(),
+            logins=IntField(),
+            dob=DateField(),
+            wakes=TimeField(),
+            created=DateTimeField(),
+            **fields
+        )
+
+    def doc(self, i):
+        return {
+            'username': 'user{}'.format(i),
+            'active': i % 2 == 0,
+            'score': i / 3.0,
+            'logins': -i,
+            'dob': datetime.date(1980, 1, 1) + datetime.timedelta(days=i),
+            'wakes': datetime.time(6, i % 60, 0, i),
+            'created': datetime.datetime(2020, 1, 1, 12, 30) + datetime.timedelta(seconds=i),
+        }
+
+    def test_roundtrip(self):
+        t = self.user_table()
+        codec = t.meta.codec
+
+        doc = self.doc(7)
+        data = codec.encode(doc)
+        self.assertEqual(data[0], datastore.RECORD_FORMAT_TYPED)
+        self.assertEqual(codec.decode(data), doc)
+        self.assertEqual(codec.decode(memoryview(data)), doc)
+
+        partial = {'username': 'x', 'score': None, 'logins': 3}
+        self.assertEqual(codec.decode(codec.encode(partial)), partial)
+
+        # values not matching schema fall back to json
+        for value in ({'username': 'x', 'other': 1}, {'username': 'x', 'logins': '1'}, 5, [1, 2]):
+            data = codec.encode(value)
+            self.assertEqual(data[0], datastore.RECORD_FORMAT_JSON)
+            self.assertEqual(codec.decode(data), value)
+
+        # dates and times survive json fallback, nested too
+        extra = dict(self.doc(3), extra={'at': [datetime.time(1, 2)], '$date': 'not a date'})
+        data = codec.encode(extra)
+        self.assertEqual(data[0], datastore.RECORD_FORMAT_JSON)
+        self.assertEqual(codec.decode(data), extra)
+        self.assertEqual(codec.decode(codec.encode({'$date': 1})), {'$date': 1})
+
+        t.set('extra', extra)
+        self.assertEqual(t.get('extra'), extra)
+
+        text = {'username': 'user7', 'active': True, 'score': 2.5, 'logins': 1234567}
+        self.assertLess(len(codec.encode(text)), len(json.dumps(text)) / 2)
+
+        for i in range(250):
+            t.set('user{}'.format(i), self.doc(i))
+
+        t.flush()
+
+        for i in range(250):
+            self.assertEqual(t.get('user{}'.format(i)), self.doc(i))
+
+    def test_schema_versions(self):
+        t = self.user_table()
+
+        for i in range(150):
+            t.set('user{}'.format(i), self.doc(i))
+
+        self.ds.close()
+
+        self.ds = DataStore(self.dirpath)
+        t = self.user_table(email=TextField())
+        self.assertEqual(t.meta.version, 2)
+
+        with open(t.meta.path) as f:
+            meta = json.load(f)
+
+        self.assertEqual(sorted(meta['versions']), ['1', '2'])
+
+        doc = dict(self.doc(1000), email='a@b.c')
+        t.set('user1000', doc)
+        self.assertEqual(t.get('user1000'), doc)
+
+        # records of version 1 still decode
+        for i in range(150):
+            self.assertEqual(t.get('user{}'.format(i)), self.doc(i))
+
+        # unchanged fields keep version
+        self.ds.close()
+        self.ds = DataStore(self.dirpath)
+        t = self.user_table(email=TextField())
+        self.assertEqual(t.meta.version, 2)
+        self.assertEqual(t.get('user1000'), doc)
+
+
+class TestBulkLoad(unittest.TestCase):
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        self.ds = DataStore(self.dirpath)
+
+    def tearDown(self):
+        self.ds.close()
+        shutil.rmtree(self.dirpath)
+
+    def user_table(self, **kwargs):
+        return self.ds.table('User', **kwargs).fields(
+            username=TextField(primary_key=True),
+            email=TextField(),
+            n=IntField(),
+            email_index=Index('email'),
+        )
+
+    def items(self, n, seed=7):
+        # shuffled, every tenth key twice with the later value winning
+        rnd = random.Random(seed)
+        keys = list(range(n)) + list(range(0, n, 10))
+        rnd.shuffle(keys)
+        seen = set()
+
+        for i in keys:
+            n_seen = 1 if i in seen else 0
+            seen.add(i)
+            yield 'user{:06d}'.format(i), {'email': 'e{}@x.com'.format(i % 13), 'n': n_seen}
+
+    def test_external_sort(self):
+        t = self.user_table(compaction=None)
+        expected = {}
+
+        for key, doc in self.items(5000):
+            expected[(key,)] = doc
+
+        # small runs force spills and a multi-way merge
+        self.assertEqual(t.bulk_load(self.items(5000), run_bytes=20000), 5000)
+        self.assertEqual(len(t.file_tables), 1)
+        self.assertEqual(len(t.file_tables[0]), 5000)
+        self.assertFalse([f for f in os.listdir(self.dirpath) if f.endswith('.run')])
+
+        self.assertEqual(list(t.scan()), sorted(expected.items()))
+        self.assertEqual(t.get('user000010'), {'email': 'e10@x.com', 'n': 1})
+        self.assertEqual(t.get('user000011'), {'email': 'e11@x.com', 'n': 0})
+
+        self.assertEqual(
+            list(t.find(email='e3@x.com')),
+            sorted((k, d) for k, d in expected.items() if d['email'] == 'e3@x.com'),
+        )
+
+    def test_leveled_and_overlap(self):
+        compaction = datastore.LeveledCompaction(level_base_bytes=20000, level_multiplier=4, target_file_bytes=8000)
+        t = self.user_table(compaction=compaction)
+        t.bulk_load(self.items(3000), run_bytes=50000)
+
+        # empty table: rows go to the level their size belongs to
+        levels = set(f.level for f in t.file_tables)
+        self.assertEqual(len(levels), 1)
+        self.assertGreater(levels.pop(), 1)
+        self.assertGreater(len(t.file_tables), 1)
+
+        # overlapping load shadows older rows
+        t.set('user000005', {'email': 'old', 'n': 5})
+        t.bulk_load([('user000005', {'email': 'new', 'n': 5}), ('user999999', {'email': 'z', 'n': 0})])
+        self.assertEqual(t.get('user000005'), {'email': 'new', 'n': 5})
+        self.assertEqual(t.get('user999999'), {'email': 'z', 'n': 0})
+        self.assertEqual([k for k, d in t.find(email='new')], [('user000005',)])
+        self.assertEqual(list(t.find(email='old')), [])
+
+        t.compact()
+        self.assertEqual(t.get('user000005'), {'email': 'new', 'n': 5})
+        self.assertEqual(len(list(t.scan())), 3001)
+
+    def test_row_cache(self):
+        # cached row read before the load is not served after it
+        t = self.user_table(compaction=None, row_cache_size=100)
+        t.set('user000001', {'email': 'old', 'n': 1})
+        self.assertEqual(t.get('user000001'), {'email': 'old', 'n': 1})
+        self.assertEqual(len(t.row_cache), 1)
+
+        t.bulk_load([('user000001', {'email': 'new', 'n': 1})])
+        self.assertEqual(len(t.row_cache), 0)
+        self.assertEqual(t.get('user000001'), {'email': 'new', 'n': 1})
+
+
+class TestCompaction(unittest.TestCase):
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        self.ds = DataStore(self.dirpath)
+
+    def tearDown(self):
+        self.ds.close()
+        shutil.rmtree(self.dirpath)
+
+    def check_table(self, t, n):
+        for i in range(n):
+            if i % 7 == 0:
+                self.assertRaises(KeyError, t.get, i)
+            else:
+                self.assertEqual(t.get(i), {'i': i, 'v': 2})
+
+    def fill_table(self, t, n):
+        for v in range(3):
+            for i in range(n):
+                t.set(i, {'i': i, 'v': v})
+
+                if i % 7 == 0 and v == 2:
+                    t.delete(i)
+
+        t.flush()
+
+    def test_size_tiered(self):
+        t = self.ds.table('T', mem_table_cap=100, compaction=None)
+        self.fill_table(t, 1000)
+        n_files = len(t.file_tables)
+        self.assertGreaterEqual(n_files, 30)
+
+        t.compaction = datastore.SizeTieredCompaction(min_threshold=4)
+        t.compact()
+        self.assertLess(len(t.file_tables), n_files)
+        self.check_table(t, 1000)
+
+        t.compact(full=True)
+        self.assertEqual(len(t.file_tables), 1)
+        self.check_table(t, 1000)
+
+        # shadowed versions and tombstones are gone
+        self.assertEqual(len(t.file_tables[0]), 1000 - 143)
+        files = [f for f in os.listdir(self.dirpath) if f.endswith('.data')]
+        self.assertEqual(len(files), 1)
+
+    def test_leveled(self):
+        compaction = datastore.LeveledCompaction(
+            l0_trigger=2,
+            level_base_bytes=20000,
+            level_multiplier=2,
+            target_file_bytes=4000,
+        )
+
+        t = self.ds.table('T', mem_table_cap=100, compaction=compaction)
+        self.fill_table(t, 1000)
+        t.compact()
+
+        levels = {}
+
+        for f in t.file_tables:
+            levels.setdefault(f.level, []).append(f)
+
+        self.assertLess(len(levels.get(0, [])), 2)
+        self.assertGreater(max(levels), 1)
+
+        # deeper levels are sorted runs
+        for level, files in levels.items():
+            if level == 0:
+                continue
+
+            for a, b in zip(files, files[1:]):
+                self.assertLess(a.max_key, b.min_key)
+
+        self.check_table(t, 1000)
+
+        self.ds.close()
+        self.ds = DataStore(self.dirpath)
+        t = self.ds.table('T', mem_table_cap=100, compaction=None)
+        self.check_table(t, 1000)
+
+    def test_process_workers(self):
+        self.ds.close()
+        self.ds = DataStore(self.dirpath, process_workers=3)
+
+        t = self.ds.table('T', mem_table_cap=100, compaction=None).fields(
+            i=IntField(primary_key=True),
+            v=IntField(),
+            v_index=Index('v'),
+        )
+
+        # flushes are encoded in worker processes too
+        self.fill_table(t, 1000)
+        self.assertIsNotNone(self.ds.process_pool)
+        self.check_table(t, 1000)
+
+        # one subcompaction per key range, outputs do not overlap
+        t.compact(full=True)
+        files = sorted(t.file_tables, key=lambda f: f.min_key)
+        self.assertEqual(len(files), 3)
+        self.assertEqual(sum(len(f) for f in files), 1000 - 143)
+
+        for a, b in zip(files, files[1:]):
+            self.assertLess(a.max_key, b.min_key)
+
+        self.check_table(t, 1000)
+        self.assertEqual(len(list(t.find(v=2))), 1000 - 143)
+        self.assertEqual(os.listdir(t._run_dir()), [])
+
+    def test_rate_limiter(self):
+        limiter = datastore.RateLimiter(100000)
+        start = time.monotonic()
+
+        for i in range(3):
+            limiter.request(100000)
+
+        self.assertGreater(time.monotonic() - start, 1.5)
+
+
 if __name__ == '__main__':
     unittest.main()